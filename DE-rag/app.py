@@ -1,15 +1,20 @@
 import os
+import shutil
 import tempfile
+import threading
 
 import streamlit as st
 import pandas as pd
-from typing import List
+from typing import Dict, Tuple
 import base64
 from dotenv import load_dotenv
 from io import BytesIO
 
 # Import our utility modules
-from utils import process_documents, create_vector_db, load_vector_db, create_rag_chain, ask_question
+from utils import load_vector_db, create_rag_chain, ask_question
+from utils.vector_db import ingest_files, ingestion_params, missing_sources, plan_ingestion, release_vector_db
+from utils.vector_store_registry import registry
+from utils.index_versions import IndexVersions, ServingSlot
 
 # Optional voice support
 try:
@@ -29,12 +34,73 @@ DB_PATH = "./db/vector_db"
 COLLECTION_NAME = "docs-financial-rag"
 MODEL_NAME = "llama3.2"
 ALLOWED_EXTENSIONS = ['.pdf', '.txt', '.json']
+KEEP_INDEX_VERSIONS = 3
 
+# Uploaded files are stored under "upload://<collection>/<file name>" whatever temp path they were saved to
+UPLOAD_SOURCE_PREFIX = f"upload://{COLLECTION_NAME}/"
 
-def save_uploaded_files(uploaded_files) -> List[str]:
-    """Save uploaded files and return their paths"""
-    temp_dir = tempfile.mkdtemp()
-    file_paths = []
+index_versions = IndexVersions(DB_PATH)
+
+
+def cleanup_index_versions() -> None:
+    """
+    Drop old index versions once a new one is published. Servers pick the
+    new version up on /refresh; versions they still serve are leased and kept.
+    """
+    for removed in index_versions.cleanup(keep=KEEP_INDEX_VERSIONS):
+        registry.discard(removed)
+
+
+@st.cache_resource
+def serving_slot() -> Tuple[ServingSlot, threading.Lock]:
+    """
+    The index version this process answers from, shared by every session, and
+    the lock that serializes loading a new one. Like the RAG API, the slot
+    leases what it serves and releases a replaced version's store once no
+    session is still answering from it.
+    """
+    return ServingSlot(index_versions), threading.Lock()
+
+
+def release_state(state) -> None:
+    """Release a swapped-out version's vector store handle"""
+    release_vector_db(state['persist_directory'], COLLECTION_NAME)
+
+
+def serve_current_version() -> bool:
+    """Load the published index version into the serving slot unless it already holds it"""
+    serving, load_lock = serving_slot()
+    with load_lock:
+        version = index_versions.current_name() or 'unversioned'
+        if serving.stats()['version'] == version:
+            return True
+
+        persist_directory = index_versions.current()
+        vector_db = load_vector_db(persist_directory=persist_directory, collection_name=COLLECTION_NAME)
+        if not vector_db:
+            return False
+        try:
+            chain = create_rag_chain(vector_db, MODEL_NAME)
+        except Exception:
+            release_vector_db(persist_directory, COLLECTION_NAME)
+            raise
+        serving.swap({'db': vector_db, 'chain': chain, 'persist_directory': persist_directory},
+                     version, on_release=release_state)
+    return True
+
+
+def upload_source(name: str) -> str:
+    """Stable source name of an uploaded file, namespaced per collection"""
+    return f"{UPLOAD_SOURCE_PREFIX}{os.path.basename(name)}"
+
+
+def save_uploaded_files(uploaded_files) -> Tuple[str, Dict[str, str]]:
+    """Save uploaded files to a fresh directory; returns it and each saved path's source"""
+    # A directory per upload so sessions never overwrite each other's files. The
+    # chunks are stored under upload_source, not the temp path, so a re-upload of
+    # a file (changed or not) replaces its own earlier chunks.
+    upload_dir = tempfile.mkdtemp(prefix="finance-assistant-upload-")
+    sources = {}
 
     for uploaded_file in uploaded_files:
         file_extension = os.path.splitext(uploaded_file.name)[1].lower()
@@ -43,12 +109,12 @@ def save_uploaded_files(uploaded_files) -> List[str]:
             st.warning(f"Unsupported file format: {file_extension}. Skipping {uploaded_file.name}")
             continue
 
-        temp_file_path = os.path.join(temp_dir, uploaded_file.name)
+        temp_file_path = os.path.join(upload_dir, os.path.basename(uploaded_file.name))
         with open(temp_file_path, "wb") as f:
             f.write(uploaded_file.getbuffer())
-        file_paths.append(temp_file_path)
+        sources[temp_file_path] = upload_source(uploaded_file.name)
 
-    return file_paths
+    return upload_dir, sources
 
 
 def text_to_speech(text: str, api_key: str = None) -> BytesIO:
@@ -110,19 +176,17 @@ def main():
 
     if 'vector_db_created' not in st.session_state:
         st.session_state.vector_db_created = False
-    if 'rag_chain' not in st.session_state:
-        st.session_state.rag_chain = None
     if 'last_response' not in st.session_state:
         st.session_state.last_response = ""
     if 'selected_voice_id' not in st.session_state:
         st.session_state.selected_voice_id = "21m00Tcm4TlvDq8ikWAM"  # Default voice ID (Adam)
 
-    if os.path.exists(DB_PATH) and not st.session_state.vector_db_created:
+    if index_versions.has_data() and not st.session_state.vector_db_created:
         st.session_state.vector_db_created = True
 
     st.sidebar.title("Database Operations")
 
-    db_exists = os.path.exists(DB_PATH)
+    db_exists = index_versions.has_data()
     if db_exists:
         st.sidebar.success("Vector database exists! Ready to answer questions.")
     else:
@@ -138,56 +202,78 @@ def main():
     with st.sidebar.expander("Advanced Options", expanded=False):
         chunk_size = st.number_input("Chunk Size", value=600, min_value=100, max_value=1000)
         chunk_overlap = st.number_input("Chunk Overlap", value=100, min_value=0, max_value=300)
+        parser_workers = st.number_input("Parser Processes", value=max(1, min(os.cpu_count() or 1, 8)),
+                                         min_value=1, max_value=os.cpu_count() or 1)
+        prune_uploads = st.checkbox("Remove uploaded documents that are not in this upload", value=True)
 
     if st.sidebar.button("Process Documents & Create Database"):
         if not uploaded_files:
             st.sidebar.error("Please upload at least one document.")
         else:
             with st.sidebar.status("Processing documents..."):
-                file_paths = save_uploaded_files(uploaded_files)
-
-                if file_paths:
-                    st.sidebar.text(f"Processing {len(file_paths)} documents...")
-                    docs = process_documents(
-                        file_paths,
-                        chunk_size=chunk_size,
-                        chunk_overlap=chunk_overlap
-                    )
-
-                    st.sidebar.text("Creating vector database...")
-                    vector_db = create_vector_db(
-                        docs,
-                        persist_directory=DB_PATH,
-                        collection_name=COLLECTION_NAME,
-                    )
-
-                    st.session_state.vector_db_created = True
-                    st.sidebar.success(f"Vector database created with {len(docs)} chunks!")
-                else:
-                    st.sidebar.error("No valid documents were uploaded.")
+                upload_dir, sources = save_uploaded_files(uploaded_files)
+                file_paths = list(sources)
+
+                try:
+                    if file_paths:
+                        # Only new or changed files are parsed and embedded (see the ingestion manifest)
+                        params = ingestion_params(chunk_size, chunk_overlap)
+                        changed = plan_ingestion(file_paths, index_versions.current(), COLLECTION_NAME, params,
+                                                 sources)
+                        missing = missing_sources(file_paths, index_versions.current(), COLLECTION_NAME,
+                                                  UPLOAD_SOURCE_PREFIX, sources) if prune_uploads else []
+                        if not changed and not missing:
+                            st.session_state.vector_db_created = True
+                            st.sidebar.success(f"All {len(file_paths)} documents are already in the database.")
+                        else:
+                            st.sidebar.text(f"Processing {len(changed)} of {len(file_paths)} documents, "
+                                            f"removing {len(missing)}...")
+
+                            # Build the next version beside the one being served, then publish it. The
+                            # plan is made again inside, against the version another writer may have published
+                            with index_versions.writer(copy_current=True) as version_path:
+                                report = ingest_files(
+                                    file_paths,
+                                    persist_directory=version_path,
+                                    collection_name=COLLECTION_NAME,
+                                    chunk_size=chunk_size,
+                                    chunk_overlap=chunk_overlap,
+                                    workers=parser_workers,
+                                    sources=sources,
+                                    prune_prefix=UPLOAD_SOURCE_PREFIX if prune_uploads else None
+                                )
+                            cleanup_index_versions()
+
+                            st.session_state.vector_db_created = True
+                            st.sidebar.success(f"Vector database updated: {report['ingested']} documents ingested, "
+                                               f"{report['skipped']} unchanged, {report['failed']} failed, "
+                                               f"{report['removed']} removed.")
+                    else:
+                        st.sidebar.error("No valid documents were uploaded.")
+                finally:
+                    # The chunks are stored under their upload source, so the files are not needed any more
+                    shutil.rmtree(upload_dir, ignore_errors=True)
 
     if st.sidebar.button("Delete Database"):
-        if os.path.exists(DB_PATH):
-            import shutil
-            shutil.rmtree(DB_PATH)
+        if index_versions.has_data():
+            # Publish an empty version instead of deleting files under live readers;
+            # the old versions are removed by later cleanups once nothing serves them
+            with index_versions.writer(copy_current=False):
+                pass
+            cleanup_index_versions()
             st.session_state.vector_db_created = False
-            st.session_state.rag_chain = None
             st.sidebar.success("Database deleted successfully.")
         else:
             st.sidebar.info("No database to delete.")
 
     st.header("Finance Assistant")
 
-    if st.session_state.vector_db_created and not st.session_state.rag_chain:
+    # This or another session may have published a newer index; swap it in before older ones are cleaned up
+    if (st.session_state.vector_db_created
+            and serving_slot()[0].stats()['version'] != (index_versions.current_name() or 'unversioned')):
         with st.status("Loading RAG chain..."):
             try:
-                vector_db = load_vector_db(
-                    persist_directory=DB_PATH,
-                    collection_name=COLLECTION_NAME,
-                )
-
-                if vector_db:
-                    st.session_state.rag_chain = create_rag_chain(vector_db, MODEL_NAME)
+                if serve_current_version():
                     st.success("Ready to answer your questions!")
                 else:
                     st.error("Failed to load vector database. Please create a new one.")
@@ -239,16 +325,19 @@ def main():
         if st.button("Get Results"):
             if not question:
                 st.warning("Please enter a question.")
-            elif not st.session_state.rag_chain:
-                st.error("RAG chain is not loaded. Please create or load a database first.")
             else:
-                with st.status("Generating answer..."):
-                    try:
-                        # Get answer from RAG chain
-                        response = ask_question(st.session_state.rag_chain, question)
-                        st.session_state.last_response = response
-                    except Exception as e:
-                        st.error(f"Error generating results: {str(e)}")
+                # The version is held until the answer is done, even if another session swaps in a newer one
+                with serving_slot()[0].use() as state:
+                    if state is None:
+                        st.error("RAG chain is not loaded. Please create or load a database first.")
+                    else:
+                        with st.status("Generating answer..."):
+                            try:
+                                # Get answer from RAG chain
+                                response = ask_question(state['chain'], question)
+                                st.session_state.last_response = response
+                            except Exception as e:
+                                st.error(f"Error generating results: {str(e)}")
 
         # Display the response
         if st.session_state.last_response:
@@ -1,12 +1,22 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 import os
 import sys
+import json
+import time
 import logging
 import datetime
 from pathlib import Path
-from utils.vector_db import load_vector_db
-from utils.rag_chain import create_rag_chain, ask_question
+from utils.vector_db import load_vector_db, release_vector_db
+from utils.vector_store_registry import registry
+from utils.rag_chain import create_rag_chain, load_dense_store, ask_question, stream_question, batch_questions, ERROR_RESPONSE
+from utils.rag_chain import normalize_query
+from utils.rag_chain import api_key_cache, finance_cache, market_snapshot, SERPAPI_URL
+from utils.http_client import finance_http
+from utils.answer_cache import SemanticAnswerCache
+from utils.local_market_data import LocalMarketData
+from utils.sse import sse_stream, SSE_HEADERS
+from utils.index_versions import IndexVersions, ServingSlot
 
 # Configure logging
 logging.basicConfig(
@@ -27,68 +37,165 @@ logger.info(f"Current directory: {current_dir}")
 project_root = current_dir.parent
 sys.path.append(str(project_root))
 
-# Global variables for the vector DB and RAG chain
+# Limits for /rag/batch
+BATCH_MAX_QUESTIONS = int(os.environ.get('BATCH_MAX_QUESTIONS', 500))
+BATCH_MAX_CONCURRENCY = int(os.environ.get('BATCH_MAX_CONCURRENCY', 4))
+BATCH_CONCURRENCY_LIMIT = int(os.environ.get('BATCH_CONCURRENCY_LIMIT', 16))
+
+COLLECTION_NAME = "docs-financial-rag"
+
+# Versioned index snapshots under db/vector_db; /refresh hot-swaps to the published one
+index_versions = IndexVersions(os.path.join(current_dir, "db", "vector_db"))
+serving = ServingSlot(index_versions)
+
+# Global variables for the vector DB, RAG chain and answer cache of the version being served
 db = None
 rag_chain = None
+answer_cache = None
+local_market = None
 
 
-def initialize_system():
-    """Initialize the RAG system with proper error handling"""
-    global db, rag_chain
+def warm_up_state(state):
+    """Run one retrieval on the store that serves queries so it and the embedding model are loaded before the swap"""
+    started = time.monotonic()
+    state['dense_store'].similarity_search("market outlook", k=1)
+    logger.info(f"Index version warmed up in {time.monotonic() - started:.2f}s")
 
-    try:
-        # Set up vector database path
-        vector_db_path = os.path.join(current_dir, "db", "vector_db")
-        logger.info(f"Looking for vector DB at: {vector_db_path}")
-
-        if not os.path.exists(vector_db_path):
-            logger.warning(f"Vector DB directory '{vector_db_path}' does not exist!")
-            os.makedirs(vector_db_path, exist_ok=True)
-            logger.info(f"Created vector DB directory at: {vector_db_path}")
-        else:
-            logger.info(f"Vector DB directory found at: {vector_db_path}")
-            contents = os.listdir(vector_db_path)
-            logger.info(f"Directory contents: {contents}")
 
-        # Load the vector database
-        logger.info("Attempting to load vector DB...")
-        db = load_vector_db(vector_db_path, "docs-financial-rag")
+def release_state(state):
+    """Release a swapped-out version once its last in-flight request has finished"""
+    logger.info(f"Releasing index version at {state['persist_directory']}")
+    release_vector_db(state['persist_directory'], COLLECTION_NAME)
 
-        if db is None:
-            logger.error("Vector DB loaded as None")
-            raise ValueError("Failed to load vector database")
-        else:
-            logger.info("Vector DB loaded successfully!")
 
+def build_state():
+    """Load, build and warm everything needed to serve the published index version"""
+    global local_market
+
+    vector_db_path = index_versions.current()
+    logger.info(f"Looking for vector DB at: {vector_db_path}")
+
+    if not os.path.exists(vector_db_path):
+        logger.warning(f"Vector DB directory '{vector_db_path}' does not exist!")
+        os.makedirs(vector_db_path, exist_ok=True)
+        logger.info(f"Created vector DB directory at: {vector_db_path}")
+    else:
+        logger.info(f"Vector DB directory found at: {vector_db_path}")
+        contents = os.listdir(vector_db_path)
+        logger.info(f"Directory contents: {contents}")
+
+    # Load the vector database
+    logger.info("Attempting to load vector DB...")
+    vector_db = load_vector_db(vector_db_path, COLLECTION_NAME)
+
+    if vector_db is None:
+        logger.error("Vector DB loaded as None")
+        raise ValueError("Failed to load vector database")
+    else:
+        logger.info("Vector DB loaded successfully!")
+
+    try:
         # Get SerpAPI key from environment variable
         serpapi_key = os.environ.get('SERP_API_KEY')
         if not serpapi_key:
             logger.warning("No SerpAPI key found in environment variables")
 
+        # Local quotes from stock_data_polygone, used before SerpAPI for known symbols
+        if local_market is None and os.environ.get('LOCAL_MARKET_DATA', '1') != '0':
+            try:
+                local_market = LocalMarketData.from_postgres()
+                local_market.load_symbols()
+            except ImportError:
+                logger.warning("psycopg2 not installed, local market data disabled")
+                local_market = None
+
         # Create RAG chain
         model_name = os.environ.get('LLM_MODEL', 'gpt-4o-mini')
         logger.info(f"Creating RAG chain with model: {model_name}")
 
-        rag_chain = create_rag_chain(
-            db,
+        # The compressed index when enabled, so Chroma's float32 HNSW is never loaded
+        dense_store = load_dense_store(vector_db)
+        chain = create_rag_chain(
+            vector_db,
             model_name=model_name,
             max_length=500,
             top_k=5,
-            serpapi_key=serpapi_key
+            serpapi_key=serpapi_key,
+            local_market=local_market,
+            dense_store=dense_store
         )
         logger.info("RAG chain created successfully!")
-        return True
 
+        # Answer cache shares the vector store's embedding model; a fresh one per
+        # index version so answers never outlive the data they came from
+        cache = SemanticAnswerCache(
+            vector_db.embeddings,
+            threshold=float(os.environ.get('ANSWER_CACHE_THRESHOLD', 0.92)),
+            ttl=float(os.environ.get('ANSWER_CACHE_TTL', 300)),
+            max_entries=int(os.environ.get('ANSWER_CACHE_SIZE', 1000))
+        )
+
+        state = {'db': vector_db, 'dense_store': dense_store, 'chain': chain, 'answer_cache': cache,
+                 'persist_directory': vector_db_path}
+        warm_up_state(state)
+        return state
+    except Exception:
+        release_vector_db(vector_db_path, COLLECTION_NAME)
+        raise
+
+
+def initialize_system():
+    """Build the published index version off to the side and swap it in; the current one keeps serving if that fails"""
+    global db, rag_chain, answer_cache
+
+    try:
+        state = build_state()
     except Exception as e:
         logger.error(f"ERROR during initialization: {e}")
         import traceback
         logger.error(traceback.format_exc())
         return False
 
+    version = index_versions.current_name() or 'unversioned'
+    serving.swap(state, version, on_release=release_state)
+    db, rag_chain, answer_cache = state['db'], state['chain'], state['answer_cache']
+    logger.info(f"Now serving index version {version}")
+    return True
+
 
 # Initialize the system at startup
 system_initialized = initialize_system()
 
+# Open the SerpAPI connection before the first question needs it
+finance_http.warm_up(SERPAPI_URL)
+
+# Keep the market index table refreshed in the background
+market_snapshot.start()
+
+
+def lookup_answer(cache, query):
+    """Look a query up in the answer cache, treating a missing cache as a miss"""
+    if cache is None:
+        return {'hit': False, 'embedding': None}
+    return cache.lookup(query)
+
+
+def lookup_answers(cache, queries):
+    """Look many queries up in the answer cache at once (one embedding call for the misses)"""
+    if cache is None:
+        return [{'hit': False, 'embedding': None} for _ in queries]
+    return cache.lookup_many(queries)
+
+
+def answer_cache_info(cache, cached):
+    """Answer cache metadata for the response sources block"""
+    info = {'hit': cached['hit']}
+    if cached['hit']:
+        info.update(similarity=cached['similarity'], age_seconds=cached['age_seconds'])
+    if cache is not None:
+        info.update(cache.stats())
+    return info
+
 
 @app.route('/rag', methods=['POST'])
 def rag():
@@ -98,25 +205,42 @@ def rag():
         logger.warning("Request received with no query")
         return jsonify({'error': 'No query provided'}), 400
 
-    # Check if system is properly initialized
-    if not system_initialized or rag_chain is None:
-        logger.error("RAG system not initialized for request: " + query)
-        return jsonify({
-            'error': 'RAG system not initialized properly',
-            'fallback_response': 'The financial information system is currently unavailable. Please try again later.'
-        }), 500
-
+    # The request keeps the index version it started on, even if /refresh swaps meanwhile
+    with serving.use() as state:
+        # Check if system is properly initialized
+        if not system_initialized or state is None:
+            logger.error("RAG system not initialized for request: " + query)
+            return jsonify({
+                'error': 'RAG system not initialized properly',
+                'fallback_response': 'The financial information system is currently unavailable. Please try again later.'
+            }), 500
+        return answer_query(state, query)
+
+
+def answer_query(state, query):
+    """Answer one /rag query with the given serving state"""
+    cache = state['answer_cache']
     try:
         logger.info(f"Processing query: {query}")
-        answer = ask_question(rag_chain, query)
-        logger.info(f"Answer generated successfully ({len(answer)} chars)")
+        context_sources = {}
+        cached = lookup_answer(cache, query)
+        if cached["hit"]:
+            answer = cached["answer"]
+            logger.info(f"Answer served from cache (similarity {cached['similarity']})")
+        else:
+            answer = ask_question(state['chain'], query, context_sources)
+            logger.info(f"Answer generated successfully ({len(answer)} chars)")
+            if cache and answer != ERROR_RESPONSE:
+                cache.store(query, answer, cached["embedding"])
 
         # Return the answer with metadata for frontend use
         return jsonify({
             'answer': answer,
             'sources': {
-                'vector_db_used': db is not None,
-                'serp_api_used': 'Google Finance via SerpAPI' in answer
+                'vector_db_used': state['db'] is not None,
+                'serp_api_used': 'Google Finance via SerpAPI' in answer,
+                'context': context_sources,
+                'answer_cache': answer_cache_info(cache, cached)
             },
             'timestamp': datetime.datetime.now().isoformat()
         })
@@ -130,10 +254,59 @@ def rag():
         }), 500
 
 
-@app.route('/health', methods=['GET'])
-def health_check():
-    """Health check endpoint for monitoring"""
-    global db, rag_chain, system_initialized
+@app.route('/rag/stream', methods=['POST'])
+def rag_stream():
+    """Endpoint to stream financial RAG answers as Server-Sent Events"""
+    query = request.json.get('query', '')
+    if not query:
+        logger.warning("Stream request received with no query")
+        return jsonify({'error': 'No query provided'}), 400
+
+    entry = serving.acquire()
+    if not system_initialized or entry is None:
+        serving.release(entry)
+        logger.error("RAG system not initialized for stream request: " + query)
+        return jsonify({
+            'error': 'RAG system not initialized properly',
+            'fallback_response': 'The financial information system is currently unavailable. Please try again later.'
+        }), 500
+
+    chain, cache = entry['value']['chain'], entry['value']['answer_cache']
+    logger.info(f"Streaming query: {query}")
+
+    def events():
+        cached = lookup_answer(cache, query)
+        if cached['hit']:
+            yield {'type': 'sources', 'sources': {'answer_cache': answer_cache_info(cache, cached)}}
+            yield {'type': 'token', 'token': cached['answer']}
+            return
+
+        tokens = []
+        completed = True
+        for event in stream_question(chain, query):
+            if event['type'] == 'sources':
+                event['sources']['answer_cache'] = answer_cache_info(cache, cached)
+            elif event['type'] == 'token':
+                tokens.append(event['token'])
+            else:
+                completed = False
+            yield event
+
+        logger.info(f"Answer streamed ({sum(len(t) for t in tokens)} chars)")
+        if completed and cache is not None:
+            cache.store(query, "".join(tokens), cached['embedding'])
+
+    response = Response(stream_with_context(sse_stream(events())),
+                        mimetype='text/event-stream',
+                        headers=SSE_HEADERS)
+    # The index version is held until the stream is closed
+    response.call_on_close(lambda: serving.release(entry))
+    return response
+
+
+def system_status():
+    """Build the health payload, reinitializing first if the system is down"""
+    global system_initialized
 
     # try reinitializing iun case of failure
     if not system_initialized:
@@ -144,11 +317,98 @@ def health_check():
         'status': 'up' if system_initialized else 'degraded',
         'rag_initialized': rag_chain is not None,
         'db_loaded': db is not None,
+        'serpapi_key_cache': api_key_cache.stats(),
+        'finance_cache': finance_cache.stats(),
+        'outbound_http': finance_http.stats(),
+        'market_snapshot': market_snapshot.health(),
+        'local_market_data': local_market.stats() if local_market else None,
+        'vector_store_registry': registry.stats(),
+        'index_version': serving.stats(),
         'timestamp': datetime.datetime.now().isoformat(),
         'app_version': '1.0.1'
     }
 
     status_code = 200 if system_initialized else 503
+    return status, status_code
+
+
+def is_admin(api_key):
+    """Check the admin API key (simplified for example)"""
+    return bool(api_key) and api_key == os.environ.get('ADMIN_API_KEY')
+
+
+@app.route('/rag/batch', methods=['POST'])
+def rag_batch():
+    """Endpoint to answer many financial queries, streamed back as NDJSON in completion order"""
+    data = request.json or {}
+    queries = data.get('queries', [])
+    if not isinstance(queries, list) or not queries or not all(isinstance(q, str) and q for q in queries):
+        logger.warning("Batch request received without a valid list of queries")
+        return jsonify({'error': 'queries must be a non-empty list of strings'}), 400
+    if len(queries) > BATCH_MAX_QUESTIONS:
+        return jsonify({'error': f'At most {BATCH_MAX_QUESTIONS} queries per batch'}), 400
+
+    try:
+        max_concurrency = int(data.get('max_concurrency', BATCH_MAX_CONCURRENCY))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'max_concurrency must be an integer'}), 400
+    max_concurrency = max(1, min(max_concurrency, BATCH_CONCURRENCY_LIMIT))
+
+    entry = serving.acquire()
+    if not system_initialized or entry is None:
+        serving.release(entry)
+        logger.error(f"RAG system not initialized for batch of {len(queries)} queries")
+        return jsonify({
+            'error': 'RAG system not initialized properly',
+            'fallback_response': 'The financial information system is currently unavailable. Please try again later.'
+        }), 500
+
+    chain, cache = entry['value']['chain'], entry['value']['answer_cache']
+    logger.info(f"Processing batch of {len(queries)} queries (max concurrency {max_concurrency})")
+
+    def results():
+        started = time.monotonic()
+        misses = []
+
+        # Each distinct question is looked up once, all in one cache call
+        unique = {}
+        for query in queries:
+            unique.setdefault(normalize_query(query), query)
+        lookups = dict(zip(unique, lookup_answers(cache, list(unique.values()))))
+
+        # Cached answers go out first; everything else goes through the chain's batch
+        for index, query in enumerate(queries):
+            cached = lookups[normalize_query(query)]
+            if cached['hit']:
+                yield json.dumps({'index': index, 'query': query, 'answer': cached['answer'],
+                                  'answer_cache': {'hit': True, 'similarity': cached['similarity']}}) + '\n'
+            else:
+                misses.append(index)
+
+        stored = set()
+        for result in batch_questions(chain, [queries[i] for i in misses], max_concurrency):
+            index = misses[result['index']]
+            key = normalize_query(queries[index])
+            if cache is not None and key not in stored and result['answer'] != ERROR_RESPONSE:
+                stored.add(key)
+                cache.store(queries[index], result['answer'], lookups[key]['embedding'])
+            yield json.dumps({'index': index, 'query': queries[index], 'answer': result['answer'],
+                              'context': result['sources'], 'answer_cache': {'hit': False}}) + '\n'
+
+        elapsed = time.monotonic() - started
+        logger.info(f"Batch of {len(queries)} queries finished in {elapsed:.2f}s")
+        yield json.dumps({'done': True, 'count': len(queries), 'unique': len(lookups),
+                          'cached': len(queries) - len(misses), 'seconds': round(elapsed, 3)}) + '\n'
+
+    response = Response(stream_with_context(results()), mimetype='application/x-ndjson', headers=SSE_HEADERS)
+    response.call_on_close(lambda: serving.release(entry))
+    return response
+
+
+@app.route('/health', methods=['GET'])
+def health_check():
+    """Health check endpoint for monitoring"""
+    status, status_code = system_status()
     return jsonify(status), status_code
 
 
@@ -157,19 +417,18 @@ def refresh_system():
     """Admin endpoint to refresh the RAG system"""
     global system_initialized
 
-    # Check for admin authentication (simplified for example)
-    api_key = request.headers.get('X-API-Key')
-    if not api_key or api_key != os.environ.get('ADMIN_API_KEY'):
+    # Check for admin authentication
+    if not is_admin(request.headers.get('X-API-Key')):
         logger.warning("Unauthorized refresh attempt")
         return jsonify({'error': 'Unauthorized'}), 401
 
+    # The new version loads and warms up while the current one keeps serving
     logger.info("Manual system refresh requested")
-    system_initialized = initialize_system()
-
-    if system_initialized:
-        return jsonify({'status': 'System refreshed successfully'})
+    if initialize_system():
+        system_initialized = True
+        return jsonify({'status': 'System refreshed successfully', 'index_version': serving.stats()['version']})
     else:
-        return jsonify({'error': 'System refresh failed'}), 500
+        return jsonify({'error': 'System refresh failed', 'index_version': serving.stats()['version']}), 500
 
 
 
@@ -0,0 +1,171 @@
+"""
+ASGI serving mode for the financial RAG API.
+
+Runs alongside the Flask app in rag_api.py and shares its initialization,
+but answers on the event loop with the chain's async interface, so one
+process can hold hundreds of in-flight questions. Run with:
+
+    uvicorn rag_asgi:app --host 0.0.0.0 --port 5007
+"""
+import asyncio
+import datetime
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+import rag_api
+from rag_api import logger
+from utils.rag_chain import aask_question, astream_question, ERROR_RESPONSE
+from utils.http_client import async_finance_http
+from utils.sse import asse_stream, SSE_HEADERS
+
+
+async def read_query(request: Request) -> str:
+    try:
+        data = await request.json()
+    except Exception:
+        return ''
+    return data.get('query', '') if isinstance(data, dict) else ''
+
+
+def not_initialized(query: str) -> JSONResponse:
+    logger.error("RAG system not initialized for request: " + query)
+    return JSONResponse({
+        'error': 'RAG system not initialized properly',
+        'fallback_response': 'The financial information system is currently unavailable. Please try again later.'
+    }, status_code=500)
+
+
+async def rag(request: Request) -> JSONResponse:
+    """Endpoint to process financial RAG queries"""
+    query = await read_query(request)
+    if not query:
+        logger.warning("Request received with no query")
+        return JSONResponse({'error': 'No query provided'}, status_code=400)
+
+    # The request keeps the index version it started on, even if /refresh swaps meanwhile
+    entry = rag_api.serving.acquire()
+    if not rag_api.system_initialized or entry is None:
+        rag_api.serving.release(entry)
+        return not_initialized(query)
+
+    state = entry['value']
+    chain, cache = state['chain'], state['answer_cache']
+    try:
+        logger.info(f"Processing query: {query}")
+        context_sources = {}
+        # Answer cache embedding goes to Ollama synchronously, so keep it off the loop
+        cached = await asyncio.to_thread(rag_api.lookup_answer, cache, query)
+        if cached['hit']:
+            answer = cached['answer']
+            logger.info(f"Answer served from cache (similarity {cached['similarity']})")
+        else:
+            answer = await aask_question(chain, query, context_sources)
+            logger.info(f"Answer generated successfully ({len(answer)} chars)")
+            if cache is not None and answer != ERROR_RESPONSE:
+                await asyncio.to_thread(cache.store, query, answer, cached['embedding'])
+
+        return JSONResponse({
+            'answer': answer,
+            'sources': {
+                'vector_db_used': state['db'] is not None,
+                'serp_api_used': 'Google Finance via SerpAPI' in answer,
+                'context': context_sources,
+                'answer_cache': rag_api.answer_cache_info(cache, cached)
+            },
+            'timestamp': datetime.datetime.now().isoformat()
+        })
+    except Exception as e:
+        logger.exception(f"Error processing query: {str(e)}")
+        return JSONResponse({
+            'error': str(e),
+            'fallback_response': 'I encountered an error processing your financial query. Please rephrase or try a different question.'
+        }, status_code=500)
+    finally:
+        rag_api.serving.release(entry)
+
+
+async def rag_stream(request: Request):
+    """Endpoint to stream financial RAG answers as Server-Sent Events"""
+    query = await read_query(request)
+    if not query:
+        logger.warning("Stream request received with no query")
+        return JSONResponse({'error': 'No query provided'}, status_code=400)
+
+    entry = rag_api.serving.acquire()
+    if not rag_api.system_initialized or entry is None:
+        rag_api.serving.release(entry)
+        return not_initialized(query)
+
+    chain, cache = entry['value']['chain'], entry['value']['answer_cache']
+    logger.info(f"Streaming query: {query}")
+
+    async def answer_events():
+        cached = await asyncio.to_thread(rag_api.lookup_answer, cache, query)
+        if cached['hit']:
+            yield {'type': 'sources', 'sources': {'answer_cache': rag_api.answer_cache_info(cache, cached)}}
+            yield {'type': 'token', 'token': cached['answer']}
+            return
+
+        tokens = []
+        completed = True
+        async for event in astream_question(chain, query):
+            if event['type'] == 'sources':
+                event['sources']['answer_cache'] = rag_api.answer_cache_info(cache, cached)
+            elif event['type'] == 'token':
+                tokens.append(event['token'])
+            else:
+                completed = False
+            yield event
+
+        logger.info(f"Answer streamed ({sum(len(t) for t in tokens)} chars)")
+        if completed and cache is not None:
+            await asyncio.to_thread(cache.store, query, "".join(tokens), cached['embedding'])
+
+    async def events():
+        # The index version is held until the stream ends or the client disconnects
+        try:
+            async for event in answer_events():
+                yield event
+        finally:
+            rag_api.serving.release(entry)
+
+    return StreamingResponse(asse_stream(events()), media_type='text/event-stream', headers=SSE_HEADERS)
+
+
+async def health_check(request: Request) -> JSONResponse:
+    """Health check endpoint for monitoring"""
+    status, status_code = await asyncio.to_thread(rag_api.system_status)
+    status['serving_mode'] = 'asgi'
+    status['async_outbound_http'] = async_finance_http.stats()
+    return JSONResponse(status, status_code=status_code)
+
+
+async def refresh_system(request: Request) -> JSONResponse:
+    """Admin endpoint to refresh the RAG system"""
+    if not rag_api.is_admin(request.headers.get('X-API-Key')):
+        logger.warning("Unauthorized refresh attempt")
+        return JSONResponse({'error': 'Unauthorized'}, status_code=401)
+
+    # The new version loads and warms up while the current one keeps serving
+    logger.info("Manual system refresh requested")
+    refreshed = await asyncio.to_thread(rag_api.initialize_system)
+    version = rag_api.serving.stats()['version']
+
+    if refreshed:
+        rag_api.system_initialized = True
+        return JSONResponse({'status': 'System refreshed successfully', 'index_version': version})
+    return JSONResponse({'error': 'System refresh failed', 'index_version': version}, status_code=500)
+
+
+app = Starlette(
+    routes=[
+        Route('/rag', rag, methods=['POST']),
+        Route('/rag/stream', rag_stream, methods=['POST']),
+        Route('/health', health_check, methods=['GET']),
+        Route('/refresh', refresh_system, methods=['POST']),
+    ],
+    on_shutdown=[async_finance_http.aclose],
+)
@@ -1,14 +1,23 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 import os
 import sys
+import atexit
+import shutil
+import tempfile
+import threading
 from pathlib import Path
 import datetime
 from werkzeug.utils import secure_filename
-from utils.rag_chain import create_rag_chain
-from utils.vector_db import load_vector_db, create_vector_db
+from utils.rag_chain import create_rag_chain, stream_question
+from utils.vector_db import load_vector_db, release_vector_db, create_vector_db
+from utils.vector_store_registry import registry
+from utils.index_versions import IndexVersions, ServingSlot
 from utils.summarize_chain import create_summarization_chain
-from utils.document_processor import process_documents
+from utils.document_processor import process_documents, add_metadata
+from utils.sse import sse_stream, SSE_HEADERS
+from utils.metadata_filter import build_filter
+from utils.ingest_manifest import IngestManifest, file_hash
 from langchain.schema import Document
 
 
@@ -25,8 +34,29 @@ print(f"Current directory: {current_dir}")
 project_root = current_dir.parent
 sys.path.append(str(project_root))
 
-try:
-    vector_db_path = os.path.join(current_dir, "db", "vector_db")
+# Model the chains are built with; recorded in the manifest so a model change re-summarizes
+SUMMARY_MODEL = "gpt-4o-mini"
+
+COLLECTION_NAME = "docs-financial-rag"
+KEEP_INDEX_VERSIONS = 3
+
+# Summaries are written into new index versions; reads follow the published one
+index_versions = IndexVersions(os.path.join(current_dir, "db", "vector_db"))
+serving = ServingSlot(index_versions)
+state_lock = threading.Lock()
+
+# Summaries are queued and written in batches, one new index version per flush,
+# so adding one summary does not copy and reload the whole index
+SUMMARY_FLUSH_SECONDS = float(os.environ.get('SUMMARY_FLUSH_SECONDS', 30))
+SUMMARY_FLUSH_SIZE = int(os.environ.get('SUMMARY_FLUSH_SIZE', 50))
+pending_summaries = []
+pending_lock = threading.Lock()
+flush_requested = threading.Event()
+
+
+def build_state():
+    """Load the published index version and build the chains over it"""
+    vector_db_path = index_versions.current()
     print(f"Looking for vector DB at: {vector_db_path}")
 
     if not os.path.exists(vector_db_path):
@@ -39,27 +69,141 @@ try:
         for item in os.listdir(vector_db_path):
             print(f"  - {item}")
 
-
     print("Attempting to load vector DB...")
-    db = load_vector_db(vector_db_path, "docs-financial-rag")
+    db = load_vector_db(vector_db_path, COLLECTION_NAME)
 
     if db is None:
         print("ERROR: Vector DB loaded as None")
     else:
         print("Vector DB loaded successfully!")
 
-    print("Creating summarization chain...")
-    summarization_chain = create_summarization_chain(db, "gpt-4o-mini")
-    qa_chain = create_rag_chain(db, "gpt-4o-mini")
-    print("Summarization chain created successfully!")
+    try:
+        print("Creating summarization chain...")
+        summarization_chain = create_summarization_chain(db, SUMMARY_MODEL)
+        qa_chain = create_rag_chain(db, SUMMARY_MODEL)
+        print("Summarization chain created successfully!")
+    except Exception:
+        if db is not None:
+            release_vector_db(vector_db_path, COLLECTION_NAME)
+        raise
+
+    return {'db': db, 'summarization_chain': summarization_chain, 'qa_chain': qa_chain,
+            'persist_directory': vector_db_path}
+
+
+def release_state(state):
+    """Release a swapped-out version once its last request has finished"""
+    if state['db'] is not None:
+        release_vector_db(state['persist_directory'], COLLECTION_NAME)
+
+
+def refresh_state():
+    """Switch to the published index version if it is not the one being served"""
+    version = index_versions.current_name() or 'unversioned'
+    with state_lock:
+        if serving.stats()['version'] == version:
+            return
+        try:
+            state = build_state()
+        except Exception as e:
+            print(f"ERROR during initialization: {e}")
+            import traceback
+            traceback.print_exc()
+            return
+        serving.swap(state, version, on_release=release_state)
+
+
+def cleanup_index_versions():
+    """Drop old index versions that no process serves any more"""
+    for removed in index_versions.cleanup(keep=KEEP_INDEX_VERSIONS):
+        registry.discard(removed)
+
+
+def queue_summary(document, replace_source=False, manifest_entry=None):
+    """Queue a summary for the next batch; a full batch is flushed right away"""
+    with pending_lock:
+        pending_summaries.append({'document': document, 'replace_source': replace_source,
+                                  'manifest_entry': manifest_entry})
+        full = len(pending_summaries) >= SUMMARY_FLUSH_SIZE
+    if full:
+        flush_requested.set()
+
+
+def pending_summary(source, content_hash):
+    """A queued summary of this source and content, if one is waiting to be written"""
+    with pending_lock:
+        for item in reversed(pending_summaries):
+            entry = item['manifest_entry']
+            if entry is not None and entry[0] == source and entry[1] == content_hash:
+                return item['document'].page_content
+    return None
+
+
+def flush_summaries():
+    """Write every queued summary into one new index version and serve it"""
+    with pending_lock:
+        batch = pending_summaries[:]
+        pending_summaries.clear()
+    if not batch:
+        return 0
+
+    added = [item['document'] for item in batch if not item['replace_source']]
+    # A source uploaded twice in one batch keeps only its latest summary
+    replaced = {item['document'].metadata['source']: item for item in batch if item['replace_source']}
+    try:
+        with index_versions.writer(copy_current=True) as version_path:
+            if added:
+                # These share one source, so add alongside the existing ones rather than replacing them
+                create_vector_db(added, version_path, COLLECTION_NAME, replace_sources=False)
+            if replaced:
+                produced = {}
+                create_vector_db([item['document'] for item in replaced.values()], version_path,
+                                 COLLECTION_NAME, chunk_ids=produced)
+                # The writer holds the publish lock, so no other thread or process
+                # loads, records and saves this manifest meanwhile
+                manifest = IngestManifest.load(version_path, COLLECTION_NAME)
+                for source, item in replaced.items():
+                    _, content_hash, params = item['manifest_entry']
+                    manifest.record(source, content_hash, params, produced.get(source, []))
+                manifest.save()
+    except Exception:
+        # Keep them for the next flush
+        with pending_lock:
+            pending_summaries[:0] = batch
+        raise
+
+    print(f"Wrote {len(batch)} queued summaries")
+    cleanup_index_versions()
+    refresh_state()
+    return len(batch)
+
+
+def flush_forever():
+    while True:
+        flush_requested.wait(timeout=SUMMARY_FLUSH_SECONDS)
+        flush_requested.clear()
+        try:
+            flush_summaries()
+        except Exception as e:
+            print(f"Error writing queued summaries: {e}")
+
+
+refresh_state()
+threading.Thread(target=flush_forever, name="summary-flush", daemon=True).start()
+# Queued summaries are written before the process exits
+atexit.register(flush_summaries)
+
+
+def request_filter(data):
+    """Metadata filter for a question scoped by document_id, source, title or date range"""
+    return build_filter(
+        document_id=data.get("document_id") or None,
+        source=data.get("source") or None,
+        title=data.get("title") or None,
+        date_from=data.get("date_from") or None,
+        date_to=data.get("date_to") or None,
+    )
 
-except Exception as e:
-    print(f"ERROR during initialization: {e}")
-    import traceback
-    traceback.print_exc()
-    print("Continuing with a simple API...")
-    db = None
-    summarization_chain = None
 
 @app.route('/summarize', methods=['POST'])
 def summarize():
@@ -68,38 +212,50 @@ def summarize():
     if not text:
         return jsonify({'error': 'No text provided'}), 400
 
-    if summarization_chain is None:
-        return jsonify({
-            'error': 'Summarization system not initialized properly',
-            'fallback_response': 'The summarization system encountered an initialization error. Please check the server logs.'
-        }), 500
+    refresh_state()
+    with serving.use() as state:
+        if state is None:
+            return jsonify({
+                'error': 'Summarization system not initialized properly',
+                'fallback_response': 'The summarization system encountered an initialization error. Please check the server logs.'
+            }), 500
 
-    try:
-        summary = summarization_chain.invoke({"text": text})
-        return jsonify({'summary': summary})
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        try:
+            summary = state['summarization_chain'].invoke({"text": text})
+            return jsonify({'summary': summary})
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
 
 
 @app.route('/ask', methods=['POST'])
 def ask():
     data = request.json
     question = data.get("question", "")
-    document_id = data.get("document_id", "")
 
     if not question:
         return jsonify({'error': 'No question provided'}), 400
 
-    if qa_chain is None:
-        return jsonify({
-            'error': 'QA system not initialized properly',
-            'fallback_response': 'The QA system encountered an initialization error. Please check the server logs.'
-        }), 500
-
+    try:
+        metadata_filter = request_filter(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    refresh_state()
+    with serving.use() as state:
+        if state is None:
+            return jsonify({
+                'error': 'QA system not initialized properly',
+                'fallback_response': 'The QA system encountered an initialization error. Please check the server logs.'
+            }), 500
+        return answer_question(state['qa_chain'], question, metadata_filter)
+
+
+def answer_question(qa_chain, question, metadata_filter):
+    """Answer one /ask question with the chain of the version being served"""
     try:
         print(f"Asked question: {question}")
 
-        response = qa_chain.invoke({"question": question})
+        response = qa_chain.invoke({"question": question, "filter": metadata_filter})
 
         # If response is not a string, extract the answer
         if isinstance(response, dict):
@@ -117,6 +273,37 @@ def ask():
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/ask/stream', methods=['POST'])
+def ask_stream():
+    data = request.json
+    question = data.get("question", "")
+
+    if not question:
+        return jsonify({'error': 'No question provided'}), 400
+
+    try:
+        metadata_filter = request_filter(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    refresh_state()
+    entry = serving.acquire()
+    if entry is None:
+        return jsonify({
+            'error': 'QA system not initialized properly',
+            'fallback_response': 'The QA system encountered an initialization error. Please check the server logs.'
+        }), 500
+
+    print(f"Streaming question: {question}")
+    qa_chain = entry['value']['qa_chain']
+    response = Response(stream_with_context(sse_stream(stream_question(qa_chain, question, metadata_filter))),
+                        mimetype='text/event-stream',
+                        headers=SSE_HEADERS)
+    # The index version is held until the stream is closed
+    response.call_on_close(lambda: serving.release(entry))
+    return response
+
+
 @app.route('/add_summarized_doc', methods=['POST'])
 def add_summarized_doc():
     data = request.json
@@ -125,17 +312,13 @@ def add_summarized_doc():
     if not text or not summary:
         return jsonify({'error': 'Text and summary are required'}), 400
 
-    if db is None:
-        return jsonify({'error': 'Vector DB not initialized'}), 500
-
     try:
         summarized_doc = Document(
             page_content=summary,
             metadata={'title': 'Summarized Document', 'source': 'summarization', 'date': str(datetime.date.today())}
         )
-        processed_docs = process_documents([summarized_doc])
-        create_vector_db(processed_docs, vector_db_path, "docs-financial-rag")
-        return jsonify({'message': 'Summarized document added to vector DB successfully'})
+        queue_summary(add_metadata([summarized_doc])[0])
+        return jsonify({'message': 'Summarized document queued, it is added to the vector DB with the next batch'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -149,42 +332,72 @@ def upload_and_summarize():
 
     if file:
         filename = secure_filename(file.filename)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        # A directory per request so concurrent uploads of the same name never overwrite each other;
+        # the summary's source is the file name, not this path
+        upload_dir = tempfile.mkdtemp(dir=app.config['UPLOAD_FOLDER'])
+        file_path = os.path.join(upload_dir, filename)
         file.save(file_path)
         print(f"Saved uploaded file to: {file_path}")
 
         try:
-            # Process the uploaded document
-            processed_docs = process_documents([file_path])
-            if not processed_docs:
-                return jsonify({'error': 'Failed to process document'}), 500
-
-            # Combine all chunks into a single text for summarization
-            full_text = " ".join(doc.page_content for doc in processed_docs)
-            summary = summarization_chain.invoke({"text": full_text})
+            # An unchanged re-upload gets its stored summary back without re-summarizing
+            source = f'summarization:{filename}'
+            content_hash = file_hash(file_path)
+            manifest_params = {'summary_model': SUMMARY_MODEL}
+            refresh_state()
+            with serving.use() as state:
+                if state is None or state['db'] is None:
+                    return jsonify({'error': 'Summarization system not initialized properly'}), 500
+                manifest = IngestManifest.load(state['persist_directory'], COLLECTION_NAME)
+                if manifest.is_current(source, content_hash, manifest_params):
+                    stored = state['db']._collection.get(ids=manifest.entry(source)['chunk_ids'],
+                                                         include=['documents'])
+                    if stored['documents']:
+                        print(f"{filename} unchanged since it was summarized, returning the stored summary")
+                        return jsonify({'summary': stored['documents'][0],
+                                        'message': 'File unchanged, returning the stored summary'})
+                queued = pending_summary(source, content_hash)
+                if queued is not None:
+                    return jsonify({'summary': queued, 'message': 'File unchanged, returning the queued summary'})
+
+                # Process the uploaded document
+                processed_docs = process_documents([file_path])
+                if not processed_docs:
+                    return jsonify({'error': 'Failed to process document'}), 500
+
+                # Combine all chunks into a single text for summarization
+                full_text = " ".join(doc.page_content for doc in processed_docs)
+                summary = state['summarization_chain'].invoke({"text": full_text})
 
             # add summary to vector DB
             summarized_doc = Document(
                 page_content=summary,
-                metadata={'title': f'Summary of {filename}', 'source': 'summarization', 'date': str(datetime.date.today())}
+                metadata={'title': f'Summary of {filename}', 'source': source,
+                          'document_id': filename, 'date': str(datetime.date.today()),
+                          'date_int': int(datetime.date.today().strftime('%Y%m%d'))}
             )
-            create_vector_db([summarized_doc], vector_db_path, "docs-financial-rag")
-            return jsonify({'summary': summary, 'message': 'File processed and summary generated'})
+            # Re-uploading a changed file replaces its previous summary
+            queue_summary(summarized_doc, replace_source=True,
+                          manifest_entry=(source, content_hash, manifest_params))
+            return jsonify({'summary': summary,
+                            'message': 'File processed and summary generated, it is added to the vector DB with the next batch'})
         except Exception as e:
             return jsonify({'error': str(e)}), 500
         finally:
             # Clean up uploaded file
-            if os.path.exists(file_path):
-                os.remove(file_path)
-                print(f"Removed temporary file: {file_path}")
+            shutil.rmtree(upload_dir, ignore_errors=True)
+            print(f"Removed temporary file: {file_path}")
 
 @app.route('/health', methods=['GET'])
 def health_check():
-    status = {
-        'status': 'up',
-        'summarization_initialized': summarization_chain is not None,
-        'db_loaded': db is not None
-    }
+    with serving.use() as state:
+        status = {
+            'status': 'up',
+            'summarization_initialized': state is not None and state['summarization_chain'] is not None,
+            'db_loaded': state is not None and state['db'] is not None,
+            'index_version': serving.stats(),
+            'queued_summaries': len(pending_summaries)
+        }
     return jsonify(status)
 
 if __name__ == '__main__':
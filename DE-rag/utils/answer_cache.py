@@ -0,0 +1,218 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from utils.query_router import detect_tickers
+from utils.rag_chain import normalize_query
+
+_YEAR = re.compile(r"\b(?:FY\s?)?((?:19|20)\d{2})\b", re.IGNORECASE)
+_QUARTER = re.compile(r"\b(?:Q([1-4])|([1-4])Q|(first|second|third|fourth|1st|2nd|3rd|4th) quarter)\b", re.IGNORECASE)
+_QUARTER_WORDS = {"first": "1", "second": "2", "third": "3", "fourth": "4",
+                  "1st": "1", "2nd": "2", "3rd": "3", "4th": "4"}
+_NAME = re.compile(r"\b[A-Z][a-z]+(?:\s+[A-Z][a-z]+)*")
+
+# Capitalised only because they start a sentence
+NOT_NAMES = {
+    "what", "whats", "how", "who", "when", "where", "why", "which", "is", "are", "was", "were",
+    "do", "does", "did", "can", "could", "should", "would", "will", "tell", "give", "show",
+    "list", "summarize", "summarise", "compare", "explain", "describe", "please", "the", "a",
+    "an", "in", "for", "of", "on", "and", "find", "get", "according", "based", "me", "i",
+}
+
+
+def question_scope(question: str) -> str:
+    """
+    What a question is about, as a key two questions must share before their
+    answers can be interchanged: tickers, capitalised names, years and
+    quarters. "Apple revenue 2023" and "Apple revenue 2024" embed almost
+    identically but have different scopes.
+    """
+    terms = {f"${ticker}" for ticker in detect_tickers(question)}
+    for name in _NAME.findall(question):
+        words = name.lower().split()
+        while words and words[0] in NOT_NAMES:
+            words.pop(0)
+        if words:
+            terms.add(" ".join(words))
+    terms.update(f"y{year}" for year in _YEAR.findall(question))
+    for number, number_first, word in _QUARTER.findall(question):
+        terms.add("q" + (number or number_first or _QUARTER_WORDS[word.lower()]))
+    return "|".join(sorted(terms))
+
+
+class SemanticAnswerCache:
+    """
+    Answer cache keyed by question meaning rather than exact text.
+
+    Questions are embedded with the same model as the vector store. A lookup
+    returns the stored answer of the nearest cached question when both ask
+    about the same tickers, names, years and quarters (see question_scope),
+    its cosine similarity is above the threshold and the answer is inside the
+    freshness window. Vectors live in a fixed-size matrix; the least recently used entry
+    is evicted when it is full. Exact repeats are answered without embedding.
+    """
+
+    def __init__(self,
+                 embeddings: Any,
+                 threshold: float = 0.92,
+                 ttl: float = 300.0,
+                 max_entries: int = 1000):
+        self._embeddings = embeddings
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        self._lock = threading.Lock()
+        self._vectors: Optional[np.ndarray] = None
+        self._stored_at = np.zeros(max_entries)
+        self._scopes = np.full(max_entries, "", dtype=object)
+        self._occupied = np.zeros(max_entries, dtype=bool)
+        self._entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._exact: Dict[str, int] = {}
+        self._free: List[int] = list(range(max_entries - 1, -1, -1))
+        self._counters = {"hits": 0, "exact_hits": 0, "misses": 0, "evictions": 0, "errors": 0}
+
+    def _embed(self, question: str) -> np.ndarray:
+        vector = np.asarray(self._embeddings.embed_query(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _embed_many(self, questions: List[str]) -> np.ndarray:
+        vectors = np.asarray(self._embeddings.embed_documents(questions), dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1.0)
+
+    def _hit(self, slot: int, similarity: float, now: float, counter: str) -> Dict[str, Any]:
+        self._entries.move_to_end(slot)
+        self._counters[counter] += 1
+        return {
+            "hit": True,
+            "answer": self._entries[slot]["answer"],
+            "similarity": round(similarity, 4),
+            "age_seconds": round(now - self._stored_at[slot], 1),
+            "embedding": None,
+        }
+
+    def lookup(self, question: str) -> Dict[str, Any]:
+        """
+        Look up a question. Returns a dict with "hit" and, on a hit, the cached
+        "answer", its "similarity" and "age_seconds". On a miss the question
+        "embedding" is returned so store() does not have to embed it again.
+        """
+        now = time.time()
+        key = normalize_query(question)
+
+        with self._lock:
+            slot = self._exact.get(key)
+            if slot is not None and now - self._stored_at[slot] <= self.ttl:
+                return self._hit(slot, 1.0, now, "exact_hits")
+
+        try:
+            vector = self._embed(question)
+        except Exception as e:
+            print(f"Answer cache embedding error: {str(e)}")
+            with self._lock:
+                self._counters["errors"] += 1
+                self._counters["misses"] += 1
+            return {"hit": False, "embedding": None}
+
+        scope = question_scope(question)
+        with self._lock:
+            return self._nearest(vector, scope, now)
+
+    def _nearest(self, vector: np.ndarray, scope: str, now: float) -> Dict[str, Any]:
+        # Caller holds the lock
+        if self._vectors is not None and self._entries:
+            fresh = self._occupied & (now - self._stored_at <= self.ttl) & (self._scopes == scope)
+            if fresh.any():
+                similarities = np.where(fresh, self._vectors @ vector, -np.inf)
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    return self._hit(best, float(similarities[best]), now, "hits")
+
+        self._counters["misses"] += 1
+        return {"hit": False, "embedding": vector}
+
+    def lookup_many(self, questions: List[str]) -> List[Dict[str, Any]]:
+        """
+        lookup() for many questions, in order. Exact repeats are answered first
+        and the rest are embedded together with one embed_documents call.
+        """
+        now = time.time()
+        results: List[Optional[Dict[str, Any]]] = [None] * len(questions)
+        pending = []
+        with self._lock:
+            for index, question in enumerate(questions):
+                slot = self._exact.get(normalize_query(question))
+                if slot is not None and now - self._stored_at[slot] <= self.ttl:
+                    results[index] = self._hit(slot, 1.0, now, "exact_hits")
+                else:
+                    pending.append(index)
+        if not pending:
+            return results
+
+        try:
+            vectors = self._embed_many([questions[index] for index in pending])
+        except Exception as e:
+            print(f"Answer cache embedding error: {str(e)}")
+            with self._lock:
+                self._counters["errors"] += 1
+                self._counters["misses"] += len(pending)
+            for index in pending:
+                results[index] = {"hit": False, "embedding": None}
+            return results
+
+        scopes = [question_scope(questions[index]) for index in pending]
+        with self._lock:
+            for index, vector, scope in zip(pending, vectors, scopes):
+                results[index] = self._nearest(vector, scope, now)
+        return results
+
+    def store(self, question: str, answer: str, embedding: Optional[np.ndarray] = None) -> None:
+        """
+        Cache an answer, evicting the least recently used entry if the index is full.
+        """
+        try:
+            vector = embedding if embedding is not None else self._embed(question)
+        except Exception as e:
+            print(f"Answer cache embedding error: {str(e)}")
+            return
+
+        key = normalize_query(question)
+        with self._lock:
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+
+            slot = self._exact.get(key)
+            if slot is None:
+                if not self._free:
+                    evicted, entry = self._entries.popitem(last=False)
+                    self._exact.pop(entry["key"], None)
+                    self._occupied[evicted] = False
+                    self._free.append(evicted)
+                    self._counters["evictions"] += 1
+                slot = self._free.pop()
+
+            self._vectors[slot] = vector
+            self._stored_at[slot] = time.time()
+            self._scopes[slot] = question_scope(question)
+            self._occupied[slot] = True
+            self._entries[slot] = {"key": key, "answer": answer}
+            self._entries.move_to_end(slot)
+            self._exact[key] = slot
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return hit/miss counters and the current index size.
+        """
+        with self._lock:
+            lookups = sum(self._counters[k] for k in ("hits", "exact_hits", "misses"))
+            hits = self._counters["hits"] + self._counters["exact_hits"]
+            return dict(self._counters,
+                        entries=len(self._entries),
+                        max_entries=self.max_entries,
+                        hit_rate=round(hits / lookups, 4) if lookups else 0.0)
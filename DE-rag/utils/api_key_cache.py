@@ -0,0 +1,136 @@
+import asyncio
+import hashlib
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Any
+
+
+class ApiKeyCache:
+    """
+    Thread-safe cache of API key validity with a TTL.
+
+    A key is validated once and the result is reused by every request and thread
+    until the TTL expires or a real endpoint reports an auth-type failure for it.
+    Concurrent callers for the same key share a single validation request.
+    """
+
+    def __init__(self,
+                 validator: Callable[[str], bool],
+                 ttl: float = 3600.0,
+                 invalid_ttl: float = 60.0):
+        self._validator = validator
+        self._ttl = ttl
+        self._invalid_ttl = invalid_ttl
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._key_locks: Dict[str, threading.Lock] = {}
+        self._pending: Dict[str, "asyncio.Future"] = {}
+        self._lock = threading.Lock()
+        self._counters = {
+            "hits": 0,
+            "validations": 0,
+            "revalidations": 0,
+            "auth_failures": 0,
+        }
+
+    @staticmethod
+    def _fingerprint(api_key: str) -> str:
+        # Keys are never held in memory in the clear
+        return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+    def _fresh_entry(self, fingerprint: str):
+        entry = self._entries.get(fingerprint)
+        if entry and not entry["stale"] and entry["expires_at"] > time.monotonic():
+            return entry
+        return None
+
+    def is_valid(self, api_key: str) -> bool:
+        """
+        Return the cached validity of the key, validating it only when needed.
+        """
+        if not api_key:
+            return False
+
+        fingerprint = self._fingerprint(api_key)
+        with self._lock:
+            entry = self._fresh_entry(fingerprint)
+            if entry:
+                self._counters["hits"] += 1
+                return entry["valid"]
+            key_lock = self._key_locks.setdefault(fingerprint, threading.Lock())
+
+        with key_lock:
+            # Another thread may have validated while we waited
+            with self._lock:
+                entry = self._fresh_entry(fingerprint)
+                if entry:
+                    self._counters["hits"] += 1
+                    return entry["valid"]
+                is_revalidation = fingerprint in self._entries
+
+            valid = bool(self._validator(api_key))
+            self._store(fingerprint, valid, is_revalidation)
+
+        return valid
+
+    def _store(self, fingerprint: str, valid: bool, is_revalidation: bool) -> None:
+        ttl = self._ttl if valid else self._invalid_ttl
+        with self._lock:
+            self._entries[fingerprint] = {
+                "valid": valid,
+                "stale": False,
+                "expires_at": time.monotonic() + ttl,
+            }
+            self._counters["revalidations" if is_revalidation else "validations"] += 1
+
+    async def ais_valid(self, api_key: str, validator: Callable[[str], Awaitable[bool]]) -> bool:
+        """
+        Async variant of is_valid for the ASGI path, using an async validator.
+        Concurrent callers for the same key await one shared validation.
+        """
+        if not api_key:
+            return False
+
+        fingerprint = self._fingerprint(api_key)
+        with self._lock:
+            entry = self._fresh_entry(fingerprint)
+            if entry:
+                self._counters["hits"] += 1
+                return entry["valid"]
+            pending = self._pending.get(fingerprint)
+            owner = pending is None
+            if owner:
+                is_revalidation = fingerprint in self._entries
+                pending = asyncio.ensure_future(validator(api_key))
+                self._pending[fingerprint] = pending
+
+        try:
+            valid = bool(await asyncio.shield(pending))
+        finally:
+            if owner:
+                with self._lock:
+                    self._pending.pop(fingerprint, None)
+
+        if owner:
+            self._store(fingerprint, valid, is_revalidation)
+        return valid
+
+    def report_auth_failure(self, api_key: str) -> None:
+        """
+        Mark the key for re-validation after an endpoint rejected it.
+        """
+        if not api_key:
+            return
+
+        fingerprint = self._fingerprint(api_key)
+        with self._lock:
+            self._counters["auth_failures"] += 1
+            entry = self._entries.get(fingerprint)
+            if entry:
+                entry["stale"] = True
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Return a snapshot of the hit and validation counters.
+        """
+        with self._lock:
+            return dict(self._counters, cached_keys=len(self._entries))
@@ -0,0 +1,252 @@
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterable, Iterator, List, Tuple, TypeVar
+
+from utils.http_client import HttpClient, retry_delay
+
+T = TypeVar("T")
+
+OLLAMA_BASE_URL = os.environ.get('OLLAMA_BASE_URL', "http://localhost:11434")
+
+
+def batched(texts: Iterable[str], batch_size: int) -> Iterator[List[str]]:
+    """
+    Group texts into lists of at most batch_size.
+    """
+    batch: List[str] = []
+    for text in texts:
+        batch.append(text)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def prefetched(items: Iterable[T], depth: int = 2) -> Iterator[T]:
+    """
+    Produce items on a background thread, at most depth ahead of the consumer,
+    so the producer (e.g. parsing) overlaps with the consumer (e.g. embedding).
+    Exceptions raised by the producer are re-raised in the consumer.
+    """
+    buffer: "queue.Queue[Tuple[str, Any]]" = queue.Queue(maxsize=max(1, depth))
+    stop = threading.Event()
+
+    def put(entry: Tuple[str, Any]) -> bool:
+        while not stop.is_set():
+            try:
+                buffer.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce() -> None:
+        try:
+            for item in items:
+                if not put(("item", item)):
+                    break
+            else:
+                put(("done", None))
+        except BaseException as e:
+            put(("error", e))
+        finally:
+            # Close a generator producer so pools and files it holds are released
+            close = getattr(items, "close", None)
+            if close is not None:
+                close()
+
+    thread = threading.Thread(target=produce, name="prefetch", daemon=True)
+    thread.start()
+    try:
+        while True:
+            kind, value = buffer.get()
+            if kind == "done":
+                return
+            if kind == "error":
+                raise value
+            yield value
+    finally:
+        # Consumer stopped early (error or break): let the producer exit
+        stop.set()
+
+
+class OllamaBatchEmbeddings:
+    """
+    Ingestion embeddings that send batches of chunks to Ollama's /api/embed
+    endpoint (Ollama 0.3.4+), with several batches in flight at once.
+
+    At most max_in_flight batches are outstanding; the producer is not asked
+    for more texts until one completes, which keeps memory bounded when the
+    input is a stream. A failed batch is retried with backoff before the run
+    fails. Per-batch throughput is logged.
+    """
+
+    def __init__(self,
+                 model: str = "nomic-embed-text",
+                 base_url: str = OLLAMA_BASE_URL,
+                 batch_size: int = 64,
+                 max_in_flight: int = 4,
+                 max_retries: int = 3,
+                 backoff: float = 0.5,
+                 timeout: float = 120.0,
+                 verbose: bool = True):
+        self.model = model
+        self.url = f"{base_url.rstrip('/')}/api/embed"
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.verbose = verbose
+        self._http = HttpClient(pool_size=max_in_flight, max_retries=0, timeout=timeout)
+        self._lock = threading.Lock()
+        self._counters = {"batches": 0, "chunks": 0, "retries": 0, "failures": 0, "seconds": 0.0}
+
+    def _embed_batch(self, index: int, texts: List[str]) -> List[List[float]]:
+        for attempt in range(self.max_retries + 1):
+            started = time.monotonic()
+            try:
+                response = self._http.request("POST", self.url, json={"model": self.model, "input": texts})
+                response.raise_for_status()
+                vectors = response.json()["embeddings"]
+                if len(vectors) != len(texts):
+                    raise ValueError(f"expected {len(texts)} embeddings, got {len(vectors)}")
+            except Exception as e:
+                with self._lock:
+                    self._counters["failures" if attempt >= self.max_retries else "retries"] += 1
+                if attempt >= self.max_retries:
+                    raise
+                print(f"Embedding batch {index} failed ({str(e)}), retrying")
+                time.sleep(retry_delay(attempt, self.backoff, 8.0))
+                continue
+
+            elapsed = time.monotonic() - started
+            with self._lock:
+                self._counters["batches"] += 1
+                self._counters["chunks"] += len(texts)
+                self._counters["seconds"] += elapsed
+            if self.verbose:
+                print(f"Embedding batch {index}: {len(texts)} chunks in {elapsed:.2f}s "
+                      f"({len(texts) / max(elapsed, 1e-6):.0f} chunks/s)")
+            return vectors
+
+    def iter_embeddings(self, texts: Iterable[str]) -> Iterator[Tuple[List[str], List[List[float]]]]:
+        """
+        Embed a stream of texts, yielding (batch texts, vectors) in input order.
+        """
+        batches = enumerate(batched(texts, self.batch_size))
+        pending: Dict[int, Any] = {}
+        done: Dict[int, Tuple[List[str], List[List[float]]]] = {}
+        next_index = 0
+        exhausted = False
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="embed") as executor:
+            while True:
+                # Only pull more input while there is room in the in-flight window
+                while not exhausted and len(pending) + len(done) < self.max_in_flight:
+                    item = next(batches, None)
+                    if item is None:
+                        exhausted = True
+                        break
+                    index, batch = item
+                    pending[index] = (batch, executor.submit(self._embed_batch, index, batch))
+
+                if not pending and not done:
+                    return
+
+                if next_index not in done:
+                    finished, _ = wait([future for _, future in pending.values()], return_when=FIRST_COMPLETED)
+                    for index in [i for i, (_, future) in pending.items() if future in finished]:
+                        batch, future = pending.pop(index)
+                        done[index] = (batch, future.result())
+
+                while next_index in done:
+                    yield done.pop(next_index)
+                    next_index += 1
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors: List[List[float]] = []
+        for _, batch_vectors in self.iter_embeddings(texts):
+            vectors.extend(batch_vectors)
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed_batch(0, [text])[0]
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return batch, retry and failure counters and the overall throughput.
+        """
+        with self._lock:
+            seconds = self._counters["seconds"]
+            return dict(self._counters,
+                        seconds=round(seconds, 3),
+                        chunks_per_second=round(self._counters["chunks"] / seconds, 1) if seconds else 0.0)
+
+
+def start_fake_embedding_server(latency: float = 0.05, per_text: float = 0.002,
+                                dimensions: int = 768) -> ThreadingHTTPServer:
+    """
+    Start a local stand-in for Ollama's /api/embed that sleeps latency plus
+    per_text seconds for each text in a request. Returns the running server.
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+            time.sleep(latency + per_text * len(texts))
+            payload = json.dumps({"embeddings": [[float(len(t) % 7)] * dimensions for t in texts]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def benchmark(base_url: str, chunks: int, batch_sizes: List[int], in_flight: List[int]) -> None:
+    """
+    Print embedding throughput for each batch size / in-flight combination.
+    """
+    texts = [f"chunk {i} " + "revenue guidance " * 40 for i in range(chunks)]
+    print(f"{'batch':>6} {'in-flight':>10} {'seconds':>8} {'chunks/s':>9}")
+    for batch_size in batch_sizes:
+        for max_in_flight in in_flight:
+            embeddings = OllamaBatchEmbeddings(base_url=base_url, batch_size=batch_size,
+                                               max_in_flight=max_in_flight, verbose=False)
+            started = time.monotonic()
+            embeddings.embed_documents(texts)
+            elapsed = time.monotonic() - started
+            print(f"{batch_size:>6} {max_in_flight:>10} {elapsed:>8.2f} {chunks / elapsed:>9.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark batched Ollama embedding throughput "
+                                                 "(run as: python -m utils.batch_embeddings)")
+    parser.add_argument("--base-url", default=None, help="Ollama URL; a fake local server is used if omitted")
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--batch-sizes", default="1,16,64")
+    parser.add_argument("--in-flight", default="1,4,8")
+    args = parser.parse_args()
+
+    server = None
+    if args.base_url is None:
+        server = start_fake_embedding_server()
+        args.base_url = f"http://127.0.0.1:{server.server_port}"
+    benchmark(args.base_url, args.chunks,
+              [int(x) for x in args.batch_sizes.split(",")],
+              [int(x) for x in args.in_flight.split(",")])
+    if server:
+        server.shutdown()
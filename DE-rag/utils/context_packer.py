@@ -0,0 +1,101 @@
+from typing import Any, Dict, List, Tuple
+
+# Exact token counts when tiktoken is installed, otherwise a ~4 chars/token estimate
+try:
+    import tiktoken
+
+    _encoding = tiktoken.get_encoding("cl100k_base")
+    TIKTOKEN_AVAILABLE = True
+except Exception:
+    _encoding = None
+    TIKTOKEN_AVAILABLE = False
+
+
+def count_tokens(text: str) -> int:
+    """
+    Count prompt tokens for a piece of text.
+    """
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return max(1, len(text) // 4)
+
+
+def _overlap(left: str, right: str, max_overlap: int, min_overlap: int) -> int:
+    """
+    Length of the longest suffix of left that is also a prefix of right.
+    """
+    for size in range(min(max_overlap, len(left), len(right)), min_overlap - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def remove_overlap(selected: List[str], text: str,
+                   max_overlap: int = 400, min_overlap: int = 40) -> str:
+    """
+    Trim the parts of text that repeat chunks already selected for the prompt.
+
+    Neighbouring chunks from the splitter share up to chunk_overlap characters at
+    their boundaries, so a chunk's head can repeat the tail of an earlier chunk
+    and its tail can repeat an earlier chunk's head. Chunks fully contained in
+    an earlier one are dropped.
+    """
+    for previous in selected:
+        if text in previous:
+            return ""
+        head = _overlap(previous, text, max_overlap, min_overlap)
+        if head:
+            text = text[head:]
+        tail = _overlap(text, previous, max_overlap, min_overlap)
+        if tail:
+            text = text[:-tail]
+    return text.strip()
+
+
+def pack_context(docs: List[Any], token_budget: int = 2000, separator: str = "\n") -> Tuple[str, Dict[str, int]]:
+    """
+    Pack retrieved chunks into prompt context under a token budget.
+
+    Chunks are taken in relevance (retrieval) order, with overlapping spans
+    removed; a chunk that no longer fits the budget is skipped so a smaller,
+    less relevant one can still be used. Returns the context and a report of
+    what was removed and how many tokens were saved.
+    """
+    texts = [str(doc.page_content) if hasattr(doc, 'page_content') else str(doc) for doc in docs]
+    tokens_raw = count_tokens(separator.join(texts))
+
+    selected: List[str] = []
+    used_tokens = 0
+    duplicates = 0
+    overlap_chars = 0
+    over_budget = 0
+
+    for text in texts:
+        trimmed = remove_overlap(selected, text)
+        if not trimmed:
+            duplicates += 1
+            continue
+        overlap_chars += len(text.strip()) - len(trimmed)
+
+        tokens = count_tokens(trimmed)
+        if used_tokens + tokens > token_budget:
+            over_budget += 1
+            continue
+        selected.append(trimmed)
+        used_tokens += tokens
+
+    context = separator.join(selected)
+    tokens_packed = count_tokens(context)
+    return context, {
+        "chunks_retrieved": len(texts),
+        "chunks_used": len(selected),
+        "duplicates_removed": duplicates,
+        "overlap_chars_removed": overlap_chars,
+        "chunks_over_budget": over_budget,
+        "token_budget": token_budget,
+        "tokens_raw": tokens_raw,
+        "tokens_packed": tokens_packed,
+        "tokens_saved": max(0, tokens_raw - tokens_packed),
+    }
@@ -1,93 +1,338 @@
 import os
+import time
 import datetime
-from typing import List, Dict, Any
+import hashlib
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Dict, Any, Deque, Iterable, Iterator, Optional, Tuple
 from langchain_community.document_loaders import PDFPlumberLoader
 from langchain_community.document_loaders import TextLoader
 from langchain_community.document_loaders import JSONLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema import Document
+from utils.metadata_filter import document_id_for, date_int
 
+# Processes used to parse files; 1 parses in-process, one file after another
+DOCUMENT_WORKERS = int(os.environ.get('DOCUMENT_WORKERS', 1))
 
-def load_documents(file_paths: List[str]) -> List[Document]:
+# Parser processes never fork from the (multithreaded) server: a forked child would
+# inherit locks held by other threads at that moment and could hang on them
+PARSER_START_METHOD = os.environ.get(
+    'PARSER_START_METHOD',
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+)
+
+# Builds a Document without validation, which would copy the metadata dict per chunk
+_build_document = getattr(Document, 'model_construct', None) or getattr(Document, 'construct', Document)
+
+
+def chunk_id(doc: Document) -> str:
     """
-    Load documents from multiple file paths.
-    Supports PDF, TXT, and JSON files.
+    Deterministic ID for a chunk, derived from its source and content, so
+    re-ingesting the same file maps to the same vector store entries.
+    """
+    source = str((doc.metadata or {}).get('source', ''))
+    return hashlib.sha256(f"{source}\x00{doc.page_content}".encode("utf-8")).hexdigest()
+
+
+def load_file(file_path: str) -> Tuple[List[Document], Dict[str, Any]]:
+    """
+    Load the raw pages of one PDF, TXT or JSON file, unsplit; chunking
+    happens once, in split_pages. Runs in a worker process in parallel mode,
+    so it never raises: a failure is reported in the returned timing entry.
 
     Args:
-        file_paths: List of file paths
+        file_path: Path of the file to load
 
     Returns:
-        List of loaded documents
+        Tuple of (loaded pages, timing entry for the load report)
     """
-    all_docs = []
+    started = time.perf_counter()
+    report = {'file': os.path.basename(file_path), 'documents': 0, 'seconds': 0.0,
+              'worker': os.getpid(), 'error': None}
+    file_extension = os.path.splitext(file_path)[1].lower()
+    docs: List[Document] = []
 
-    for file_path in file_paths:
-        print(f"Processing file: {os.path.basename(file_path)}")
+    try:
+        if file_extension == '.pdf':
+            loader = PDFPlumberLoader(file_path=file_path)
+            docs = loader.load()
 
-        file_extension = os.path.splitext(file_path)[1].lower()
+        elif file_extension == '.txt':
+            loader = TextLoader(file_path=file_path)
+            docs = loader.load()
 
-        try:
-            if file_extension == '.pdf':
-                loader = PDFPlumberLoader(file_path=file_path)
-                docs = loader.load_and_split()
-
-            elif file_extension == '.txt':
-                loader = TextLoader(file_path=file_path)
-                docs = loader.load_and_split()
-
-            elif file_extension == '.json':
-                # For JSON files, you might need to specify the jq parameter
-                # to extract the right fields depending on your JSON structure
-                loader = JSONLoader(
-                    file_path=file_path,
-                    jq='.',  # Extract everything
-                    text_content=False
-                )
-                docs = loader.load_and_split()
-
-            else:
-                print(f"Unsupported file format: {file_extension}")
-                continue
-
-            all_docs.extend(docs)
-            print(f"Loaded {len(docs)} document chunks from {os.path.basename(file_path)}")
+        elif file_extension == '.json':
+            # For JSON files, you might need to specify the jq parameter
+            # to extract the right fields depending on your JSON structure
+            loader = JSONLoader(
+                file_path=file_path,
+                jq='.',  # Extract everything
+                text_content=False
+            )
+            docs = loader.load()
+
+        else:
+            report['error'] = f"Unsupported file format: {file_extension}"
+
+    except Exception as e:
+        report['error'] = f"Error loading file {file_path}: {str(e)}"
 
+    report['documents'] = len(docs)
+    report['seconds'] = time.perf_counter() - started
+    return docs, report
+
+
+def _failed_load(file_path: str, error: Exception) -> Tuple[List[Document], Dict[str, Any]]:
+    # The worker itself died (e.g. out of memory on a malformed PDF)
+    return [], {'file': os.path.basename(file_path), 'documents': 0, 'seconds': 0.0,
+                'worker': None, 'error': f"Error loading file {file_path}: {str(error)}"}
+
+
+def _parser_pool(workers: int) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(PARSER_START_METHOD))
+
+
+def iter_loaded_files(file_paths: List[str],
+                      workers: Optional[int] = None) -> Iterator[Tuple[List[Document], Dict[str, Any]]]:
+    """
+    Load files one by one, yielding (documents, timing entry) per file in the
+    order of file_paths. With workers > 1 files are parsed in a process pool
+    that runs at most two files per worker ahead of the consumer, so parsed
+    pages do not pile up in memory while later stages catch up. If a parser
+    process dies the pool is rebuilt and only the file that killed it is
+    reported as failed.
+
+    Args:
+        file_paths: List of file paths
+        workers: Number of parser processes (defaults to DOCUMENT_WORKERS)
+
+    Yields:
+        Tuple of (loaded documents, timing entry) for each file
+    """
+    workers = DOCUMENT_WORKERS if workers is None else workers
+    workers = max(1, min(workers, len(file_paths)))
+
+    if workers == 1:
+        for file_path in file_paths:
+            print(f"Processing file: {os.path.basename(file_path)}")
+            yield load_file(file_path)
+        return
+
+    print(f"Processing {len(file_paths)} files with {workers} worker processes")
+    executor = _parser_pool(workers)
+    pending: Deque[Tuple[int, str]] = deque()
+    futures: Dict[int, Any] = {}
+    paths = enumerate(file_paths)
+    try:
+        while True:
+            while len(pending) < workers * 2:
+                queued = next(paths, None)
+                if queued is None:
+                    break
+                pending.append(queued)
+                futures[queued[0]] = _submit(executor, queued[1])
+            if not pending:
+                return
+            position, file_path = pending.popleft()
+            try:
+                result = futures.pop(position).result()
+            except BrokenProcessPool:
+                # A worker died (e.g. a parser crashed or ran out of memory) and took
+                # the whole pool with it. Retry this file alone so only the file that
+                # kills its worker is recorded as failed, then resubmit the rest.
+                executor.shutdown(wait=False, cancel_futures=True)
+                result = _load_isolated(file_path)
+                executor = _parser_pool(workers)
+                for position, queued_path in pending:
+                    futures[position] = _submit(executor, queued_path)
+            except Exception as e:
+                result = _failed_load(file_path, e)
+            yield result
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _submit(executor: ProcessPoolExecutor, file_path: str) -> Future:
+    # A pool broken by an earlier file refuses new work; hand the error to the
+    # consumer with this file's future instead of raising it mid-submit
+    try:
+        return executor.submit(load_file, file_path)
+    except BrokenProcessPool as e:
+        future: Future = Future()
+        future.set_exception(e)
+        return future
+
+
+def _load_isolated(file_path: str) -> Tuple[List[Document], Dict[str, Any]]:
+    """
+    Load one file in a process of its own, recording a failure if that
+    process dies too.
+    """
+    with _parser_pool(1) as executor:
+        try:
+            return executor.submit(load_file, file_path).result()
+        except BrokenProcessPool:
+            return _failed_load(file_path, RuntimeError("parser process died"))
         except Exception as e:
-            print(f"Error loading file {file_path}: {str(e)}")
+            return _failed_load(file_path, e)
 
-    return all_docs
 
+def iter_documents(file_paths: List[str],
+                   workers: Optional[int] = None,
+                   report: Optional[List[Dict[str, Any]]] = None) -> Iterator[List[Document]]:
+    """
+    Yield the loaded documents of each file in order, logging failures and
+    appending each file's timing entry to report when one is given.
+    """
+    for docs, entry in iter_loaded_files(file_paths, workers):
+        if entry['error']:
+            print(entry['error'])
+        else:
+            print(f"Loaded {len(docs)} pages from {entry['file']}")
+        if report is not None:
+            report.append(entry)
+        yield docs
+
+
+def load_documents_with_report(file_paths: List[str],
+                               workers: Optional[int] = None) -> Tuple[List[Document], List[Dict[str, Any]]]:
+    """
+    Load documents from multiple file paths, spreading files over a process
+    pool when workers > 1. Documents keep the order of file_paths whatever the
+    order workers finish in, and a file that fails to parse is skipped
+    without affecting the others.
 
-def chunk_documents(documents: List[Document],
-                    chunk_size: int = 1200,
-                    chunk_overlap: int = 300) -> List[Document]:
+    Args:
+        file_paths: List of file paths
+        workers: Number of parser processes (defaults to DOCUMENT_WORKERS)
+
+    Returns:
+        Tuple of (loaded documents, one timing entry per file)
     """
-    Split documents into smaller chunks for processing.
+    all_docs = []
+    report: List[Dict[str, Any]] = []
+    for docs in iter_documents(file_paths, workers, report):
+        all_docs.extend(docs)
+    return all_docs, report
+
+
+def format_load_report(report: List[Dict[str, Any]]) -> str:
+    """
+    Per-file parse timings, slowest first, for the end of an ingestion run.
+    """
+    lines = [f"{'seconds':>8} {'pages':>6}  file"]
+    for entry in sorted(report, key=lambda e: e['seconds'], reverse=True):
+        status = f"  ({entry['error']})" if entry['error'] else ""
+        lines.append(f"{entry['seconds']:>8.2f} {entry['documents']:>6}  {entry['file']}{status}")
+    failed = sum(1 for entry in report if entry['error'])
+    lines.append(f"{len(report)} files, {failed} failed, {sum(e['seconds'] for e in report):.2f}s of parsing")
+    return "\n".join(lines)
+
+
+def load_documents(file_paths: List[str], workers: Optional[int] = None) -> List[Document]:
+    """
+    Load documents from multiple file paths.
+    Supports PDF, TXT, and JSON files.
 
     Args:
-        documents: List of documents to chunk
-        chunk_size: Size of each chunk
-        chunk_overlap: Overlap between chunks
+        file_paths: List of file paths
+        workers: Number of parser processes (defaults to DOCUMENT_WORKERS)
 
     Returns:
-        List of chunked documents
+        List of loaded documents
+    """
+    started = time.perf_counter()
+    docs, report = load_documents_with_report(file_paths, workers)
+    print(format_load_report(report))
+    print(f"Loaded {len(file_paths)} files in {time.perf_counter() - started:.2f}s")
+    return docs
+
+
+def iter_chunks(documents: Iterable[Document],
+                chunk_size: int = 1200,
+                chunk_overlap: int = 300) -> Iterator[Document]:
+    """
+    Split a stream of documents into chunks, one document at a time.
     """
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=chunk_size,
         chunk_overlap=chunk_overlap
     )
 
-    chunked_docs = []
     for doc in documents:
         chunks = text_splitter.split_text(doc.page_content)
         for chunk in chunks:
             # Preserve the original metadata
-            chunked_docs.append(Document(
+            yield Document(
                 page_content=chunk,
                 metadata=doc.metadata
-            ))
+            )
+
+
+def chunk_documents(documents: List[Document],
+                    chunk_size: int = 1200,
+                    chunk_overlap: int = 300) -> List[Document]:
+    """
+    Split documents into smaller chunks for processing.
+
+    Chunks are not given copies of their document's metadata: every chunk of
+    a document holds that document's metadata dict, so it must be treated as
+    read-only. Copy it before changing one chunk's metadata.
+
+    Args:
+        documents: List of documents to chunk
+        chunk_size: Size of each chunk
+        chunk_overlap: Overlap between chunks
+
+    Returns:
+        List of chunked documents
+    """
+    return list(iter_chunks(documents, chunk_size, chunk_overlap))
+
+
+def tag_metadata(metadata: Optional[Dict[str, Any]],
+                 doc_title: str = "Financial-Documents") -> Dict[str, Any]:
+    """
+    Copy of metadata with the default title, author, date, document_id and
+    date_int filled in where missing.
+    """
+    # Start with existing metadata
+    metadata = dict(metadata) if metadata else {}
+
+    # Add default metadata if not present
+    if 'title' not in metadata:
+        metadata['title'] = doc_title
 
-    return chunked_docs
+    if 'author' not in metadata:
+        metadata['author'] = "Group-DE"
+
+    if 'date' not in metadata:
+        metadata['date'] = str(datetime.date.today())
+
+    # Document-level ID and sortable date used by metadata-filtered retrieval
+    if 'document_id' not in metadata:
+        metadata['document_id'] = document_id_for(str(metadata.get('source', doc_title)))
+
+    if 'date_int' not in metadata and date_int(metadata['date']) is not None:
+        metadata['date_int'] = date_int(metadata['date'])
+
+    return metadata
+
+
+def iter_with_metadata(documents: Iterable[Document],
+                       doc_title: str = "Financial-Documents") -> Iterator[Document]:
+    """
+    Add default metadata to a stream of documents, one document at a time.
+    """
+    for doc in documents:
+        # Create new document with updated metadata
+        yield Document(
+            page_content=doc.page_content,
+            metadata=tag_metadata(getattr(doc, 'metadata', None), doc_title)
+        )
 
 
 def add_metadata(documents: List[Document],
@@ -95,6 +340,10 @@ def add_metadata(documents: List[Document],
     """
     Add metadata to documents if not already present.
 
+    Each document gets its own tagged copy of its metadata, so this costs a
+    dict per chunk when given chunks; split_pages tags once per page instead,
+    and its chunks share the page's dict, which is then read-only.
+
     Args:
         documents: List of documents
         doc_title: Title to use for documents
@@ -102,35 +351,91 @@ def add_metadata(documents: List[Document],
     Returns:
         List of documents with metadata
     """
-    docs_with_metadata = []
+    return list(iter_with_metadata(documents, doc_title))
 
-    for doc in documents:
-        # Start with existing metadata
-        metadata = doc.metadata.copy() if hasattr(doc, 'metadata') and doc.metadata else {}
 
-        # Add default metadata if not present
-        if 'title' not in metadata:
-            metadata['title'] = doc_title
+def split_pages(pages: Iterable[Document],
+                chunk_size: int = 1200,
+                chunk_overlap: int = 300,
+                doc_title: str = "Financial-Documents") -> Iterator[Document]:
+    """
+    Single chunking stage: split raw page text once and tag metadata once per
+    page rather than once per chunk.
 
-        if 'author' not in metadata:
-            metadata['author'] = "Group-DE"
+    Every chunk of a page shares that page's metadata dict, which carries the
+    source, the page number from the loader and page_offset, the character
+    offset of the page within its source. The shared dicts must be treated
+    as read-only.
 
-        if 'date' not in metadata:
-            metadata['date'] = str(datetime.date.today())
+    Args:
+        pages: Raw pages from load_file, grouped by source
+        chunk_size: Size of each chunk
+        chunk_overlap: Overlap between chunks
+        doc_title: Title to use for documents
 
-        # Create new document with updated metadata
-        docs_with_metadata.append(Document(
-            page_content=doc.page_content,
-            metadata=metadata
-        ))
+    Yields:
+        Chunks with metadata, in page order
+    """
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap
+    )
+
+    source = None
+    offset = 0
+    for page in pages:
+        metadata = tag_metadata(page.metadata, doc_title)
+        if metadata.get('source') != source:
+            source, offset = metadata.get('source'), 0
+        metadata['page_offset'] = offset
+        offset += len(page.page_content)
+
+        for chunk in text_splitter.split_text(page.page_content):
+            yield _build_document(page_content=chunk, metadata=metadata)
+
+
+def iter_process_documents(file_paths: List[str],
+                           chunk_size: int = 1200,
+                           chunk_overlap: int = 300,
+                           doc_title: str = "Financial-Documents",
+                           workers: Optional[int] = None,
+                           report: Optional[List[Dict[str, Any]]] = None,
+                           sources: Optional[Dict[str, str]] = None) -> Iterator[Document]:
+    """
+    Streaming version of process_documents: load pages, then chunk and tag
+    them in one pass (split_pages), lazily, so only the file being processed
+    is held in memory and chunks reach the vector store while later files are
+    still being parsed. sources maps a file to the source its chunks are
+    stored under, e.g. a stable upload name for a file saved to a temp path.
+
+    Args:
+        file_paths: List of file paths to process
+        chunk_size: Size of each chunk for splitting
+        chunk_overlap: Overlap between chunks
+        doc_title: Title to use for documents
+        workers: Number of parser processes (defaults to DOCUMENT_WORKERS)
+        report: Optional list that receives each file's timing entry
+        sources: Optional source name per file path
 
-    return docs_with_metadata
+    Yields:
+        Processed chunks, in file order
+    """
+    if sources:
+        # iter_documents yields one list per file, in file order
+        pages = (_build_document(page_content=doc.page_content,
+                                 metadata={**(doc.metadata or {}), 'source': sources.get(file_path, file_path)})
+                 for file_path, docs in zip(file_paths, iter_documents(file_paths, workers, report))
+                 for doc in docs)
+    else:
+        pages = (doc for docs in iter_documents(file_paths, workers, report) for doc in docs)
+    yield from split_pages(pages, chunk_size, chunk_overlap, doc_title)
 
 
 def process_documents(file_paths: List[str],
                       chunk_size: int = 1200,
                       chunk_overlap: int = 300,
-                      doc_title: str = "Financial-Documents") -> List[Document]:
+                      doc_title: str = "Financial-Documents",
+                      workers: Optional[int] = None) -> List[Document]:
     """
     Main function to process documents: load, chunk, and add metadata.
 
@@ -139,19 +444,17 @@ def process_documents(file_paths: List[str],
         chunk_size: Size of each chunk for splitting
         chunk_overlap: Overlap between chunks
         doc_title: Title to use for documents
+        workers: Number of parser processes (defaults to DOCUMENT_WORKERS)
 
     Returns:
         List of processed documents
     """
-    # Load documents
-    docs = load_documents(file_paths)
-
-    # Chunk documents
-    chunked_docs = chunk_documents(docs, chunk_size, chunk_overlap)
-
-    # Add metadata
-    processed_docs = add_metadata(chunked_docs, doc_title)
+    started = time.perf_counter()
+    report: List[Dict[str, Any]] = []
+    processed_docs = list(iter_process_documents(file_paths, chunk_size, chunk_overlap, doc_title, workers, report))
 
-    print(f"Processed {len(processed_docs)} total chunks from {len(file_paths)} files")
+    print(format_load_report(report))
+    print(f"Processed {len(processed_docs)} total chunks from {len(file_paths)} files "
+          f"in {time.perf_counter() - started:.2f}s")
 
-    return processed_docs
\ No newline at end of file
+    return processed_docs
@@ -0,0 +1,278 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+# A read refreshes an entry's used_at only once the stored one is this old (seconds),
+# and the refreshes are written in batches of TOUCH_BATCH or with the next put, so
+# cache hits do not each cost a write transaction
+TOUCH_INTERVAL = 300.0
+TOUCH_BATCH = 1000
+
+
+def embedding_key(model_name: str, text: str) -> str:
+    """
+    Content address of a chunk's embedding: the hash of (model name, text).
+    """
+    return hashlib.sha256(f"{model_name}\x00{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    On-disk, content-addressed store of embedding vectors.
+
+    Vectors are kept as float32 blobs in a SQLite file keyed by embedding_key,
+    so an unchanged chunk maps to the same entry across runs and processes.
+    Once the stored vectors exceed max_bytes the least recently used entries
+    are evicted. The stored size is kept in a totals row maintained by
+    triggers, so checking it does not scan the table.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 512 * 1024 * 1024):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Rows replaced by INSERT OR REPLACE only fire the delete trigger with this on
+        self._conn.execute("PRAGMA recursive_triggers=ON")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, used_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_used_at ON embeddings (used_at)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS totals (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS embeddings_added AFTER INSERT ON embeddings BEGIN "
+            "UPDATE totals SET value = value + 1 WHERE name = 'entries'; "
+            "UPDATE totals SET value = value + new.size WHERE name = 'bytes'; END"
+        )
+        self._conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS embeddings_removed AFTER DELETE ON embeddings BEGIN "
+            "UPDATE totals SET value = value - 1 WHERE name = 'entries'; "
+            "UPDATE totals SET value = value - old.size WHERE name = 'bytes'; END"
+        )
+        # Caches written before the totals row existed are counted once
+        self._conn.execute("INSERT OR IGNORE INTO totals SELECT 'entries', COUNT(*) FROM embeddings")
+        self._conn.execute("INSERT OR IGNORE INTO totals SELECT 'bytes', COALESCE(SUM(size), 0) FROM embeddings")
+        self._conn.commit()
+        self._counters = {"hits": 0, "misses": 0, "evictions": 0}
+        self._touched: Dict[str, None] = {}
+
+    def _totals(self) -> Dict[str, int]:
+        return dict(self._conn.execute("SELECT name, value FROM totals").fetchall())
+
+    def _write_touched(self) -> None:
+        # Caller holds the lock and commits
+        if self._touched:
+            now = time.time()
+            self._conn.executemany("UPDATE embeddings SET used_at = ? WHERE key = ?",
+                                   [(now, key) for key in self._touched])
+            self._touched.clear()
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        """
+        Return the cached vectors for the keys that are present.
+        """
+        found: Dict[str, List[float]] = {}
+        stale_before = time.time() - TOUCH_INTERVAL
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                marks = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT key, vector, used_at FROM embeddings WHERE key IN ({marks})", batch
+                ).fetchall()
+                for key, blob, used_at in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32).tolist()
+                    if used_at < stale_before:
+                        self._touched[key] = None
+            if len(self._touched) >= TOUCH_BATCH:
+                self._write_touched()
+                self._conn.commit()
+            self._counters["hits"] += len(found)
+            self._counters["misses"] += len(keys) - len(found)
+        return found
+
+    def put_many(self, items: Dict[str, List[float]]) -> None:
+        """
+        Store vectors and evict least recently used entries over the size cap.
+        """
+        now = time.time()
+        rows = []
+        for key, vector in items.items():
+            blob = np.asarray(vector, dtype=np.float32).tobytes()
+            rows.append((key, blob, len(blob), now))
+        with self._lock:
+            # Pending read refreshes go first so eviction sees recent hits as recent
+            self._write_touched()
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+            self._conn.commit()
+            self._evict()
+
+    def _evict(self) -> None:
+        total = self._totals().get("bytes", 0)
+        if total <= self.max_bytes:
+            return
+        # Evict down to 90% of the cap so the next run does not evict again straight away
+        excess = total - int(self.max_bytes * 0.9)
+        evicted = 0
+        for key, size in self._conn.execute("SELECT key, size FROM embeddings ORDER BY used_at").fetchall():
+            if excess <= 0:
+                break
+            self._conn.execute("DELETE FROM embeddings WHERE key = ?", (key,))
+            excess -= size
+            evicted += 1
+        self._conn.commit()
+        self._counters["evictions"] += evicted
+
+    def reset_stats(self) -> None:
+        """
+        Zero the hit and miss counters, e.g. at the start of an ingestion run.
+        """
+        with self._lock:
+            self._counters = dict.fromkeys(self._counters, 0)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return hit/miss/eviction counters, the hit rate and the stored size.
+        """
+        with self._lock:
+            totals = self._totals()
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return dict(self._counters,
+                        hit_rate=round(self._counters["hits"] / lookups, 3) if lookups else 0.0,
+                        entries=totals.get("entries", 0),
+                        bytes=totals.get("bytes", 0),
+                        max_bytes=self.max_bytes)
+
+
+class CachedEmbeddings:
+    """
+    Embeddings wrapper that answers unchanged chunks from an EmbeddingCache and
+    only sends the rest to the underlying model. Drop-in for OllamaEmbeddings
+    wherever LangChain expects embed_documents/embed_query.
+    """
+
+    def __init__(self, embeddings: Any, model_name: str, cache: EmbeddingCache):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.cache = cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [embedding_key(self.model_name, text) for text in texts]
+        found = self.cache.get_many(list(dict.fromkeys(keys)))
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(computed)
+            found.update(computed)
+
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
+
+    def report(self) -> str:
+        """
+        One-line summary of the cache for the end of an ingestion run.
+        """
+        stats = self.cache.stats()
+        return (f"Embedding cache: {stats['hits']} hits, {stats['misses']} misses "
+                f"({stats['hit_rate']:.0%} hit rate), {stats['entries']} entries, "
+                f"{stats['bytes'] / (1024 * 1024):.1f} MB")
+
+
+class QueryEmbeddingCache:
+    """
+    Embeddings wrapper for the retrieval path that remembers question embeddings.
+
+    Repeated questions (including the same question sent to /rag and /ask) are
+    answered from an in-process LRU of at most max_entries vectors. An optional
+    EmbeddingCache acts as a second tier shared by every worker on the host.
+    Document embedding is passed through untouched.
+    """
+
+    def __init__(self,
+                 embeddings: Any,
+                 model_name: str,
+                 max_entries: int = 2048,
+                 disk: Optional[EmbeddingCache] = None):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.disk = disk
+        self._entries: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "disk_hits": 0, "misses": 0}
+
+    def _remember(self, key: str, vector: List[float]) -> None:
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = embedding_key(self.model_name, text)
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+                self._counters["hits"] += 1
+                return vector
+
+        if self.disk is not None:
+            vector = self.disk.get_many([key]).get(key)
+            if vector is not None:
+                with self._lock:
+                    self._counters["disk_hits"] += 1
+                self._remember(key, vector)
+                return vector
+
+        with self._lock:
+            self._counters["misses"] += 1
+        vector = self.embeddings.embed_query(text)
+        self._remember(key, vector)
+        if self.disk is not None:
+            self.disk.put_many({key: vector})
+        return vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return hit/miss counters for both tiers and the in-process size.
+        """
+        with self._lock:
+            return dict(self._counters,
+                        entries=len(self._entries),
+                        max_entries=self.max_entries,
+                        disk=self.disk.stats() if self.disk is not None else None)
+
+
+_caches: Dict[str, EmbeddingCache] = {}
+_caches_lock = threading.Lock()
+
+
+def get_embedding_cache(path: str, max_bytes: int = 512 * 1024 * 1024) -> EmbeddingCache:
+    """
+    Return the process-wide EmbeddingCache for a file, opening it on first use.
+    """
+    path = os.path.abspath(path)
+    with _caches_lock:
+        if path not in _caches:
+            _caches[path] = EmbeddingCache(path, max_bytes)
+        return _caches[path]
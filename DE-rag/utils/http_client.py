@@ -0,0 +1,260 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+# Only these methods are safe to repeat after a failure
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS"}
+RETRY_STATUSES = {429, 502, 503, 504}
+
+# Monotonic time by which the caller needs an answer (set per context source).
+# Requests made under it shrink their timeout to the time left and skip retries
+# that could not finish before it, so an abandoned source frees its worker.
+request_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+
+def time_left(deadline: Optional[float]) -> Optional[float]:
+    """
+    Seconds until deadline, or None when there is no deadline.
+    """
+    return None if deadline is None else deadline - time.monotonic()
+
+
+class HostTimings:
+    """
+    Thread-safe per-host request counters and timings.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts: Dict[str, Dict[str, float]] = {}
+
+    def record(self, host: str, elapsed: float, failed: bool, retried: bool) -> None:
+        with self._lock:
+            timing = self._hosts.setdefault(host, {
+                "requests": 0, "errors": 0, "retries": 0, "total_ms": 0.0, "max_ms": 0.0
+            })
+            timing["requests"] += 1
+            timing["errors"] += int(failed)
+            timing["retries"] += int(retried)
+            timing["total_ms"] += elapsed * 1000
+            timing["max_ms"] = max(timing["max_ms"], elapsed * 1000)
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {
+                host: dict(timing, avg_ms=round(timing["total_ms"] / timing["requests"], 2))
+                for host, timing in self._hosts.items()
+            }
+
+
+def retry_delay(attempt: int, backoff: float, max_backoff: float) -> float:
+    """
+    Exponential backoff with full jitter, so concurrent workers do not retry in lockstep.
+    """
+    return random.uniform(0, min(max_backoff, backoff * (2 ** attempt)))
+
+
+class HttpClient:
+    """
+    Shared outbound HTTP client with a keep-alive connection pool.
+
+    Idempotent requests that fail with a connection error, a timeout or a
+    transient status are retried with exponential backoff and full jitter,
+    within the caller's request_deadline when one is set.
+    Timings are recorded per host so slow upstreams show up in /health.
+    """
+
+    def __init__(self,
+                 pool_size: int = 16,
+                 max_retries: int = 2,
+                 backoff: float = 0.25,
+                 max_backoff: float = 2.0,
+                 timeout: float = 10.0):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.timings = HostTimings()
+
+    def _sleep_before_retry(self, attempt: int, deadline: Optional[float]) -> bool:
+        """
+        Back off before the next attempt; False if the deadline leaves no time for it.
+        """
+        delay = retry_delay(attempt, self.backoff, self.max_backoff)
+        remaining = time_left(deadline)
+        if remaining is not None and remaining <= delay:
+            return False
+        time.sleep(delay)
+        return True
+
+    def request(self, method: str, url: str, **kwargs: Any) -> requests.Response:
+        """
+        Send a request through the pooled session, retrying idempotent failures.
+        """
+        method = method.upper()
+        timeout = kwargs.pop("timeout", self.timeout)
+        deadline = request_deadline.get()
+        host = urlsplit(url).netloc
+        retries = self.max_retries if method in IDEMPOTENT_METHODS else 0
+
+        for attempt in range(retries + 1):
+            remaining = time_left(deadline)
+            if remaining is not None and remaining <= 0:
+                raise requests.Timeout(f"Deadline passed before {method} {url}")
+            started = time.monotonic()
+            try:
+                response = self.session.request(
+                    method, url, timeout=timeout if remaining is None else min(timeout, remaining), **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self.timings.record(host, time.monotonic() - started, failed=True, retried=attempt > 0)
+                if attempt >= retries or not self._sleep_before_retry(attempt, deadline):
+                    raise
+                continue
+
+            failed = response.status_code >= 400
+            self.timings.record(host, time.monotonic() - started, failed=failed, retried=attempt > 0)
+            if (response.status_code in RETRY_STATUSES and attempt < retries
+                    and self._sleep_before_retry(attempt, deadline)):
+                continue
+            return response
+
+    def get(self, url: str, params: Optional[Dict[str, Any]] = None, **kwargs: Any) -> requests.Response:
+        """
+        Send a GET request through the pooled session.
+        """
+        return self.request("GET", url, params=params, **kwargs)
+
+    def warm_up(self, url: str) -> None:
+        """
+        Open a pooled connection to the host of url in the background, so TCP and
+        TLS setup happen before the first real request needs them.
+        """
+        def connect():
+            try:
+                self.request("HEAD", url, timeout=5)
+            except Exception as e:
+                print(f"Connection warm-up for {url} failed: {str(e)}")
+
+        threading.Thread(target=connect, name="http-warm-up", daemon=True).start()
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Return per-host request counts and timings.
+        """
+        return self.timings.stats()
+
+
+class AsyncHttpClient:
+    """
+    Async counterpart of HttpClient built on httpx, for the ASGI serving mode.
+
+    Uses the same retry policy and per-host timing report. The underlying
+    httpx.AsyncClient is created on first use inside the running event loop.
+    """
+
+    def __init__(self,
+                 pool_size: int = 100,
+                 max_retries: int = 2,
+                 backoff: float = 0.25,
+                 max_backoff: float = 2.0,
+                 timeout: float = 10.0):
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.timings = HostTimings()
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=self.pool_size,
+                                    max_keepalive_connections=self.pool_size),
+                timeout=self.timeout,
+            )
+        return self._client
+
+    async def _sleep_before_retry(self, attempt: int, deadline: Optional[float]) -> bool:
+        """
+        Back off before the next attempt; False if the deadline leaves no time for it.
+        """
+        delay = retry_delay(attempt, self.backoff, self.max_backoff)
+        remaining = time_left(deadline)
+        if remaining is not None and remaining <= delay:
+            return False
+        await asyncio.sleep(delay)
+        return True
+
+    async def request(self, method: str, url: str, **kwargs: Any):
+        """
+        Send a request through the pooled async client, retrying idempotent failures.
+        """
+        method = method.upper()
+        timeout = kwargs.pop("timeout", self.timeout)
+        deadline = request_deadline.get()
+        host = urlsplit(url).netloc
+        retries = self.max_retries if method in IDEMPOTENT_METHODS else 0
+
+        for attempt in range(retries + 1):
+            remaining = time_left(deadline)
+            if remaining is not None and remaining <= 0:
+                raise httpx.TimeoutException(f"Deadline passed before {method} {url}")
+            started = time.monotonic()
+            try:
+                response = await self.client.request(
+                    method, url, timeout=timeout if remaining is None else min(timeout, remaining), **kwargs)
+            except httpx.TransportError:
+                self.timings.record(host, time.monotonic() - started, failed=True, retried=attempt > 0)
+                if attempt >= retries or not await self._sleep_before_retry(attempt, deadline):
+                    raise
+                continue
+
+            failed = response.status_code >= 400
+            self.timings.record(host, time.monotonic() - started, failed=failed, retried=attempt > 0)
+            if (response.status_code in RETRY_STATUSES and attempt < retries
+                    and await self._sleep_before_retry(attempt, deadline)):
+                continue
+            return response
+
+    async def get(self, url: str, params: Optional[Dict[str, Any]] = None, **kwargs: Any):
+        """
+        Send a GET request through the pooled async client.
+        """
+        return await self.request("GET", url, params=params, **kwargs)
+
+    async def aclose(self) -> None:
+        """
+        Close the pooled connections; the client is recreated on next use.
+        """
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Return per-host request counts and timings.
+        """
+        return self.timings.stats()
+
+
+# Process-wide clients for finance calls; the sync pool matches the network context worker
+# count, the async pool is sized for many concurrent questions on one event loop
+finance_http = HttpClient(pool_size=int(os.environ.get('CONTEXT_NETWORK_WORKERS', 16)))
+async_finance_http = AsyncHttpClient(pool_size=int(os.environ.get('ASYNC_HTTP_POOL_SIZE', 100)))
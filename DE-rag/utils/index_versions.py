@@ -0,0 +1,356 @@
+import datetime
+import json
+import os
+import shutil
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set
+
+# Optional cross-process lock around publishing (POSIX only)
+try:
+    import fcntl
+
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+VERSIONS_DIR = "versions"
+CURRENT_FILE = "CURRENT"
+LEASES_DIR = "leases"
+PUBLISH_LOCK_FILE = "publish.lock"
+
+# ioctl that makes dst share src's blocks copy-on-write (Linux btrfs/XFS)
+FICLONE = 0x40049409
+
+# A lease from another host counts until its heartbeat is this old
+LEASE_TTL = float(os.environ.get('INDEX_LEASE_TTL', 300))
+
+
+def lease_owner() -> str:
+    """
+    Lease name for this process.
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def clone_file(src: str, dst: str) -> str:
+    """
+    copytree copy function: a copy-on-write clone where the filesystem
+    supports one, so seeding a version costs metadata rather than a full copy
+    of the index; a regular copy otherwise.
+    """
+    if FCNTL_AVAILABLE:
+        try:
+            with open(src, "rb") as source, open(dst, "wb") as target:
+                fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+            shutil.copystat(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
+
+
+class IndexVersions:
+    """
+    Versioned snapshot directories for one index root.
+
+    Each ingestion writes a complete index into root/versions/<version> and
+    then publishes it by atomically replacing root/CURRENT, so readers only
+    ever open a fully written version. A root that predates versioning (Chroma
+    files directly in root, no CURRENT) is served as is until the first publish.
+    Processes serving a version hold a lease on it in root/leases, and
+    cleanup never deletes a leased version.
+    """
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        self.versions_dir = os.path.join(self.root, VERSIONS_DIR)
+        self._pointer = os.path.join(self.root, CURRENT_FILE)
+        self.leases_dir = os.path.join(self.root, LEASES_DIR)
+        self._publish_lock = threading.Lock()
+
+    def current_name(self) -> Optional[str]:
+        """
+        Name of the published version, or None for the unversioned layout.
+        """
+        try:
+            with open(self._pointer, encoding="utf-8") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def current(self) -> str:
+        """
+        Directory of the published version.
+        """
+        name = self.current_name()
+        return os.path.join(self.versions_dir, name) if name else self.root
+
+    def has_data(self) -> bool:
+        """
+        Whether the published version contains any index files.
+        """
+        current = self.current()
+        if not os.path.isdir(current):
+            return False
+        return any(name not in (VERSIONS_DIR, LEASES_DIR, PUBLISH_LOCK_FILE, CURRENT_FILE, f"{CURRENT_FILE}.tmp")
+                   for name in os.listdir(current))
+
+    def new_version(self, copy_current: bool = True) -> str:
+        """
+        Create a directory for the next version, optionally seeded with a copy
+        of the current one so ingestion can upsert into it incrementally. Files
+        are cloned copy-on-write where the filesystem allows (see clone_file).
+        """
+        os.makedirs(self.versions_dir, exist_ok=True)
+        name = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d-%H%M%S-%f") + f"-{os.getpid()}"
+        path = os.path.join(self.versions_dir, name)
+        current = self.current()
+        if copy_current and self.has_data():
+            shutil.copytree(current, path, copy_function=clone_file,
+                            ignore=shutil.ignore_patterns(VERSIONS_DIR, LEASES_DIR, PUBLISH_LOCK_FILE,
+                                                          CURRENT_FILE, f"{CURRENT_FILE}.tmp"))
+        else:
+            os.makedirs(path)
+        return path
+
+    def publish(self, path: str) -> None:
+        """
+        Make a fully written version current with an atomic pointer swap.
+        """
+        name = os.path.basename(os.path.normpath(path))
+        tmp_path = f"{self._pointer}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(name)
+        os.replace(tmp_path, self._pointer)
+        print(f"Published index version {name}")
+
+    @contextmanager
+    def writer(self, copy_current: bool = True) -> Iterator[str]:
+        """
+        Write the next version and publish it, one writer at a time across
+        threads and (where fcntl is available) processes, so a writer always
+        starts from the latest published version and never loses another's
+        changes. Published versions are never modified in place. Yields the
+        new version's directory; it is published if the block succeeds and
+        deleted if it raises.
+        """
+        with self._publish_lock:
+            os.makedirs(self.root, exist_ok=True)
+            with open(os.path.join(self.root, PUBLISH_LOCK_FILE), "a") as lock_file:
+                if FCNTL_AVAILABLE:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    path = self.new_version(copy_current=copy_current)
+                    try:
+                        yield path
+                    except BaseException:
+                        shutil.rmtree(path, ignore_errors=True)
+                        raise
+                    self.publish(path)
+                finally:
+                    if FCNTL_AVAILABLE:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def versions(self) -> List[str]:
+        """
+        Version names, oldest first.
+        """
+        if not os.path.isdir(self.versions_dir):
+            return []
+        return sorted(os.listdir(self.versions_dir))
+
+    def lease(self, versions: List[str], owner: Optional[str] = None) -> None:
+        """
+        Record (or renew) that owner is serving versions; an empty list drops the lease.
+        """
+        owner = owner or lease_owner()
+        path = os.path.join(self.leases_dir, f"{owner}.json")
+        if not versions:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            return
+        os.makedirs(self.leases_dir, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"host": socket.gethostname(), "pid": os.getpid(),
+                       "versions": sorted(versions), "heartbeat": time.time()}, f)
+        os.replace(tmp_path, path)
+
+    def leased_versions(self) -> Set[str]:
+        """
+        Versions held by a live lease. A lease from this host counts while its
+        process is alive; one from another host while its heartbeat is recent.
+        Dead leases are removed.
+        """
+        if not os.path.isdir(self.leases_dir):
+            return set()
+        leased: Set[str] = set()
+        host = socket.gethostname()
+        for name in os.listdir(self.leases_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.leases_dir, name)
+            try:
+                with open(path, encoding="utf-8") as f:
+                    lease = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if lease.get("host") == host:
+                alive = _pid_alive(int(lease.get("pid", 0)))
+            else:
+                alive = time.time() - lease.get("heartbeat", 0) < LEASE_TTL
+            if alive:
+                leased.update(lease.get("versions", []))
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        return leased
+
+    def cleanup(self, keep: int = 3) -> List[str]:
+        """
+        Delete all but the newest keep versions, never the current one or one
+        a process still serves (see lease). Returns the removed directories.
+        """
+        current = self.current_name()
+        names = self.versions()
+        kept = set(names[-keep:]) if keep > 0 else set()
+        kept.update(self.leased_versions())
+        removable = [name for name in names if name not in kept and name != current]
+        removed = []
+        for name in removable:
+            path = os.path.join(self.versions_dir, name)
+            shutil.rmtree(path, ignore_errors=True)
+            removed.append(path)
+        return removed
+
+
+class ServingSlot:
+    """
+    Atomically swappable holder for the state a server answers with.
+
+    Requests take a reference with use()/acquire() and keep the state they
+    started with even if a swap happens meanwhile. A swapped-out state is
+    released (on_release) only after its last in-flight request finishes.
+    With versions, the slot leases every version it still holds (the current
+    one and retired ones with requests in flight) and renews the lease every
+    heartbeat seconds, so other processes' cleanup leaves them alone.
+    """
+
+    def __init__(self, versions: Optional[IndexVersions] = None, heartbeat: float = LEASE_TTL / 3):
+        self._lock = threading.Lock()
+        self._current: Optional[Dict[str, Any]] = None
+        self._held: List[Dict[str, Any]] = []
+        self._counters = {"swaps": 0, "retired": 0}
+        self._versions = versions
+        self._heartbeat = heartbeat
+        self._heartbeat_thread: Optional[threading.Thread] = None
+
+    def _held_versions(self) -> List[str]:
+        with self._lock:
+            return sorted({entry["version"] for entry in self._held if entry["version"]})
+
+    def _renew_lease(self) -> None:
+        if self._versions is None:
+            return
+        try:
+            self._versions.lease(self._held_versions())
+        except OSError as e:
+            print(f"Error writing index lease: {str(e)}")
+
+    def _renew_forever(self) -> None:
+        while True:
+            time.sleep(self._heartbeat)
+            self._renew_lease()
+
+    def _start_heartbeat(self) -> None:
+        if self._versions is None or self._heartbeat_thread is not None:
+            return
+        self._heartbeat_thread = threading.Thread(target=self._renew_forever, name="index-lease", daemon=True)
+        self._heartbeat_thread.start()
+
+    def swap(self, value: Any, version: str, on_release: Optional[Callable[[Any], None]] = None) -> None:
+        """
+        Point new requests at value; the previous state is retired.
+        """
+        entry = {"value": value, "version": version, "refs": 0, "retired": False,
+                 "on_release": on_release, "since": time.time()}
+        with self._lock:
+            old, self._current = self._current, entry
+            self._held.append(entry)
+            self._counters["swaps"] += 1
+            if old is not None:
+                old["retired"] = True
+                release_now = old["refs"] == 0
+        # Lease the new version before the old one can be dropped from the lease
+        self._renew_lease()
+        self._start_heartbeat()
+        if old is not None and release_now:
+            self._release(old)
+
+    def _release(self, entry: Dict[str, Any]) -> None:
+        # Close the version's stores while it is still leased, then drop the lease
+        if entry["on_release"] is not None:
+            try:
+                entry["on_release"](entry["value"])
+            except Exception as e:
+                print(f"Error releasing index version {entry['version']}: {str(e)}")
+        with self._lock:
+            self._counters["retired"] += 1
+            self._held.remove(entry)
+        self._renew_lease()
+
+    def acquire(self) -> Optional[Dict[str, Any]]:
+        """
+        Take a reference to the current state; pair with release().
+        Returns None when nothing has been published yet.
+        """
+        with self._lock:
+            entry = self._current
+            if entry is not None:
+                entry["refs"] += 1
+            return entry
+
+    def release(self, entry: Optional[Dict[str, Any]]) -> None:
+        if entry is None:
+            return
+        with self._lock:
+            entry["refs"] -= 1
+            release_now = entry["retired"] and entry["refs"] == 0
+        if release_now:
+            self._release(entry)
+
+    @contextmanager
+    def use(self) -> Iterator[Optional[Any]]:
+        """
+        Context manager yielding the current state's value for one request.
+        """
+        entry = self.acquire()
+        try:
+            yield entry["value"] if entry is not None else None
+        finally:
+            self.release(entry)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            current = self._current
+            return dict(self._counters,
+                        version=current["version"] if current else None,
+                        in_flight=current["refs"] if current else 0,
+                        serving_since=current["since"] if current else None)
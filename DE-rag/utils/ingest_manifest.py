@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+
+def manifest_path(persist_directory: str, collection_name: str) -> str:
+    """
+    Location of a collection's ingestion manifest, next to the vector store.
+    """
+    return os.path.join(persist_directory, f"{collection_name}.manifest.json")
+
+
+def file_hash(path: str, block_size: int = 1024 * 1024) -> str:
+    """
+    sha256 of a file's content, read in blocks.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def source_key(source: str) -> str:
+    """
+    Manifest key for a source: the real path for files, the source itself
+    otherwise (e.g. "summarization:report.pdf" or a logical upload name like
+    "upload://docs-financial-rag/report.pdf"), so loaders that report a
+    resolved path and callers that pass a relative one or one through a
+    symlink (e.g. a symlinked temp dir) agree.
+    """
+    if "://" in source:
+        return source
+    return os.path.realpath(source) if os.path.sep in source or os.path.exists(source) else source
+
+
+class IngestManifest:
+    """
+    Record of what has been ingested into one collection.
+
+    For each source it keeps the content hash, the parameters it was chunked
+    with and the chunk IDs it produced. A source whose hash and parameters
+    match its entry (and whose chunks are still stored) does not need to be
+    parsed or embedded again.
+    """
+
+    def __init__(self, path: str, entries: Optional[Dict[str, Dict[str, Any]]] = None):
+        self.path = path
+        self.entries: Dict[str, Dict[str, Any]] = entries or {}
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @classmethod
+    def load(cls, persist_directory: str, collection_name: str) -> "IngestManifest":
+        """
+        Load a collection's manifest, or an empty one if there is none yet.
+        """
+        path = manifest_path(persist_directory, collection_name)
+        try:
+            with open(path, encoding="utf-8") as f:
+                return cls(path, json.load(f).get("sources", {}))
+        except FileNotFoundError:
+            return cls(path)
+        except (OSError, ValueError) as e:
+            print(f"Error reading ingestion manifest, re-ingesting everything: {str(e)}")
+            return cls(path)
+
+    def save(self) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": 1, "sources": self.entries}, f)
+        os.replace(tmp_path, self.path)
+
+    def entry(self, source: str) -> Optional[Dict[str, Any]]:
+        return self.entries.get(source_key(source))
+
+    def is_current(self, source: str, content_hash: str, params: Dict[str, Any]) -> bool:
+        """
+        Whether source was ingested from the same content with the same parameters.
+        """
+        entry = self.entry(source)
+        return entry is not None and entry["hash"] == content_hash and entry["params"] == params
+
+    def changed_files(self, file_paths: List[str], params: Dict[str, Any],
+                      sources: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+        """
+        Files that are new or changed since they were recorded, with their hashes.
+        sources maps a file to the source it is recorded under, if not its path.
+        """
+        sources = sources or {}
+        changed = {}
+        for file_path in file_paths:
+            content_hash = file_hash(file_path)
+            if not self.is_current(sources.get(file_path, file_path), content_hash, params):
+                changed[file_path] = content_hash
+        return changed
+
+    def record(self, source: str, content_hash: str, params: Dict[str, Any], chunk_ids: List[str]) -> None:
+        self.entries[source_key(source)] = {
+            "hash": content_hash,
+            "params": params,
+            "chunk_ids": list(chunk_ids),
+            "ingested_at": time.time(),
+        }
+
+    def remove(self, source: str) -> None:
+        self.entries.pop(source_key(source), None)
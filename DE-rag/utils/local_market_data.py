@@ -0,0 +1,159 @@
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Set
+
+
+class LocalMarketData:
+    """
+    Quote provider backed by the daily OHLCV history in stock_data_polygone.
+
+    The RAG chain asks it first for symbols we hold locally and only goes to
+    SerpAPI for the rest. Results are rendered in the same shape as the
+    SerpAPI stock_data entries so format_serpapi_data can print them as is.
+    Any DB-API connection works: Postgres in production, SQLite for testing.
+    """
+
+    def __init__(self,
+                 connect: Callable[[], Any],
+                 placeholder: str = "%s",
+                 table: str = "stock_data_polygone",
+                 recent_days: int = 5,
+                 symbols_ttl: float = 300.0):
+        self._connect = connect
+        self._placeholder = placeholder
+        self._table = table
+        self.recent_days = recent_days
+        self._symbols_ttl = symbols_ttl
+        self._symbols: Set[str] = set()
+        self._symbols_loaded_at = 0.0
+        self._lock = threading.Lock()
+        self._counters = {"quotes": 0, "errors": 0}
+
+    @classmethod
+    def from_postgres(cls, **kwargs: Any) -> "LocalMarketData":
+        """
+        Provider for the Postgres database used by api.py, configurable via POSTGRES_* variables.
+        """
+        import psycopg2
+
+        conn_params = {
+            'dbname': os.environ.get('POSTGRES_DB', 'postgres'),
+            'user': os.environ.get('POSTGRES_USER', 'postgres'),
+            'password': os.environ.get('POSTGRES_PASSWORD', 'postgres'),
+            'host': os.environ.get('POSTGRES_HOST', 'localhost'),
+            'port': os.environ.get('POSTGRES_PORT', '5432'),
+        }
+        return cls(lambda: psycopg2.connect(connect_timeout=2, **conn_params), placeholder="%s", **kwargs)
+
+    @classmethod
+    def from_sqlite(cls, path: str, **kwargs: Any) -> "LocalMarketData":
+        """
+        Provider for a SQLite copy of stock_data_polygone.
+        """
+        import sqlite3
+
+        return cls(lambda: sqlite3.connect(path), placeholder="?", **kwargs)
+
+    def _query(self, sql: str, params: tuple = ()) -> List[tuple]:
+        conn = self._connect()
+        try:
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            rows = cur.fetchall()
+            cur.close()
+            return rows
+        finally:
+            conn.close()
+
+    def load_symbols(self) -> Set[str]:
+        """
+        Load the set of locally held symbols from the database.
+        """
+        try:
+            rows = self._query(f"SELECT DISTINCT symbol FROM {self._table}")
+            symbols = {str(row[0]).upper() for row in rows}
+            print(f"Local market data: {len(symbols)} symbols available")
+        except Exception as e:
+            print(f"Local market data unavailable: {str(e)}")
+            with self._lock:
+                self._counters["errors"] += 1
+            return self._symbols
+
+        with self._lock:
+            self._symbols = symbols
+            self._symbols_loaded_at = time.monotonic()
+        return symbols
+
+    def symbols(self) -> Set[str]:
+        """
+        Return the symbols held locally. Once symbols_ttl has passed the set is
+        reloaded in the background, so callers on the hot path never wait on it.
+        """
+        with self._lock:
+            expired = time.monotonic() - self._symbols_loaded_at >= self._symbols_ttl
+            if expired:
+                self._symbols_loaded_at = time.monotonic()
+            symbols = self._symbols
+
+        if expired:
+            threading.Thread(target=self.load_symbols, name="local-symbols", daemon=True).start()
+        return symbols
+
+    def has_symbol(self, symbol: str) -> bool:
+        """
+        Check whether a symbol is held locally.
+        """
+        return symbol.upper() in self.symbols()
+
+    def quote(self, symbol: str) -> List[Dict[str, Any]]:
+        """
+        Render the latest close, its change and the recent closes for a symbol
+        as SerpAPI-style stock_data entries. Returns [] if there is no data.
+        """
+        rows = self._query(
+            f"SELECT date, close, volume FROM {self._table} "
+            f"WHERE symbol = {self._placeholder} ORDER BY date DESC LIMIT {int(self.recent_days)}",
+            (symbol.upper(),)
+        )
+        with self._lock:
+            self._counters["quotes"] += 1
+        if not rows:
+            return []
+
+        latest_date, latest_close, _ = rows[0]
+        latest_close = float(latest_close)
+        entry = {
+            "title": f"{symbol.upper()} (local daily close)",
+            "price": f"{latest_close:.2f}",
+            "change": "N/A",
+            "percentage": "N/A",
+            "timestamp": str(latest_date),
+        }
+        if len(rows) > 1 and float(rows[1][1]):
+            previous_close = float(rows[1][1])
+            change = latest_close - previous_close
+            entry["change"] = f"{change:+.2f}"
+            entry["percentage"] = f"{change / previous_close * 100:+.2f}%"
+
+        recent_points = [
+            {"date": str(day), "price": round(float(close), 2), "volume": volume}
+            for day, close, volume in reversed(rows)
+        ]
+        return [entry, {"recent_points": recent_points}]
+
+    def quotes(self, symbols: List[str]) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Quotes for several symbols in the fetch_stock_quote result shape.
+        """
+        stock_data = []
+        for symbol in symbols:
+            stock_data.extend(self.quote(symbol))
+        return {"stock_data": stock_data, "news": []}
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return quote and error counters and the number of known symbols.
+        """
+        with self._lock:
+            return dict(self._counters, symbols=len(self._symbols))
@@ -0,0 +1,114 @@
+import datetime
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+
+class MarketIndexSnapshot:
+    """
+    Background service that keeps the latest market index table in memory.
+
+    The index table is the same whatever the user asked, so it is refreshed on a
+    fixed schedule instead of per question. Readers get the last good snapshot
+    without any I/O; a failed refresh keeps the previous snapshot in place.
+    """
+
+    def __init__(self,
+                 fetcher: Callable[[], List[Dict[str, str]]],
+                 interval: float = 60.0):
+        self._fetcher = fetcher
+        self.interval = interval
+        self._snapshot: Optional[Dict[str, Any]] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._consecutive_failures = 0
+        self._last_error: Optional[str] = None
+
+    def refresh(self) -> bool:
+        """
+        Fetch the index table once and publish it if it is non-empty.
+        """
+        error = None
+        try:
+            market_data = self._fetcher()
+        except Exception as e:
+            market_data = []
+            error = str(e)
+
+        if not market_data:
+            with self._lock:
+                self._consecutive_failures += 1
+                self._last_error = error or "Empty market index response"
+            print(f"Market index snapshot refresh failed: {self._last_error}")
+            return False
+
+        fetched_at = datetime.datetime.now(datetime.timezone.utc)
+        with self._lock:
+            self._snapshot = {
+                "market_data": market_data,
+                "as_of": fetched_at.isoformat(timespec="seconds"),
+                "fetched_at": fetched_at.timestamp(),
+            }
+            self._consecutive_failures = 0
+            self._last_error = None
+        return True
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.refresh()
+            self._stop.wait(self.interval)
+
+    def start(self) -> None:
+        """
+        Start the refresher thread; calling it again while running does nothing.
+        """
+        if self.is_running():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="market-snapshot", daemon=True)
+        self._thread.start()
+        print(f"Market index snapshot service started (every {self.interval}s)")
+
+    def stop(self) -> None:
+        """
+        Stop the refresher thread.
+        """
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self._thread = None
+
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def latest(self) -> Optional[Dict[str, Any]]:
+        """
+        Return the current snapshot ({market_data, as_of, fetched_at}) or None.
+        """
+        with self._lock:
+            return self._snapshot
+
+    def health(self) -> Dict[str, Any]:
+        """
+        Report whether the service is running and how fresh its snapshot is.
+        """
+        snapshot = self.latest()
+        age = round(time.time() - snapshot["fetched_at"], 1) if snapshot else None
+        if snapshot is None:
+            state = "empty"
+        elif age > 3 * self.interval:
+            state = "stale"
+        else:
+            state = "fresh"
+
+        with self._lock:
+            return {
+                "running": self.is_running(),
+                "state": state,
+                "as_of": snapshot["as_of"] if snapshot else None,
+                "age_seconds": age,
+                "interval_seconds": self.interval,
+                "consecutive_failures": self._consecutive_failures,
+                "last_error": self._last_error,
+            }
@@ -0,0 +1,185 @@
+import bisect
+import datetime
+import os
+import threading
+from typing import Any, Dict, Hashable, List, Optional, Set, Union
+
+# Metadata fields that get an equality index; date_int also gets a range index
+INDEXED_FIELDS = ("document_id", "source", "title", "author", "date")
+RANGE_FIELDS = ("date_int",)
+
+
+def document_id_for(source: str) -> str:
+    """
+    Document-level ID stamped on every chunk: the file name for file sources,
+    the source itself otherwise (e.g. "summarization:report.pdf").
+    """
+    return os.path.basename(source) if os.path.sep in source else source
+
+
+def date_int(value: str) -> Optional[int]:
+    """
+    Turn an ISO date ("2025-05-06") into a sortable integer (20250506).
+    """
+    try:
+        return int(datetime.date.fromisoformat(str(value)[:10]).strftime("%Y%m%d"))
+    except ValueError:
+        return None
+
+
+def build_filter(document_id: Union[str, List[str], None] = None,
+                 source: Union[str, List[str], None] = None,
+                 title: Union[str, List[str], None] = None,
+                 date_from: Optional[str] = None,
+                 date_to: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Build a metadata filter in Chroma's where syntax, or None when nothing is
+    filtered. The same filter is understood by matches and MetadataIndex, so
+    every retriever applies it identically.
+    """
+    conditions: List[Dict[str, Any]] = []
+    for field, value in (("document_id", document_id), ("source", source), ("title", title)):
+        if value:
+            values = [value] if isinstance(value, str) else list(value)
+            conditions.append({field: values[0]} if len(values) == 1 else {field: {"$in": values}})
+    for op, value in (("$gte", date_from), ("$lte", date_to)):
+        if value:
+            bound = date_int(value)
+            if bound is None:
+                raise ValueError(f"Invalid date: {value} (expected YYYY-MM-DD)")
+            conditions.append({"date_int": {op: bound}})
+
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+
+def _condition_matches(value: Any, condition: Any) -> bool:
+    if not isinstance(condition, dict):
+        return value == condition
+    for op, operand in condition.items():
+        if op == "$eq" and value != operand:
+            return False
+        if op == "$ne" and value == operand:
+            return False
+        if op == "$in" and value not in operand:
+            return False
+        if op == "$nin" and value in operand:
+            return False
+        if op in ("$gt", "$gte", "$lt", "$lte"):
+            if value is None:
+                return False
+            if (op == "$gt" and not value > operand) or (op == "$gte" and not value >= operand) \
+                    or (op == "$lt" and not value < operand) or (op == "$lte" and not value <= operand):
+                return False
+    return True
+
+
+def matches(metadata: Dict[str, Any], where: Optional[Dict[str, Any]]) -> bool:
+    """
+    Evaluate a where filter against one chunk's metadata.
+    """
+    if not where:
+        return True
+    for field, condition in where.items():
+        if field == "$and":
+            if not all(matches(metadata, part) for part in condition):
+                return False
+        elif field == "$or":
+            if not any(matches(metadata, part) for part in condition):
+                return False
+        elif not _condition_matches(metadata.get(field), condition):
+            return False
+    return True
+
+
+class MetadataIndex:
+    """
+    Inverted index from metadata values to chunk keys.
+
+    Resolves a where filter to the set of matching keys before any scoring,
+    using value postings for equality and sorted values for date ranges, so
+    the keyword and compressed indexes only score chunks in scope.
+    """
+
+    def __init__(self):
+        self._values: Dict[str, Dict[Any, Set[Hashable]]] = {field: {} for field in INDEXED_FIELDS}
+        self._ranges: Dict[str, List[tuple]] = {field: [] for field in RANGE_FIELDS}
+        self._lock = threading.Lock()
+
+    def add(self, key: Hashable, metadata: Dict[str, Any]) -> None:
+        with self._lock:
+            for field in INDEXED_FIELDS:
+                if field in metadata:
+                    self._values[field].setdefault(metadata[field], set()).add(key)
+            for field in RANGE_FIELDS:
+                if metadata.get(field) is not None:
+                    bisect.insort(self._ranges[field], (metadata[field], str(key), key))
+
+    def remove(self, key: Hashable, metadata: Dict[str, Any]) -> None:
+        with self._lock:
+            for field in INDEXED_FIELDS:
+                postings = self._values[field].get(metadata.get(field))
+                if postings is not None:
+                    postings.discard(key)
+                    if not postings:
+                        del self._values[field][metadata.get(field)]
+            for field in RANGE_FIELDS:
+                if metadata.get(field) is not None:
+                    entry = (metadata[field], str(key), key)
+                    values = self._ranges[field]
+                    i = bisect.bisect_left(values, entry)
+                    if i < len(values) and values[i] == entry:
+                        del values[i]
+
+    def _select_condition(self, field: str, condition: Any) -> Optional[Set[Hashable]]:
+        if field in self._values:
+            values = self._values[field]
+            if not isinstance(condition, dict):
+                return set(values.get(condition, ()))
+            if set(condition) == {"$eq"}:
+                return set(values.get(condition["$eq"], ()))
+            if set(condition) == {"$in"}:
+                return set().union(*(values.get(v, set()) for v in condition["$in"]))
+        if field in self._ranges and isinstance(condition, dict) \
+                and set(condition) <= {"$gt", "$gte", "$lt", "$lte"}:
+            values = self._ranges[field]
+            low, high = 0, len(values)
+            if "$gte" in condition:
+                low = bisect.bisect_left(values, (condition["$gte"],))
+            if "$gt" in condition:
+                low = max(low, bisect.bisect_right(values, (condition["$gt"], "\uffff")))
+            if "$lte" in condition:
+                high = bisect.bisect_right(values, (condition["$lte"], "\uffff"))
+            if "$lt" in condition:
+                high = min(high, bisect.bisect_left(values, (condition["$lt"],)))
+            return {entry[2] for entry in values[low:high]}
+        # Not indexed: the caller falls back to checking each chunk with matches
+        return None
+
+    def _select(self, where: Dict[str, Any]) -> Optional[Set[Hashable]]:
+        selected: Optional[Set[Hashable]] = None
+        for field, condition in where.items():
+            if field == "$and":
+                part = None
+                for sub in (self._select(p) for p in condition):
+                    if sub is not None:
+                        part = sub if part is None else part & sub
+            elif field == "$or":
+                parts = [self._select(p) for p in condition]
+                part = None if any(p is None for p in parts) else set().union(*parts)
+            else:
+                part = self._select_condition(field, condition)
+            if part is not None:
+                selected = part if selected is None else selected & part
+        return selected
+
+    def select(self, where: Optional[Dict[str, Any]]) -> Optional[Set[Hashable]]:
+        """
+        Keys that may match the filter, or None when the filter cannot be
+        narrowed by the index. Conditions on unindexed fields are left to matches.
+        """
+        if not where:
+            return None
+        with self._lock:
+            return self._select(where)
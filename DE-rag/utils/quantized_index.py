@@ -0,0 +1,346 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain.schema import Document
+
+MODES = ("float32", "float16", "int8")
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """
+    Scale rows to unit length so inner product is cosine similarity.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def quantize(vectors: np.ndarray, mode: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """
+    Compress unit vectors. int8 uses one symmetric scale per vector.
+    Returns (codes, scales); scales is None for the float modes.
+    """
+    if mode == "float32":
+        return vectors.astype(np.float32), None
+    if mode == "float16":
+        return vectors.astype(np.float16), None
+    if mode == "int8":
+        scales = np.abs(vectors).max(axis=1) / 127.0
+        scales = np.maximum(scales, 1e-12).astype(np.float32)
+        codes = np.round(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales
+    raise ValueError(f"Unknown index mode: {mode} (expected one of {', '.join(MODES)})")
+
+
+def approximate_scores(query: np.ndarray, codes: np.ndarray, scales: Optional[np.ndarray],
+                       block_size: int = 16384) -> np.ndarray:
+    """
+    Cosine scores of a unit query against compressed vectors. Codes are widened
+    block by block so a query never holds a float32 copy of the whole index.
+    """
+    scores = np.empty(len(codes), dtype=np.float32)
+    for start in range(0, len(codes), block_size):
+        scores[start:start + block_size] = codes[start:start + block_size].astype(np.float32) @ query
+    return scores * scales if scales is not None else scores
+
+
+def ids_fingerprint(ids: List[str]) -> str:
+    """
+    sha256 over sorted chunk IDs. Chunk IDs hash the chunk's source and text,
+    so two sets of chunks with the same fingerprint hold the same content.
+    """
+    digest = hashlib.sha256()
+    for doc_id in sorted(ids):
+        digest.update(doc_id.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.hexdigest()
+
+
+class QuantizedIndex:
+    """
+    Compressed in-memory copy of a collection's embeddings for dense search.
+
+    Only chunk IDs and the float16 or int8 codes (2x / 4x smaller than
+    float32) are resident; codes are scanned with a single matrix product.
+    The top rescore_k candidates are then re-scored exactly against the
+    float32 vectors, which stay on disk and are memory-mapped, so only
+    candidate rows are paged in. Chunk text and metadata stay in the Chroma
+    collection: filters are resolved there and the k results are fetched by
+    ID, so Chroma's own HNSW index is never loaded. Exposes similarity_search
+    like a Chroma store, so it can stand in for one.
+    """
+
+    # Saved indexes without this format carry text and metadata in RAM and are rebuilt
+    FORMAT = 2
+
+    def __init__(self,
+                 ids: List[str],
+                 codes: np.ndarray,
+                 scales: Optional[np.ndarray],
+                 full: Optional[np.ndarray],
+                 mode: str,
+                 collection: Any = None,
+                 embeddings: Any = None,
+                 rescore_k: int = 50):
+        self.ids = ids
+        self.codes = codes
+        self.scales = scales
+        self.full = full
+        self.mode = mode
+        self.collection = collection
+        self.embeddings = embeddings
+        self.rescore_k = rescore_k
+        self._rows: Optional[Dict[str, int]] = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, vectors: np.ndarray, ids: List[str], mode: str, **kwargs: Any) -> "QuantizedIndex":
+        """
+        Build an index from raw embedding vectors.
+        """
+        full = normalize(vectors) if len(ids) else np.zeros((0, 0), dtype=np.float32)
+        codes, scales = quantize(full, mode)
+        return cls(ids, codes, scales, full, mode, **kwargs)
+
+    @staticmethod
+    def read_collection(collection: Any, page_size: int = 5000) -> Tuple[np.ndarray, List[str]]:
+        """
+        Read every embedding and its chunk ID from a Chroma collection.
+        """
+        ids: List[str] = []
+        vectors: List[np.ndarray] = []
+        offset = 0
+        while True:
+            page = collection.get(include=["embeddings"], limit=page_size, offset=offset)
+            if not page["ids"]:
+                break
+            ids.extend(page["ids"])
+            vectors.append(np.asarray(page["embeddings"], dtype=np.float32))
+            offset += len(page["ids"])
+        matrix = np.vstack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+        return matrix, ids
+
+    @staticmethod
+    def collection_fingerprint(collection: Any, page_size: int = 5000) -> str:
+        """
+        Fingerprint of the chunks stored in a Chroma collection, reading IDs only.
+        """
+        ids: List[str] = []
+        offset = 0
+        while True:
+            page = collection.get(include=[], limit=page_size, offset=offset)
+            if not page["ids"]:
+                break
+            ids.extend(page["ids"])
+            offset += len(page["ids"])
+        return ids_fingerprint(ids)
+
+    def fingerprint(self) -> str:
+        """
+        Fingerprint of the chunks the index was built from.
+        """
+        return ids_fingerprint(self.ids)
+
+    @staticmethod
+    def _paths(directory: str, collection_name: str, mode: str) -> Dict[str, str]:
+        base = os.path.join(directory, f"{collection_name}.quantized")
+        return {
+            "codes": f"{base}.{mode}.npy",
+            "scales": f"{base}.{mode}.scales.npy",
+            "full": f"{base}.float32.npy",
+            "meta": f"{base}.meta.json",
+        }
+
+    def save(self, directory: str, collection_name: str) -> None:
+        """
+        Write codes, full-precision vectors and chunk IDs next to the collection.
+        """
+        paths = self._paths(directory, collection_name, self.mode)
+        np.save(paths["codes"], self.codes)
+        if self.scales is not None:
+            np.save(paths["scales"], self.scales)
+        np.save(paths["full"], np.asarray(self.full, dtype=np.float32))
+        tmp_path = f"{paths['meta']}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"format": self.FORMAT, "ids": self.ids}, f)
+        os.replace(tmp_path, paths["meta"])
+
+    @classmethod
+    def load(cls, directory: str, collection_name: str, mode: str, **kwargs: Any) -> Optional["QuantizedIndex"]:
+        """
+        Load a saved index, or None if it has not been built for this mode
+        (or was saved in an older format).
+        """
+        paths = cls._paths(directory, collection_name, mode)
+        if not (os.path.exists(paths["codes"]) and os.path.exists(paths["meta"])):
+            return None
+        with open(paths["meta"], encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("format") != cls.FORMAT:
+            return None
+        codes = np.load(paths["codes"])
+        scales = np.load(paths["scales"]) if mode == "int8" else None
+        full = np.load(paths["full"], mmap_mode="r") if os.path.exists(paths["full"]) else None
+        return cls(meta["ids"], codes, scales, full, mode, **kwargs)
+
+    def filter_rows(self, where: Optional[Dict[str, Any]]) -> Optional[np.ndarray]:
+        """
+        Rows matching a where filter (Chroma syntax), or None for all rows.
+        The filter is evaluated by the collection, which returns IDs only.
+        """
+        if not where:
+            return None
+        if self._rows is None:
+            self._rows = {doc_id: row for row, doc_id in enumerate(self.ids)}
+        matched = self.collection.get(where=where, include=[])["ids"]
+        return np.fromiter(sorted(self._rows[doc_id] for doc_id in matched if doc_id in self._rows),
+                           dtype=np.int64)
+
+    def search_vector(self, query: np.ndarray, k: int = 4,
+                      rows: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """
+        Top k (row, score) pairs for a query vector, re-scored exactly when
+        possible. rows restricts the search to a pre-filtered subset.
+        """
+        if not len(self.ids) or (rows is not None and not len(rows)):
+            return []
+        query = normalize(query)
+        if rows is None:
+            scores = approximate_scores(query, self.codes, self.scales)
+        else:
+            scores = approximate_scores(query, self.codes[rows],
+                                        self.scales[rows] if self.scales is not None else None)
+        n = min(len(scores), max(k, self.rescore_k))
+        top = np.argpartition(-scores, n - 1)[:n]
+        candidates = top if rows is None else rows[top]
+
+        if self.full is not None and self.mode != "float32":
+            return self._rescore(query, candidates, k)
+
+        order = np.argsort(-scores[top])[:k]
+        return [(int(candidates[i]), float(scores[top[i]])) for i in order]
+
+    def _rescore(self, query: np.ndarray, candidates: np.ndarray, k: int) -> List[Tuple[int, float]]:
+        candidates = np.sort(candidates)
+        scores_exact = np.asarray(self.full[candidates], dtype=np.float32) @ query
+        order = np.argsort(-scores_exact)[:k]
+        return [(int(candidates[i]), float(scores_exact[i])) for i in order]
+
+    def documents_for(self, rows: List[int]) -> List[Document]:
+        """
+        Fetch the text and metadata of rows from the collection, in row order given.
+        """
+        if not rows:
+            return []
+        ids = [self.ids[row] for row in rows]
+        found = self.collection.get(ids=ids, include=["documents", "metadatas"])
+        by_id = {doc_id: (text, metadata) for doc_id, text, metadata
+                 in zip(found["ids"], found["documents"], found["metadatas"])}
+        return [Document(page_content=by_id[doc_id][0], metadata=by_id[doc_id][1] or {})
+                for doc_id in ids if doc_id in by_id]
+
+    def similarity_search(self, query: str, k: int = 4,
+                          filter: Optional[Dict[str, Any]] = None, **kwargs: Any) -> List[Document]:
+        vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        return self.documents_for([row for row, _ in self.search_vector(vector, k, self.filter_rows(filter))])
+
+    def as_retriever(self, search_kwargs: Optional[Dict[str, Any]] = None) -> "QuantizedRetriever":
+        search_kwargs = search_kwargs or {}
+        return QuantizedRetriever(self, search_kwargs.get("k", 4), search_kwargs.get("filter"))
+
+    def memory_bytes(self) -> int:
+        """
+        Resident size: the codes and scales plus the chunk ID strings and the
+        ID-to-row map once a filter has built it. The float32 copy is
+        memory-mapped and only candidate rows are paged in; text and metadata
+        stay in the collection.
+        """
+        size = self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+        size += sys.getsizeof(self.ids) + sum(sys.getsizeof(doc_id) for doc_id in self.ids)
+        if self._rows is not None:
+            size += sys.getsizeof(self._rows)
+        return size
+
+
+class QuantizedRetriever:
+    """
+    invoke/ainvoke retriever over a QuantizedIndex.
+    """
+
+    def __init__(self, index: QuantizedIndex, k: int = 4, metadata_filter: Optional[Dict[str, Any]] = None):
+        self.index = index
+        self.k = k
+        self.metadata_filter = metadata_filter
+
+    def invoke(self, query: str) -> List[Document]:
+        return self.index.similarity_search(query, k=self.k, filter=self.metadata_filter)
+
+    async def ainvoke(self, query: str) -> List[Document]:
+        return await asyncio.to_thread(self.invoke, query)
+
+
+def recall_report(vectors: np.ndarray,
+                  queries: np.ndarray,
+                  k: int = 5,
+                  rescore_k: int = 50,
+                  ids: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """
+    Recall@k of each mode, with and without exact re-scoring, against exact
+    float32 search, alongside the resident memory each mode needs (codes,
+    scales and chunk IDs, see QuantizedIndex.memory_bytes). ids defaults to
+    sha256-length placeholders, the size of real chunk IDs.
+    """
+    full = normalize(vectors)
+    if ids is None:
+        ids = [f"{row:064x}" for row in range(len(full))]
+    queries = normalize(queries)
+    exact = [set(np.argsort(-(full @ q))[:k]) for q in queries]
+
+    rows = []
+    for mode in MODES:
+        codes, scales = quantize(full, mode)
+        for rescore in ((False, True) if mode != "float32" else (False,)):
+            index = QuantizedIndex(ids, codes, scales, full if rescore else None, mode, rescore_k=rescore_k)
+            hits = sum(len(exact[i] & {row for row, _ in index.search_vector(q, k)}) for i, q in enumerate(queries))
+            rows.append({
+                "mode": mode,
+                "rescore": rescore,
+                "recall": hits / (k * len(queries)),
+                "memory_mb": index.memory_bytes() / (1024 * 1024),
+                "bytes_per_vector": index.memory_bytes() / max(len(full), 1),
+            })
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall versus memory for compressed index modes "
+                                                 "(run as: python -m utils.quantized_index)")
+    parser.add_argument("--persist-directory", default="./db/vector_db")
+    parser.add_argument("--collection", default="docs-financial-rag")
+    parser.add_argument("--queries", type=int, default=200, help="stored vectors sampled as queries")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--rescore-k", type=int, default=50)
+    args = parser.parse_args()
+
+    from utils.vector_store_registry import registry
+
+    collection = registry.client(args.persist_directory).get_collection(args.collection)
+    vectors, ids = QuantizedIndex.read_collection(collection)
+    rng = np.random.default_rng(0)
+    # Perturb sampled vectors so a query is close to, but not identical with, a stored chunk
+    sample = vectors[rng.choice(len(vectors), size=min(args.queries, len(vectors)), replace=False)]
+    queries = sample + rng.normal(scale=0.02, size=sample.shape).astype(np.float32)
+
+    print(f"{len(vectors)} vectors x {vectors.shape[1]} dims, recall@{args.k} over {len(queries)} queries")
+    print(f"{'mode':>8} {'rescore':>8} {'recall':>7} {'memory MB':>10} {'bytes/vec':>10}")
+    for row in recall_report(vectors, queries, args.k, args.rescore_k, ids):
+        print(f"{row['mode']:>8} {str(row['rescore']):>8} {row['recall']:>7.3f} "
+              f"{row['memory_mb']:>10.1f} {row['bytes_per_vector']:>10.0f}")
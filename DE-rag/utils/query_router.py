@@ -0,0 +1,112 @@
+import re
+from typing import Any, Callable, Dict, List, Optional
+
+# Words that signal a live market lookup; on their own they are only a weak signal
+LIVE_TERMS = {
+    "price", "prices", "quote", "quotes", "trading", "currently", "live", "market cap",
+    "premarket", "after hours", "intraday", "indices", "dow", "nasdaq", "s&p", "stock price",
+    "share price", "news", "this week", "right now",
+}
+
+# Quote wording that, together with a ticker, means only live market data is needed
+QUOTE_TERMS = {
+    "price", "prices", "quote", "quotes", "market cap", "stock price", "share price",
+    "trading", "premarket", "after hours", "intraday",
+}
+
+# Words that signal a question about our uploaded filings and reports
+DOCUMENT_TERMS = {
+    "report", "reports", "filing", "filings", "10-k", "10-q", "annual report", "document",
+    "documents", "according to", "uploaded", "summary", "summarize", "fiscal", "footnote",
+    "management discussion", "md&a", "balance sheet", "cash flow", "income statement",
+    "guidance", "segment", "risk factors", "auditor",
+}
+
+# Words that ask for news, which only SerpAPI provides
+NEWS_TERMS = {
+    "news", "headline", "headlines", "latest", "announcement", "announced", "announces",
+}
+
+# Upper-case words that look like tickers but are not
+NOT_TICKERS = {
+    "I", "A", "AN", "THE", "AND", "OR", "OF", "IN", "ON", "IS", "IT", "TO", "FOR", "Q1", "Q2",
+    "Q3", "Q4", "FY", "YOY", "QOQ", "EPS", "CEO", "CFO", "USD", "EUR", "GBP", "PKR", "ETF", "IPO",
+    "GDP", "CPI", "SEC", "PE", "P", "E", "AI", "US", "USA", "UK", "EU", "HTML", "API", "ROI",
+    "ROE", "EBIT", "EBITDA", "NAV", "YTD", "MD",
+}
+
+_DOLLAR_TICKER = re.compile(r"\$([A-Za-z]{1,5})\b")
+# Bare symbols need two letters and must not be part of "10-K" or "S&P" style tokens
+_CAPS_TICKER = re.compile(r"(?<![\w&$-])([A-Z]{2,5})(?:[.:][A-Z]{1,6})?(?![\w&-])")
+
+
+def detect_tickers(question: str) -> List[str]:
+    """
+    Find ticker symbols in a question: $-prefixed symbols and short all-caps words.
+    Single-letter symbols are only recognised with a $ prefix.
+    """
+    tickers = [t.upper() for t in _DOLLAR_TICKER.findall(question)]
+    for word in _CAPS_TICKER.findall(question):
+        if word not in NOT_TICKERS and word not in tickers:
+            tickers.append(word)
+    return tickers
+
+
+def _matches(text: str, terms: set) -> List[str]:
+    return sorted(term for term in terms if re.search(r"(?<!\w)" + re.escape(term) + r"(?!\w)", text))
+
+
+class QueryRouter:
+    """
+    Cheap local router that decides which context sources a question needs.
+
+    Rules and ticker detection run first. When they point at only one source
+    that source is used alone; when they are ambiguous an optional classifier
+    (question -> {"vector_db": p, "serpapi": p}) decides, and without one both
+    sources are kept, which matches the behaviour before routing.
+    """
+
+    def __init__(self,
+                 classifier: Optional[Callable[[str], Dict[str, float]]] = None,
+                 classifier_threshold: float = 0.5):
+        self.classifier = classifier
+        self.classifier_threshold = classifier_threshold
+
+    def route(self, question: str) -> Dict[str, Any]:
+        """
+        Return {"vector_db": bool, "serpapi": bool, "tickers": [...], "wants_news": bool,
+        "reason": str} plus the matched terms.
+        """
+        text = question.lower()
+        tickers = detect_tickers(question)
+        live = _matches(text, LIVE_TERMS)
+        documents = _matches(text, DOCUMENT_TERMS)
+
+        quote = _matches(text, QUOTE_TERMS)
+
+        # Neither a ticker alone ("AAPL revenue growth") nor words like "current" or
+        # "latest" ("Apple's current ratio") rule out the filings, so only a ticker
+        # asked about with quote wording skips the document search
+        if tickers and quote and not documents:
+            decision = {"vector_db": False, "serpapi": True, "reason": "ticker quote"}
+        elif documents and not (live or tickers):
+            decision = {"vector_db": True, "serpapi": False, "reason": "document terms"}
+        elif self.classifier is not None:
+            try:
+                scores = self.classifier(question)
+                decision = {
+                    "vector_db": scores.get("vector_db", 1.0) >= self.classifier_threshold,
+                    "serpapi": scores.get("serpapi", 1.0) >= self.classifier_threshold,
+                    "reason": "classifier",
+                }
+                if not (decision["vector_db"] or decision["serpapi"]):
+                    decision = {"vector_db": True, "serpapi": True, "reason": "classifier undecided"}
+            except Exception as e:
+                print(f"Query classifier error: {str(e)}")
+                decision = {"vector_db": True, "serpapi": True, "reason": "classifier error"}
+        else:
+            decision = {"vector_db": True, "serpapi": True, "reason": "ambiguous, using all sources"}
+
+        decision.update(tickers=tickers, live_terms=live, document_terms=documents,
+                        wants_news=bool(_matches(text, NEWS_TERMS)))
+        return decision
@@ -1,29 +1,100 @@
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List, Callable, Iterator, AsyncIterator, Awaitable
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from langchain.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.runnables import RunnablePassthrough, RunnableLambda
 from langchain_community.vectorstores import Chroma
 from langchain.chat_models import ChatOpenAI
-import requests
 import os
 import json
+import time
+import asyncio
+import threading
 from dotenv import load_dotenv
+from utils.api_key_cache import ApiKeyCache
+from utils.ttl_cache import StaleWhileRevalidateCache
+from utils.http_client import finance_http, async_finance_http, request_deadline
+from utils.market_snapshot import MarketIndexSnapshot
+from utils.context_packer import pack_context
+from utils.query_router import QueryRouter, detect_tickers
+from utils.local_market_data import LocalMarketData
+from utils.sparse_index import SparseIndex, HybridRetriever
+from utils.vector_db import load_sparse_index, load_quantized_index, COMPRESSED_INDEX
 
 # Load environment variables from .env file
 load_dotenv()
 
 
+# All SerpAPI engines share one endpoint; overridable to point at a local stub server
+SERPAPI_URL = os.environ.get('SERPAPI_URL', "https://serpapi.com/search.json")
+
+# Per-source deadlines (seconds) for the concurrent context-gathering stage.
+# A source that misses its deadline is dropped and the prompt gets partial context.
+DEFAULT_SOURCE_TIMEOUTS = {
+    "vector_db": 6.0,
+    "serpapi_validate": 8.0,
+    "serpapi_markets": 8.0,
+    "serpapi_stock": 8.0,
+    "local_market": 3.0,
+}
+
+# Shared pool for context sources; sized for a handful of sources per in-flight question.
+# Under batch load sources queue for a worker, and that wait does not count against their
+# deadlines; a source still queued after CONTEXT_QUEUE_TIMEOUT seconds is dropped.
+_context_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('CONTEXT_WORKERS', 16)),
+    thread_name_prefix="context-source"
+)
+# Sources that call out to SerpAPI get their own pool, so a slow upstream cannot
+# occupy the workers that local sources such as vector_db need
+NETWORK_SOURCES = {"serpapi_validate", "serpapi_markets", "serpapi_stock"}
+_network_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get('CONTEXT_NETWORK_WORKERS', 16)),
+    thread_name_prefix="context-network"
+)
+CONTEXT_QUEUE_TIMEOUT = float(os.environ.get('CONTEXT_QUEUE_TIMEOUT', 30))
+
+
+# Recent latency (EWMA, seconds) of each context source, used to estimate the
+# time saved when the query router skips sources
+_source_latency: Dict[str, float] = {}
+_latency_lock = threading.Lock()
+
+
+def record_source_latency(name: str, seconds: float, alpha: float = 0.2) -> None:
+    """
+    Fold one observed context-source latency into its moving average.
+    """
+    with _latency_lock:
+        previous = _source_latency.get(name)
+        _source_latency[name] = seconds if previous is None else (1 - alpha) * previous + alpha * seconds
+
+
+def estimate_routing_savings(planned: List[str], kept: List[str]) -> float:
+    """
+    Estimate wall time saved by running only the kept sources. Sources run in
+    parallel, so the saving is the slowest planned source minus the slowest kept one.
+    """
+    with _latency_lock:
+        slowest_planned = max((_source_latency.get(name, 0.0) for name in planned), default=0.0)
+        slowest_kept = max((_source_latency.get(name, 0.0) for name in kept), default=0.0)
+    return round(max(0.0, slowest_planned - slowest_kept), 3)
+
+
+def resolve_serpapi_key(api_key: Optional[str] = None) -> str:
+    """
+    Return the SerpAPI key to use, falling back to the environment.
+    """
+    return api_key or os.environ.get('SERP_API_KEY',
+                                     "1680d06ead92d9a969fb3706eb7c0d5e60faa82843e76ac168993a44695eddd0")
+
+
 def validate_api_key(api_key: str) -> bool:
     """
     Validate the SerpAPI key by making a simple request.
     """
     try:
-        params = {
-            "engine": "google",
-            "q": "test",
-            "api_key": api_key
-        }
-        response = requests.get("https://serpapi.com/search.json", params=params, timeout=10)
+        response = finance_http.get(SERPAPI_URL, params=_validate_params(api_key), timeout=10)
         response.raise_for_status()
         data = json.loads(response.text)
         return "error" not in data
@@ -31,100 +102,443 @@ def validate_api_key(api_key: str) -> bool:
         return False
 
 
-def fetch_serpapi_finance_data(query: str, api_key: Optional[str] = None) -> Dict[str, Any]:
+async def avalidate_api_key(api_key: str) -> bool:
     """
-    Fetch Google Finance data using SerpAPI, combining multiple endpoints for comprehensive data.
+    Async variant of validate_api_key.
     """
-    api_key = api_key or os.environ.get('SERP_API_KEY',
-                                        "1680d06ead92d9a969fb3706eb7c0d5e60faa82843e76ac168993a44695eddd0")
+    try:
+        response = await async_finance_http.get(SERPAPI_URL, params=_validate_params(api_key), timeout=10)
+        response.raise_for_status()
+        data = json.loads(response.text)
+        return "error" not in data
+    except Exception:
+        return False
 
-    if not api_key or not validate_api_key(api_key):
-        print(f"API key validation failed")
-        return {"error": "Invalid or inactive API key"}
 
+# SerpAPI key validity is shared by every request and thread; a key is only
+# checked again after the TTL or after a real endpoint rejects it.
+api_key_cache = ApiKeyCache(
+    validate_api_key,
+    ttl=float(os.environ.get('SERPAPI_KEY_CACHE_TTL', 3600))
+)
+
+
+def is_auth_failure(response: Any) -> bool:
+    """
+    Check whether a SerpAPI response was rejected because of the API key.
+    """
+    if response.status_code in (401, 403):
+        return True
+    try:
+        error = str(json.loads(response.text).get("error", ""))
+    except Exception:
+        return False
+    return "api key" in error.lower()
+
+
+def _validate_params(api_key: str) -> Dict[str, str]:
+    return {
+        "engine": "google",
+        "q": "test",
+        "api_key": api_key
+    }
+
+
+def _markets_params(query: str, api_key: str) -> Dict[str, str]:
+    return {
+        "engine": "google_finance_markets",
+        "q": query,
+        "trend": "indexes",
+        "hl": "en",
+        "api_key": api_key
+    }
+
+
+def _stock_params(query: str, api_key: str) -> Dict[str, str]:
+    return {
+        "engine": "google_finance",
+        "q": query,
+        "api_key": api_key
+    }
+
+
+def parse_market_indices(markets_data: Dict[str, Any]) -> List[Dict[str, str]]:
+    """
+    Extract the US market indices from a google_finance_markets response.
+    """
+    market_data = []
+    markets = markets_data.get("markets", {})
+    for region in markets.get("us", []):
+        name = str(region.get("name", "N/A"))
+        price = str(region.get("price", "N/A"))
+        movement = region.get("price_movement", {})
+        percentage = str(movement.get("percentage", "N/A"))
+        value = str(movement.get("value", "N/A"))
+        market_data.append({
+            "name": name,
+            "price": price,
+            "percentage": percentage,
+            "value": value
+        })
+    return market_data
+
+
+def parse_stock_quote(stock_data: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Extract quote, recent price points and news from a google_finance response.
+    """
     result_data = {
-        "market_data": [],
         "stock_data": [],
         "news": []
     }
 
-    # Fetch markets data for broader context
-    try:
-        markets_url = "https://serpapi.com/search.json"
-        markets_params = {
-            "engine": "google_finance_markets",
-            "q": query,
-            "trend": "indexes",
-            "hl": "en",
-            "api_key": api_key
-        }
-        markets_response = requests.get(markets_url, params=markets_params, timeout=10)
-        markets_response.raise_for_status()
-        markets_data = json.loads(markets_response.text)
-
-        # Extract market indices
-        markets = markets_data.get("markets", {})
-        for region in markets.get("us", []):
-            name = str(region.get("name", "N/A"))
-            price = str(region.get("price", "N/A"))
-            movement = region.get("price_movement", {})
-            percentage = str(movement.get("percentage", "N/A"))
-            value = str(movement.get("value", "N/A"))
-            result_data["market_data"].append({
-                "name": name,
-                "price": price,
-                "percentage": percentage,
-                "value": value
+    # Extract stock information
+    summary = stock_data.get("summary", {})
+    if summary:
+        result_data["stock_data"].append({
+            "title": summary.get("title", "N/A"),
+            "price": summary.get("price", "N/A"),
+            "change": summary.get("change", "N/A"),
+            "percentage": summary.get("percentage", "N/A"),
+            "timestamp": summary.get("extracted_on", "N/A")
+        })
+
+        # Extract graph data points if available
+        graph = stock_data.get("graph", {})
+        data_points = graph.get("data_points", [])
+        if data_points:
+            # Get last 5 data points for trend analysis
+            recent_points = data_points[-5:] if len(data_points) > 5 else data_points
+            result_data["stock_data"].append({
+                "recent_points": recent_points
             })
+
+    # Extract news if available
+    news_items = stock_data.get("news", [])
+    for item in news_items[:3]:
+        result_data["news"].append({
+            "title": item.get("title", "N/A"),
+            "source": item.get("source", "N/A"),
+            "date": item.get("date", "N/A"),
+            "snippet": item.get("snippet", "N/A")
+        })
+
+    return result_data
+
+
+def _finance_payload(response: Any, api_key: str) -> Dict[str, Any]:
+    if is_auth_failure(response):
+        api_key_cache.report_auth_failure(api_key)
+    response.raise_for_status()
+    return json.loads(response.text)
+
+
+def fetch_market_indices(query: str, api_key: str) -> List[Dict[str, str]]:
+    """
+    Fetch the US market index table from the google_finance_markets endpoint.
+    """
+    try:
+        response = finance_http.get(SERPAPI_URL, params=_markets_params(query, api_key), timeout=10)
+        return parse_market_indices(_finance_payload(response, api_key))
     except Exception as e:
         print(f"Error fetching markets data: {str(e)}")
+        return []
+
 
-    # Fetch specific stock data if the query looks like a stock query
+async def afetch_market_indices(query: str, api_key: str) -> List[Dict[str, str]]:
+    """
+    Async variant of fetch_market_indices.
+    """
     try:
-        stock_url = "https://serpapi.com/search.json"
-        stock_params = {
-            "engine": "google_finance",
-            "q": query,
-            "api_key": api_key
-        }
-        stock_response = requests.get(stock_url, params=stock_params, timeout=10)
-        stock_response.raise_for_status()
-        stock_data = json.loads(stock_response.text)
+        response = await async_finance_http.get(SERPAPI_URL, params=_markets_params(query, api_key), timeout=10)
+        return parse_market_indices(_finance_payload(response, api_key))
+    except Exception as e:
+        print(f"Error fetching markets data: {str(e)}")
+        return []
 
-        # Extract stock information
-        summary = stock_data.get("summary", {})
-        if summary:
-            result_data["stock_data"].append({
-                "title": summary.get("title", "N/A"),
-                "price": summary.get("price", "N/A"),
-                "change": summary.get("change", "N/A"),
-                "percentage": summary.get("percentage", "N/A"),
-                "timestamp": summary.get("extracted_on", "N/A")
-            })
 
-            # Extract graph data points if available
-            graph = stock_data.get("graph", {})
-            data_points = graph.get("data_points", [])
-            if data_points:
-                # Get last 5 data points for trend analysis
-                recent_points = data_points[-5:] if len(data_points) > 5 else data_points
-                result_data["stock_data"].append({
-                    "recent_points": recent_points
-                })
-
-        # Extract news if available
-        news_items = stock_data.get("news", [])
-        for item in news_items[:3]:
-            result_data["news"].append({
-                "title": item.get("title", "N/A"),
-                "source": item.get("source", "N/A"),
-                "date": item.get("date", "N/A"),
-                "snippet": item.get("snippet", "N/A")
-            })
+def fetch_stock_quote(query: str, api_key: str) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Fetch quote, recent price points and news from the google_finance endpoint.
+    """
+    try:
+        response = finance_http.get(SERPAPI_URL, params=_stock_params(query, api_key), timeout=10)
+        return parse_stock_quote(_finance_payload(response, api_key))
     except Exception as e:
         print(f"Error fetching stock data: {str(e)}")
+        return {"stock_data": [], "news": []}
 
-    return result_data
+
+async def afetch_stock_quote(query: str, api_key: str) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Async variant of fetch_stock_quote.
+    """
+    try:
+        response = await async_finance_http.get(SERPAPI_URL, params=_stock_params(query, api_key), timeout=10)
+        return parse_stock_quote(_finance_payload(response, api_key))
+    except Exception as e:
+        print(f"Error fetching stock data: {str(e)}")
+        return {"stock_data": [], "news": []}
+
+
+# Finance data is shared across questions; expired entries are served stale while
+# a background refresh runs, so repeated tickers stay off the outbound hot path.
+finance_cache = StaleWhileRevalidateCache(
+    ttls={
+        "market_indices": float(os.environ.get('FINANCE_CACHE_INDICES_TTL', 60)),
+        "quote": float(os.environ.get('FINANCE_CACHE_QUOTE_TTL', 30)),
+        "news": float(os.environ.get('FINANCE_CACHE_NEWS_TTL', 600)),
+    },
+    max_bytes=int(os.environ.get('FINANCE_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+)
+
+
+# The US index table is the same for every question, so the RAG API keeps it
+# refreshed in the background and the chain reads it without any I/O.
+market_snapshot = MarketIndexSnapshot(
+    lambda: fetch_market_indices("market indexes", resolve_serpapi_key()),
+    interval=float(os.environ.get('MARKET_SNAPSHOT_INTERVAL', 60))
+)
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalize a question or ticker into a cache key.
+    """
+    return " ".join(query.lower().strip().rstrip("?!.").split())
+
+
+def cached_market_indices(query: str, api_key: str) -> List[Dict[str, str]]:
+    """
+    Market indices through the finance cache. The US index table does not depend
+    on the question, so every query shares one entry.
+    """
+    return finance_cache.get_or_load("market_indices", "us",
+                                     lambda: fetch_market_indices(query, api_key))
+
+
+def stock_quote_key(query: str) -> str:
+    """
+    What a stock quote is fetched and cached by: the ticker when the question
+    names exactly one, so every question about it shares one entry, otherwise
+    the normalized question.
+    """
+    tickers = detect_tickers(query)
+    return tickers[0] if len(tickers) == 1 else normalize_query(query)
+
+
+# Cache kind -> field of the fetch_stock_quote result it holds
+_STOCK_FIELDS = {"quote": "stock_data", "news": "news"}
+
+
+def cached_stock_quote(query: str, api_key: str) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Quote and news through the finance cache. Both come from one google_finance
+    call, so loading either kind stores the other as well.
+    """
+    key = stock_quote_key(query)
+
+    def load(kind: str, other: str):
+        def loader():
+            data = fetch_stock_quote(key, api_key)
+            finance_cache.put(other, key, data[_STOCK_FIELDS[other]])
+            return data[_STOCK_FIELDS[kind]]
+        return loader
+
+    return {
+        "stock_data": finance_cache.get_or_load("quote", key, load("quote", "news")),
+        "news": finance_cache.get_or_load("news", key, load("news", "quote")),
+    }
+
+
+async def acached_market_indices(query: str, api_key: str) -> List[Dict[str, str]]:
+    """
+    Async variant of cached_market_indices.
+    """
+    return await finance_cache.aget_or_load("market_indices", "us",
+                                            lambda: afetch_market_indices(query, api_key))
+
+
+async def acached_stock_quote(query: str, api_key: str) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Async variant of cached_stock_quote.
+    """
+    key = stock_quote_key(query)
+
+    def load(kind: str, other: str):
+        async def loader():
+            data = await afetch_stock_quote(key, api_key)
+            finance_cache.put(other, key, data[_STOCK_FIELDS[other]])
+            return data[_STOCK_FIELDS[kind]]
+        return loader
+
+    return {
+        "stock_data": await finance_cache.aget_or_load("quote", key, load("quote", "news")),
+        "news": await finance_cache.aget_or_load("news", key, load("news", "quote")),
+    }
+
+
+def gather_context_sources(sources: Dict[str, Callable[[], Any]],
+                           timeouts: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+    """
+    Run every context source concurrently and collect the ones that finish in time.
+
+    Each deadline is measured from when its source starts running on the
+    shared pool, so time spent queued behind other questions' sources (e.g.
+    during a batch) does not use it up. The deadline is also the source's
+    request_deadline, so its HTTP calls time out and stop retrying with it
+    instead of holding a worker after it has been given up on. Sources that
+    fail, miss their deadline or never get a worker within
+    CONTEXT_QUEUE_TIMEOUT are left out of the result.
+    """
+    timeouts = {**DEFAULT_SOURCE_TIMEOUTS, **(timeouts or {})}
+    started = time.monotonic()
+    running = {name: threading.Event() for name in sources}
+    started_at: Dict[str, float] = {}
+
+    def run(name: str, fn: Callable[[], Any]) -> Any:
+        started_at[name] = time.monotonic()
+        running[name].set()
+        # Pool threads are reused, so the deadline is reset once the source returns
+        token = request_deadline.set(started_at[name] + timeouts.get(name, max(DEFAULT_SOURCE_TIMEOUTS.values())))
+        try:
+            return fn()
+        finally:
+            request_deadline.reset(token)
+
+    futures = {
+        name: (_network_executor if name in NETWORK_SOURCES else _context_executor).submit(run, name, fn)
+        for name, fn in sources.items()
+    }
+    for name, future in futures.items():
+        future.add_done_callback(
+            lambda f, name=name: f.cancelled() or record_source_latency(name, time.monotonic() - started_at[name]))
+
+    results = {}
+    for name, future in futures.items():
+        if not running[name].wait(timeout=max(0.0, started + CONTEXT_QUEUE_TIMEOUT - time.monotonic())):
+            if future.cancel():
+                print(f"Context source '{name}' waited {CONTEXT_QUEUE_TIMEOUT}s for a worker, continuing without it")
+                continue
+            running[name].wait()
+        deadline = started_at[name] + timeouts.get(name, max(DEFAULT_SOURCE_TIMEOUTS.values()))
+        try:
+            results[name] = future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except FutureTimeoutError:
+            future.cancel()
+            print(f"Context source '{name}' missed its {timeouts.get(name)}s deadline, continuing without it")
+        except Exception as e:
+            print(f"Context source '{name}' failed: {str(e)}")
+
+    print(f"Context sources gathered in {time.monotonic() - started:.2f}s: {sorted(results)}")
+    return results
+
+
+async def agather_context_sources(sources: Dict[str, Callable[[], Awaitable[Any]]],
+                                  timeouts: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+    """
+    Async variant of gather_context_sources; sources are coroutine factories
+    run as tasks on the current event loop.
+    """
+    timeouts = {**DEFAULT_SOURCE_TIMEOUTS, **(timeouts or {})}
+    started = time.monotonic()
+
+    async def run(name: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        # Each task runs in its own copy of the context, so this does not leak
+        request_deadline.set(started + timeouts.get(name, max(DEFAULT_SOURCE_TIMEOUTS.values())))
+        return await fn()
+
+    tasks = {name: asyncio.ensure_future(run(name, fn)) for name, fn in sources.items()}
+    for name, task in tasks.items():
+        task.add_done_callback(
+            lambda t, name=name: t.cancelled() or record_source_latency(name, time.monotonic() - started))
+
+    results = {}
+    for name, task in tasks.items():
+        deadline = started + timeouts.get(name, max(DEFAULT_SOURCE_TIMEOUTS.values()))
+        try:
+            results[name] = await asyncio.wait_for(task, timeout=max(0.0, deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            print(f"Context source '{name}' missed its {timeouts.get(name)}s deadline, continuing without it")
+        except Exception as e:
+            print(f"Context source '{name}' failed: {str(e)}")
+
+    print(f"Context sources gathered in {time.monotonic() - started:.2f}s: {sorted(results)}")
+    return results
+
+
+def serpapi_sources(query: str, api_key: str, include_markets: bool = True) -> Dict[str, Callable[[], Any]]:
+    """
+    Build the SerpAPI context sources for a query, ready for gather_context_sources.
+    """
+    sources = {
+        "serpapi_validate": lambda: api_key_cache.is_valid(api_key),
+        "serpapi_stock": lambda: cached_stock_quote(query, api_key),
+    }
+    if include_markets:
+        sources["serpapi_markets"] = lambda: cached_market_indices(query, api_key)
+    return sources
+
+
+def aserpapi_sources(query: str, api_key: str,
+                     include_markets: bool = True) -> Dict[str, Callable[[], Awaitable[Any]]]:
+    """
+    Async variant of serpapi_sources, ready for agather_context_sources.
+    """
+    sources = {
+        "serpapi_validate": lambda: api_key_cache.ais_valid(api_key, avalidate_api_key),
+        "serpapi_stock": lambda: acached_stock_quote(query, api_key),
+    }
+    if include_markets:
+        sources["serpapi_markets"] = lambda: acached_market_indices(query, api_key)
+    return sources
+
+
+def merge_serpapi_results(results: Dict[str, Any],
+                          snapshot: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    Combine gathered SerpAPI source results into the fetch_serpapi_finance_data shape.
+    A market index snapshot, when given, replaces the per-question index fetch, and
+    local quotes (the "local_market" source) come before any SerpAPI quote.
+    """
+    local = results.get("local_market") or {}
+
+    # Only an explicit failed validation discards the data; a slow validation
+    # is not evidence of a bad key when the data endpoints answered.
+    if results.get("serpapi_validate") is False:
+        print(f"API key validation failed")
+        if not local.get("stock_data"):
+            return {"error": "Invalid or inactive API key"}
+        results = {"local_market": local}
+
+    stock = results.get("serpapi_stock") or {}
+    merged = {
+        "market_data": results.get("serpapi_markets") or [],
+        "stock_data": local.get("stock_data", []) + stock.get("stock_data", []),
+        "news": stock.get("news", [])
+    }
+    if snapshot:
+        merged["market_data"] = snapshot["market_data"]
+        merged["market_as_of"] = snapshot["as_of"]
+    return merged
+
+
+def fetch_serpapi_finance_data(query: str,
+                               api_key: Optional[str] = None,
+                               timeouts: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+    """
+    Fetch Google Finance data using SerpAPI, combining multiple endpoints for comprehensive data.
+    The key check (usually a cache hit) and both finance endpoints are requested concurrently.
+    """
+    api_key = resolve_serpapi_key(api_key)
+
+    if not api_key:
+        print(f"API key validation failed")
+        return {"error": "Invalid or inactive API key"}
+
+    snapshot = market_snapshot.latest()
+    results = gather_context_sources(serpapi_sources(query, api_key, include_markets=snapshot is None), timeouts)
+    return merge_serpapi_results(results, snapshot)
 
 
 def format_serpapi_data(data: Dict[str, Any]) -> str:
@@ -138,7 +552,10 @@ def format_serpapi_data(data: Dict[str, Any]) -> str:
 
     # Format market data
     if data["market_data"]:
-        result.append("## Market Data")
+        if data.get("market_as_of"):
+            result.append(f"## Market Data (as of {data['market_as_of']})")
+        else:
+            result.append("## Market Data")
         for item in data["market_data"]:
             result.append(f"- {item['name']}: ${item['price']} ({item['percentage']}% {item['value']})")
 
@@ -164,14 +581,45 @@ def format_serpapi_data(data: Dict[str, Any]) -> str:
     return "\n".join(result) if result else "No financial data found."
 
 
+def load_dense_store(vector_db: Chroma) -> Any:
+    """
+    Store that serves dense search for vector_db: its compressed index when
+    COMPRESSED_INDEX is set (so Chroma's own HNSW is never loaded), the
+    Chroma store itself otherwise or if the compressed index is unavailable.
+    """
+    persist_directory = getattr(vector_db, '_persist_directory', None)
+    if COMPRESSED_INDEX and persist_directory:
+        return load_quantized_index(vector_db, persist_directory, vector_db._collection.name,
+                                    COMPRESSED_INDEX) or vector_db
+    return vector_db
+
+
 def create_rag_chain(vector_db: Chroma,
                      model_name: str = "gpt-4o-mini",
                      max_length: int = 500,
                      top_k: int = 4,
-                     serpapi_key: Optional[str] = None) -> Any:
+                     serpapi_key: Optional[str] = None,
+                     source_timeouts: Optional[Dict[str, float]] = None,
+                     context_token_budget: Optional[int] = None,
+                     router: Optional[QueryRouter] = None,
+                     local_market: Optional[LocalMarketData] = None,
+                     sparse_index: Optional[SparseIndex] = None,
+                     dense_store: Any = None) -> Any:
     """
     Create an enhanced RAG chain with SerpAPI Google Finance integration.
+    source_timeouts overrides the per-source deadlines in DEFAULT_SOURCE_TIMEOUTS;
+    context_token_budget caps the retrieved context (CONTEXT_TOKEN_BUDGET by default);
+    router decides which sources each question needs (QUERY_ROUTING=0 disables it);
+    local_market, when given, quotes known symbols before SerpAPI is asked;
+    sparse_index enables hybrid BM25 + vector retrieval and is loaded from the
+    collection's directory when not given (HYBRID_RETRIEVAL=0 disables it);
+    dense_store is the store dense search runs on (load_dense_store by default).
     """
+    if context_token_budget is None:
+        context_token_budget = int(os.environ.get('CONTEXT_TOKEN_BUDGET', 2000))
+    if router is None and os.environ.get('QUERY_ROUTING', '1') != '0':
+        router = QueryRouter()
+
     llm = ChatOpenAI(
         model=model_name,
         temperature=0.2,
@@ -179,7 +627,35 @@ def create_rag_chain(vector_db: Chroma,
         openai_api_key=os.environ.get('OPENAI_API_KEY', '')
     )
 
-    retriever = vector_db.as_retriever(search_kwargs={"k": top_k})
+    persist_directory = getattr(vector_db, '_persist_directory', None)
+    if sparse_index is None and persist_directory and os.environ.get('HYBRID_RETRIEVAL', '1') != '0':
+        sparse_index = load_sparse_index(persist_directory, vector_db._collection.name)
+    # Dense search runs on the compressed index when COMPRESSED_INDEX is set
+    if dense_store is None:
+        dense_store = load_dense_store(vector_db)
+    use_hybrid = sparse_index is not None and len(sparse_index) > 0
+    if use_hybrid:
+        # Sparse hits are resolved to text, metadata and filters through the collection
+        sparse_index.collection = vector_db._collection
+        stored = vector_db._collection.count()
+        if len(sparse_index) != stored:
+            # A partial index would skew the fusion towards the chunks it covers;
+            # the next ingestion backfills it
+            print(f"Keyword index covers {len(sparse_index)} of {stored} chunks, using vector retrieval only")
+            use_hybrid = False
+    if use_hybrid:
+        print(f"Using hybrid BM25 + vector retrieval over {len(sparse_index)} chunks")
+
+    def make_retriever(metadata_filter: Optional[Dict[str, Any]] = None) -> Any:
+        # The filter (Chroma where syntax) is applied before the similarity search
+        if use_hybrid:
+            return HybridRetriever(dense_store, sparse_index, k=top_k, metadata_filter=metadata_filter)
+        search_kwargs = {"k": top_k}
+        if metadata_filter:
+            search_kwargs["filter"] = metadata_filter
+        return dense_store.as_retriever(search_kwargs=search_kwargs)
+
+    retriever = make_retriever()
 
     template = """You are an advanced financial assistant providing accurate, actionable insights. Your goal is to deliver clear, structured information that is directly viewable and easy to understand.
 
@@ -229,35 +705,116 @@ def create_rag_chain(vector_db: Chroma,
 
     prompt = ChatPromptTemplate.from_template(template)
 
-    def fetch_combined_context(inputs: Dict[str, Any]) -> Dict[str, Any]:
+    def plan_sources(question: str, use_async: bool, metadata_filter: Optional[Dict[str, Any]] = None):
+        # Route first, then build only the sources the question needs
+        if router is not None:
+            routing = router.route(question)
+        else:
+            routing = {"vector_db": True, "serpapi": True, "reason": "routing disabled",
+                       "tickers": detect_tickers(question), "wants_news": True}
+
+        # A question scoped to documents always searches them, and only them
+        scoped = make_retriever(metadata_filter) if metadata_filter else retriever
+        if metadata_filter:
+            routing["vector_db"] = True
+            routing["metadata_filter"] = metadata_filter
+
+        api_key = resolve_serpapi_key(serpapi_key)
+        snapshot = market_snapshot.latest()
+        planned = {}
+        if use_async:
+            planned["vector_db"] = lambda: scoped.ainvoke(question)
+            if api_key:
+                planned.update(aserpapi_sources(question, api_key, include_markets=snapshot is None))
+        else:
+            planned["vector_db"] = lambda: scoped.invoke(question)
+            if api_key:
+                planned.update(serpapi_sources(question, api_key, include_markets=snapshot is None))
+
+        # Symbols held in stock_data_polygone are quoted locally; SerpAPI's quote call
+        # is only kept for unknown symbols, no symbols at all, or when news is asked for
+        tickers = routing.get("tickers", [])
+        local_symbols = [t for t in tickers if local_market is not None and local_market.has_symbol(t)]
+        remote_quote = not tickers or len(local_symbols) < len(tickers) or routing.get("wants_news", True)
+        routing["local_symbols"] = local_symbols
+
+        context_sources = {}
+        if routing["vector_db"]:
+            context_sources["vector_db"] = planned["vector_db"]
+        if routing["serpapi"]:
+            if local_symbols:
+                if use_async:
+                    context_sources["local_market"] = lambda: asyncio.to_thread(local_market.quotes, local_symbols)
+                else:
+                    context_sources["local_market"] = lambda: local_market.quotes(local_symbols)
+            for name in ("serpapi_stock", "serpapi_markets"):
+                if name in planned and (name != "serpapi_stock" or remote_quote):
+                    context_sources[name] = planned[name]
+            # The key check only matters when a SerpAPI data call goes out
+            if "serpapi_stock" in context_sources or "serpapi_markets" in context_sources:
+                context_sources["serpapi_validate"] = planned["serpapi_validate"]
+
+        routing["skipped"] = sorted(set(planned) - set(context_sources))
+        routing["estimated_seconds_saved"] = estimate_routing_savings(list(planned), list(context_sources))
+        if routing["skipped"]:
+            print(f"Query routing skipped {routing['skipped']} ({routing['reason']})")
+        return context_sources, api_key, snapshot, routing
+
+    def assemble_context(inputs: Dict[str, Any],
+                         context_sources: Dict[str, Any],
+                         results: Dict[str, Any],
+                         snapshot: Optional[Dict[str, Any]],
+                         api_key: str,
+                         routing: Dict[str, Any],
+                         context_seconds: float) -> Dict[str, Any]:
         question = str(inputs["question"])
         context = ""
 
-        # First retrieve information from vector database
-        try:
-            context_docs = retriever.invoke(question)
+        packing = None
+        if "vector_db" in results:
+            context_docs = results["vector_db"]
             if isinstance(context_docs, list) and context_docs:
-                context = "\n".join(
-                    [str(doc.page_content) if hasattr(doc, 'page_content') else str(doc) for doc in context_docs]
-                )
+                # Drop overlapping spans between chunks and keep the prompt under budget
+                context, packing = pack_context(context_docs, context_token_budget)
+                print(f"Context packed: {packing['chunks_used']}/{packing['chunks_retrieved']} chunks, "
+                      f"{packing['tokens_saved']} tokens saved")
             elif isinstance(context_docs, str):
                 context = context_docs
 
             print(f"Vector DB context retrieved: {len(context)} characters")
-        except Exception as e:
-            print(f"Retriever error: {str(e)}")
+        elif not routing["vector_db"]:
+            context = "Document search was not needed for this question."
+        else:
             context = "Error retrieving context from vector database."
 
-        # Fetch SerpAPI data regardless of context availability for up to date results
-
         serpapi_data = ""
-        try:
-            raw_finance_data = fetch_serpapi_finance_data(question, serpapi_key)
-            serpapi_data = format_serpapi_data(raw_finance_data)
-            print(f"SerpAPI data retrieved: {len(serpapi_data)} characters")
-        except Exception as e:
-            print(f"SerpAPI error: {str(e)}")
-            serpapi_data = "Error retrieving financial data from Google Finance."
+        raw_finance_data = {"error": "Invalid or inactive API key"}
+        if not routing["serpapi"]:
+            serpapi_data = "Live market data was not needed for this question."
+        else:
+            try:
+                if api_key or "local_market" in results:
+                    raw_finance_data = merge_serpapi_results(results, snapshot)
+                serpapi_data = format_serpapi_data(raw_finance_data)
+                print(f"SerpAPI data retrieved: {len(serpapi_data)} characters")
+            except Exception as e:
+                print(f"SerpAPI error: {str(e)}")
+                serpapi_data = "Error retrieving financial data from Google Finance."
+
+        # Callers may pass a dict under "sources" to receive the context-source report,
+        # which is filled in before generation starts (see stream_question)
+        report = inputs.get("sources")
+        if isinstance(report, dict):
+            report.update({
+                "vector_db_used": "vector_db" in results,
+                "serp_api_used": routing["serpapi"] and "error" not in raw_finance_data,
+                "sources_answered": sorted(results),
+                "sources_missed": sorted(set(context_sources) - set(results)),
+                "market_snapshot_as_of": snapshot["as_of"] if snapshot and routing["serpapi"] else None,
+                "context_seconds": round(context_seconds, 3),
+                "context_packing": packing,
+                "routing": routing,
+            })
 
         return {
             "context": str(context),
@@ -266,9 +823,34 @@ def create_rag_chain(vector_db: Chroma,
             "max_length": str(max_length)
         }
 
+    def fetch_combined_context(inputs: Dict[str, Any]) -> Dict[str, Any]:
+        question = str(inputs["question"])
+
+        # The needed sources run concurrently, each with its own deadline
+        context_sources, api_key, snapshot, routing = plan_sources(question, use_async=False,
+                                                                   metadata_filter=inputs.get("filter"))
+        started = time.monotonic()
+        results = gather_context_sources(context_sources, source_timeouts)
+
+        return assemble_context(inputs, context_sources, results, snapshot, api_key, routing,
+                                time.monotonic() - started)
+
+    async def afetch_combined_context(inputs: Dict[str, Any]) -> Dict[str, Any]:
+        question = str(inputs["question"])
+
+        # Same stage on the event loop: async retrieval and async SerpAPI calls
+        context_sources, api_key, snapshot, routing = plan_sources(question, use_async=True,
+                                                                   metadata_filter=inputs.get("filter"))
+        started = time.monotonic()
+        results = await agather_context_sources(context_sources, source_timeouts)
+
+        return assemble_context(inputs, context_sources, results, snapshot, api_key, routing,
+                                time.monotonic() - started)
+
     # Build the chain
+    # invoke/stream use the threaded context stage, ainvoke/astream the async one
     chain = (
-            fetch_combined_context
+            RunnableLambda(fetch_combined_context, afunc=afetch_combined_context)
             | prompt
             | llm
             | StrOutputParser()
@@ -277,16 +859,122 @@ def create_rag_chain(vector_db: Chroma,
     return chain
 
 
-def ask_question(chain: Any, question: str) -> str:
+ERROR_RESPONSE = "I encountered an error while processing your financial query. Please try again with a more specific question about market trends, stock performance, or financial metrics."
+
+
+def ask_question(chain: Any, question: str, sources: Optional[Dict[str, Any]] = None,
+                 metadata_filter: Optional[Dict[str, Any]] = None) -> str:
     """
     Ask a finance question using the enhanced RAG chain.
+    If a sources dict is given it is filled with the context-source report;
+    metadata_filter (see metadata_filter.build_filter) scopes the document search.
     """
     try:
         print(f"Processing question: {question}")
-        response = chain.invoke({"question": question})
+        response = chain.invoke({"question": question, "sources": sources, "filter": metadata_filter})
         return response
     except Exception as e:
         print(f"Error generating response: {str(e)}")
         import traceback
         traceback.print_exc()
-        return "I encountered an error while processing your financial query. Please try again with a more specific question about market trends, stock performance, or financial metrics."
\ No newline at end of file
+        return ERROR_RESPONSE
+
+
+def batch_questions(chain: Any, questions: List[str], max_concurrency: int = 4) -> Iterator[Dict[str, Any]]:
+    """
+    Answer many finance questions through the chain's batch interface.
+
+    Questions that normalize to the same text are answered once. Results are
+    yielded in completion order as {"index", "question", "answer", "sources"},
+    once for every input index.
+    """
+    groups: Dict[str, List[int]] = {}
+    for index, question in enumerate(questions):
+        groups.setdefault(normalize_query(question), []).append(index)
+    unique = list(groups.values())
+    inputs = [{"question": questions[indices[0]], "sources": {}} for indices in unique]
+    print(f"Batch of {len(questions)} questions ({len(unique)} unique), max concurrency {max_concurrency}")
+
+    for position, output in chain.batch_as_completed(inputs,
+                                                     config={"max_concurrency": max_concurrency},
+                                                     return_exceptions=True):
+        if isinstance(output, Exception):
+            print(f"Error generating batch response: {str(output)}")
+            output = ERROR_RESPONSE
+        for index in unique[position]:
+            yield {
+                "index": index,
+                "question": questions[index],
+                "answer": output,
+                "sources": inputs[position]["sources"],
+            }
+
+
+def stream_question(chain: Any, question: str,
+                    metadata_filter: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Stream a finance question through the RAG chain.
+
+    Yields {"type": "sources", "sources": {...}} once the context stage has
+    finished, then {"type": "token", "token": "..."} for every generated token.
+    An {"type": "error", "error": "..."} event ends the stream on failure.
+    """
+    sources: Dict[str, Any] = {}
+    sources_sent = False
+    try:
+        print(f"Streaming question: {question}")
+        for token in chain.stream({"question": question, "sources": sources, "filter": metadata_filter}):
+            if not sources_sent:
+                sources_sent = True
+                yield {"type": "sources", "sources": sources}
+            yield {"type": "token", "token": token}
+    except Exception as e:
+        print(f"Error streaming response: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        yield {"type": "error", "error": ERROR_RESPONSE}
+        return
+
+    if not sources_sent:
+        yield {"type": "sources", "sources": sources}
+
+
+
+async def aask_question(chain: Any, question: str, sources: Optional[Dict[str, Any]] = None,
+                        metadata_filter: Optional[Dict[str, Any]] = None) -> str:
+    """
+    Async variant of ask_question, built on the chain's ainvoke.
+    """
+    try:
+        print(f"Processing question: {question}")
+        return await chain.ainvoke({"question": question, "sources": sources, "filter": metadata_filter})
+    except Exception as e:
+        print(f"Error generating response: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return ERROR_RESPONSE
+
+
+async def astream_question(chain: Any, question: str,
+                           metadata_filter: Optional[Dict[str, Any]] = None) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Async variant of stream_question, built on the chain's astream.
+    """
+    sources: Dict[str, Any] = {}
+    sources_sent = False
+    try:
+        print(f"Streaming question: {question}")
+        async for token in chain.astream({"question": question, "sources": sources, "filter": metadata_filter}):
+            if not sources_sent:
+                sources_sent = True
+                yield {"type": "sources", "sources": sources}
+            yield {"type": "token", "token": token}
+    except Exception as e:
+        print(f"Error streaming response: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        yield {"type": "error", "error": ERROR_RESPONSE}
+        return
+
+    if not sources_sent:
+        yield {"type": "sources", "sources": sources}
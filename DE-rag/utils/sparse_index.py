@@ -0,0 +1,263 @@
+import asyncio
+import math
+import os
+import re
+import sqlite3
+import threading
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from langchain.schema import Document
+from utils.document_processor import chunk_id
+
+# Keeps tickers, figures and labels like "10-k", "q3", "fy2024", "$4.2b", "12.5%" and
+# CUSIPs as single tokens instead of splitting them on punctuation
+_TOKEN = re.compile(r"[a-z0-9$][a-z0-9$.,&%/-]*[a-z0-9%]|[a-z0-9]")
+
+STOPWORDS = {
+    "a", "an", "and", "s", "are", "as", "at", "be", "by", "for", "from", "has", "have", "how", "in",
+    "is", "it", "its", "of", "on", "or", "that", "the", "their", "this", "to", "was", "were",
+    "what", "when", "which", "who", "will", "with",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split text into lower-case index terms, dropping stopwords.
+    """
+    return [token for token in _TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+
+def sparse_index_path(persist_directory: str, collection_name: str) -> str:
+    """
+    Location of a collection's keyword index, next to its Chroma files.
+    """
+    return os.path.join(persist_directory, f"{collection_name}.bm25.sqlite")
+
+
+class SparseIndex:
+    """
+    Persistent BM25 inverted index over the chunks of one collection.
+
+    Dense search is weak on exact tokens such as tickers, CUSIPs and quarter
+    labels; this index scores them exactly. It is kept in a SQLite file next
+    to the Chroma collection: postings keyed by term and chunk ID, plus each
+    chunk's length. Adds and removals are written as they happen rather than
+    rewriting the index, and a search reads only the postings of its query
+    terms, so no process holds the index in memory. Chunk text, metadata and
+    filters are resolved against the collection (set collection before
+    searching with a filter or fetching documents).
+    """
+
+    def __init__(self, path: str, k1: float = 1.5, b: float = 0.75, read_only: bool = False):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self.collection: Any = None
+        self._lock = threading.RLock()
+        if read_only:
+            self._conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS chunks (id TEXT PRIMARY KEY, length INTEGER NOT NULL);"
+            "CREATE TABLE IF NOT EXISTS postings ("
+            "term TEXT NOT NULL, id TEXT NOT NULL, tf INTEGER NOT NULL, PRIMARY KEY (term, id)) WITHOUT ROWID;"
+            "CREATE INDEX IF NOT EXISTS postings_id ON postings (id);"
+            "CREATE TABLE IF NOT EXISTS totals (name TEXT PRIMARY KEY, value INTEGER NOT NULL);"
+            "INSERT OR IGNORE INTO totals VALUES ('chunks', 0), ('length', 0);"
+        )
+        self._conn.commit()
+
+    def _totals(self) -> Tuple[int, int]:
+        totals = dict(self._conn.execute("SELECT name, value FROM totals").fetchall())
+        return totals.get("chunks", 0), totals.get("length", 0)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._totals()[0]
+
+    def indexed_ids(self) -> Set[str]:
+        with self._lock:
+            return {row[0] for row in self._conn.execute("SELECT id FROM chunks")}
+
+    def add(self, documents: Iterable[Document], ids: Optional[List[str]] = None) -> int:
+        """
+        Index documents, replacing any already indexed under the same id.
+        Returns the number of documents indexed.
+        """
+        documents = list(documents)
+        ids = ids or [chunk_id(doc) for doc in documents]
+        chunks, postings = [], []
+        for doc_id, doc in zip(ids, documents):
+            counts = Counter(tokenize(doc.page_content))
+            chunks.append((doc_id, sum(counts.values())))
+            postings.extend((term, doc_id, tf) for term, tf in counts.items())
+        with self._lock:
+            self._remove(ids)
+            self._conn.executemany("INSERT INTO chunks VALUES (?, ?)", chunks)
+            self._conn.executemany("INSERT INTO postings VALUES (?, ?, ?)", postings)
+            self._conn.execute("UPDATE totals SET value = value + ? WHERE name = 'chunks'", (len(chunks),))
+            self._conn.execute("UPDATE totals SET value = value + ? WHERE name = 'length'",
+                               (sum(length for _, length in chunks),))
+            self._conn.commit()
+        return len(documents)
+
+    def _remove(self, ids: List[str]) -> int:
+        removed, length = 0, 0
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            marks = ",".join("?" * len(batch))
+            count, total = self._conn.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(length), 0) FROM chunks WHERE id IN ({marks})", batch
+            ).fetchone()
+            if not count:
+                continue
+            self._conn.execute(f"DELETE FROM chunks WHERE id IN ({marks})", batch)
+            self._conn.execute(f"DELETE FROM postings WHERE id IN ({marks})", batch)
+            removed += count
+            length += total
+        if removed:
+            self._conn.execute("UPDATE totals SET value = value - ? WHERE name = 'chunks'", (removed,))
+            self._conn.execute("UPDATE totals SET value = value - ? WHERE name = 'length'", (length,))
+        return removed
+
+    def remove(self, ids: Iterable[str]) -> int:
+        """
+        Drop documents from the index. Returns the number removed.
+        """
+        with self._lock:
+            removed = self._remove(list(ids))
+            self._conn.commit()
+        return removed
+
+    def sync(self, collection: Any, page_size: int = 5000) -> Dict[str, int]:
+        """
+        Bring the index in line with a Chroma collection: index the chunks it
+        is missing (e.g. a collection ingested before the index existed) and
+        drop the ones no longer stored. Returns added/removed counts.
+        """
+        indexed = self.indexed_ids()
+        stored: Set[str] = set()
+        added = 0
+        offset = 0
+        while True:
+            page = collection.get(include=["documents"], limit=page_size, offset=offset)
+            if not page["ids"]:
+                break
+            stored.update(page["ids"])
+            new = [(doc_id, text) for doc_id, text in zip(page["ids"], page["documents"]) if doc_id not in indexed]
+            if new:
+                added += self.add([Document(page_content=text or "") for _, text in new], [doc_id for doc_id, _ in new])
+            offset += len(page["ids"])
+        removed = self.remove(indexed - stored)
+        return {"added": added, "removed": removed}
+
+    def search(self, query: str, k: int = 4, where: Optional[Dict[str, Any]] = None) -> List[Tuple[str, float]]:
+        """
+        Return the top k (id, BM25 score) pairs for a query. A where filter
+        (Chroma syntax) restricts scoring to matching chunks.
+        """
+        allowed = set(self.collection.get(where=where, include=[])["ids"]) if where else None
+        with self._lock:
+            n, total_length = self._totals()
+            if not n:
+                return []
+            avg_length = total_length / n or 1.0
+            scores: Dict[str, float] = {}
+            for term in set(tokenize(query)):
+                postings = self._conn.execute(
+                    "SELECT postings.id, tf, length FROM postings JOIN chunks ON chunks.id = postings.id "
+                    "WHERE term = ?", (term,)
+                ).fetchall()
+                if not postings:
+                    continue
+                idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id, tf, length in postings:
+                    if allowed is not None and doc_id not in allowed:
+                        continue
+                    norm = tf + self.k1 * (1 - self.b + self.b * length / avg_length)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / norm
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def documents(self, ids: List[str]) -> List[Document]:
+        """
+        Fetch indexed chunks from the collection, in the order of ids.
+        """
+        if not ids:
+            return []
+        found = self.collection.get(ids=ids, include=["documents", "metadatas"])
+        by_id = {doc_id: (text, metadata) for doc_id, text, metadata
+                 in zip(found["ids"], found["documents"], found["metadatas"])}
+        return [Document(page_content=by_id[doc_id][0], metadata=by_id[doc_id][1] or {})
+                for doc_id in ids if doc_id in by_id]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+def _fusion_key(doc: Document) -> Tuple[str, str]:
+    return str((doc.metadata or {}).get("source", "")), doc.page_content
+
+
+class HybridRetriever:
+    """
+    Retriever that fuses dense (Chroma) and keyword (BM25) results.
+
+    Both searches return fetch_k candidates and the lists are merged with
+    reciprocal rank fusion, so a chunk that matches an exact ticker or quarter
+    label ranks well even when its embedding is only loosely similar. A
+    metadata_filter (Chroma where syntax) scopes both searches. Exposes
+    invoke/ainvoke like a LangChain retriever.
+    """
+
+    def __init__(self,
+                 vector_db: Any,
+                 sparse_index: SparseIndex,
+                 k: int = 4,
+                 fetch_k: Optional[int] = None,
+                 rrf_k: int = 60,
+                 sparse_weight: float = 1.0,
+                 metadata_filter: Optional[Dict[str, Any]] = None):
+        self.vector_db = vector_db
+        self.sparse_index = sparse_index
+        self.k = k
+        self.fetch_k = fetch_k or max(4 * k, 20)
+        self.rrf_k = rrf_k
+        self.sparse_weight = sparse_weight
+        self.metadata_filter = metadata_filter
+
+    def fuse(self, dense: List[Document], sparse: List[Document]) -> List[Document]:
+        """
+        Merge two ranked lists with reciprocal rank fusion and keep the top k.
+        """
+        scores: Dict[Tuple[str, str], float] = {}
+        docs: Dict[Tuple[str, str], Document] = {}
+        for weight, ranked in ((1.0, dense), (self.sparse_weight, sparse)):
+            for rank, doc in enumerate(ranked):
+                key = _fusion_key(doc)
+                docs.setdefault(key, doc)
+                scores[key] = scores.get(key, 0.0) + weight / (self.rrf_k + rank + 1)
+        best = sorted(scores, key=scores.get, reverse=True)[:self.k]
+        return [docs[key] for key in best]
+
+    def _dense(self, query: str) -> List[Document]:
+        if self.metadata_filter:
+            return self.vector_db.similarity_search(query, k=self.fetch_k, filter=self.metadata_filter)
+        return self.vector_db.similarity_search(query, k=self.fetch_k)
+
+    def _sparse(self, query: str) -> List[Document]:
+        return self.sparse_index.documents(
+            [doc_id for doc_id, _ in self.sparse_index.search(query, self.fetch_k, self.metadata_filter)])
+
+    def invoke(self, query: str) -> List[Document]:
+        return self.fuse(self._dense(query), self._sparse(query))
+
+    async def ainvoke(self, query: str) -> List[Document]:
+        dense, sparse = await asyncio.gather(
+            asyncio.to_thread(self._dense, query),
+            asyncio.to_thread(self._sparse, query),
+        )
+        return self.fuse(dense, sparse)
@@ -0,0 +1,39 @@
+import json
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Iterable, Iterator
+
+# Headers that stop proxies (nginx in particular) from buffering the stream
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
+
+
+def sse_event(event: str, data: Any) -> str:
+    """
+    Format one Server-Sent Event with a JSON payload.
+    """
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def sse_stream(events: Iterable[Dict[str, Any]]) -> Iterator[str]:
+    """
+    Turn stream_question events into Server-Sent Events, ending with a "done" event.
+    """
+    for event in events:
+        kind = event["type"]
+        yield sse_event(kind, {k: v for k, v in event.items() if k != "type"})
+        if kind == "error":
+            return
+    yield sse_event("done", {})
+
+
+async def asse_stream(events: AsyncIterable[Dict[str, Any]]) -> AsyncIterator[str]:
+    """
+    Async variant of sse_stream for astream_question events.
+    """
+    async for event in events:
+        kind = event["type"]
+        yield sse_event(kind, {k: v for k, v in event.items() if k != "type"})
+        if kind == "error":
+            return
+    yield sse_event("done", {})
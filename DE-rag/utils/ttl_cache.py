@@ -0,0 +1,219 @@
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+
+def estimate_size(value: Any) -> int:
+    """
+    Rough in-memory size of a JSON-like value, used for the cache memory cap.
+    """
+    try:
+        return len(json.dumps(value, default=str))
+    except Exception:
+        return len(str(value))
+
+
+class StaleWhileRevalidateCache:
+    """
+    Bounded LRU cache with per-kind TTLs and stale-while-revalidate reads.
+
+    Entries are keyed by (kind, key). A fresh entry is returned as is. An expired
+    entry is still returned immediately while a single background refresh runs.
+    A missing entry is loaded synchronously, with concurrent callers for the same
+    key sharing one load. Entries are evicted least-recently-used first once the
+    estimated size of all values exceeds max_bytes.
+    """
+
+    def __init__(self,
+                 ttls: Dict[str, float],
+                 max_bytes: int = 16 * 1024 * 1024,
+                 negative_ttl: float = 30.0,
+                 refresh_workers: int = 4):
+        self._ttls = dict(ttls)
+        self._max_bytes = max_bytes
+        self._negative_ttl = negative_ttl
+        self._entries: "OrderedDict[Tuple[str, Hashable], Dict[str, Any]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._load_locks: Dict[Tuple[str, Hashable], threading.Lock] = {}
+        self._refreshing = set()
+        self._pending: Dict[Tuple[str, Hashable], "asyncio.Future"] = {}
+        self._tasks = set()
+        self._refresher = ThreadPoolExecutor(max_workers=refresh_workers,
+                                             thread_name_prefix="cache-refresh")
+        self._counters = {
+            "hits": 0,
+            "stale_hits": 0,
+            "misses": 0,
+            "refreshes": 0,
+            "refresh_errors": 0,
+            "evictions": 0,
+        }
+
+    def _ttl_for(self, kind: str, value: Any) -> float:
+        ttl = self._ttls.get(kind, 60.0)
+        # Empty results (no match or a swallowed upstream error) are kept briefly
+        return ttl if value else min(ttl, self._negative_ttl)
+
+    def put(self, kind: str, key: Hashable, value: Any) -> None:
+        """
+        Store a value, evicting least-recently-used entries over the memory cap.
+        """
+        cache_key = (kind, key)
+        size = estimate_size(value) + estimate_size(key)
+        entry = {
+            "value": value,
+            "size": size,
+            "expires_at": time.monotonic() + self._ttl_for(kind, value),
+        }
+
+        with self._lock:
+            old = self._entries.pop(cache_key, None)
+            if old:
+                self._bytes -= old["size"]
+            if size > self._max_bytes:
+                return
+            self._entries[cache_key] = entry
+            self._bytes += size
+            while self._bytes > self._max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted["size"]
+                self._counters["evictions"] += 1
+
+    def _lookup(self, cache_key: Tuple[str, Hashable]) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(cache_key)
+        if entry is not None:
+            self._entries.move_to_end(cache_key)
+        return entry
+
+    def _refresh(self, kind: str, key: Hashable, loader: Callable[[], Any]) -> None:
+        try:
+            self.put(kind, key, loader())
+            with self._lock:
+                self._counters["refreshes"] += 1
+        except Exception as e:
+            print(f"Background refresh of {kind}:{key} failed: {str(e)}")
+            with self._lock:
+                self._counters["refresh_errors"] += 1
+        finally:
+            with self._lock:
+                self._refreshing.discard((kind, key))
+
+    def get_or_load(self, kind: str, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """
+        Return the cached value for (kind, key), loading or refreshing it as needed.
+        """
+        cache_key = (kind, key)
+        with self._lock:
+            entry = self._lookup(cache_key)
+            if entry is not None:
+                if entry["expires_at"] > time.monotonic():
+                    self._counters["hits"] += 1
+                    return entry["value"]
+
+                self._counters["stale_hits"] += 1
+                if cache_key not in self._refreshing:
+                    self._refreshing.add(cache_key)
+                    self._refresher.submit(self._refresh, kind, key, loader)
+                return entry["value"]
+
+            load_lock = self._load_locks.setdefault(cache_key, threading.Lock())
+
+        try:
+            with load_lock:
+                # A concurrent caller may have loaded it while we waited
+                with self._lock:
+                    entry = self._lookup(cache_key)
+                    if entry is not None:
+                        self._counters["hits"] += 1
+                        return entry["value"]
+                    self._counters["misses"] += 1
+
+                value = loader()
+                self.put(kind, key, value)
+                return value
+        finally:
+            # Also when the loader raises, so failed keys do not leave a lock behind
+            with self._lock:
+                if self._load_locks.get(cache_key) is load_lock:
+                    del self._load_locks[cache_key]
+
+    async def _arefresh(self, kind: str, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> None:
+        try:
+            self.put(kind, key, await loader())
+            with self._lock:
+                self._counters["refreshes"] += 1
+        except Exception as e:
+            print(f"Background refresh of {kind}:{key} failed: {str(e)}")
+            with self._lock:
+                self._counters["refresh_errors"] += 1
+        finally:
+            with self._lock:
+                self._refreshing.discard((kind, key))
+
+    async def _aload(self, kind: str, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            value = await loader()
+            self.put(kind, key, value)
+            return value
+        finally:
+            with self._lock:
+                self._pending.pop((kind, key), None)
+
+    def _spawn(self, coro) -> "asyncio.Task":
+        # Keep a reference so the event loop does not drop running tasks
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def aget_or_load(self, kind: str, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Async variant of get_or_load for the ASGI path, with an async loader.
+        Stale entries are refreshed by a background task on the running loop.
+        """
+        cache_key = (kind, key)
+        with self._lock:
+            entry = self._lookup(cache_key)
+            if entry is not None:
+                if entry["expires_at"] > time.monotonic():
+                    self._counters["hits"] += 1
+                    return entry["value"]
+
+                self._counters["stale_hits"] += 1
+                if cache_key not in self._refreshing:
+                    self._refreshing.add(cache_key)
+                    self._spawn(self._arefresh(kind, key, loader))
+                return entry["value"]
+
+            pending = self._pending.get(cache_key)
+            if pending is None:
+                self._counters["misses"] += 1
+                pending = self._spawn(self._aload(kind, key, loader))
+                self._pending[cache_key] = pending
+            else:
+                self._counters["hits"] += 1
+
+        return await asyncio.shield(pending)
+
+    def clear(self) -> None:
+        """
+        Drop every cached entry.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Return a snapshot of the cache counters and memory use.
+        """
+        with self._lock:
+            return dict(self._counters,
+                        entries=len(self._entries),
+                        bytes=self._bytes,
+                        max_bytes=self._max_bytes)
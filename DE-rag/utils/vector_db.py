@@ -1,57 +1,412 @@
 from pathlib import Path
 import os
 from langchain_community.vectorstores import Chroma
-from langchain_ollama import OllamaEmbeddings
-from typing import Optional, List
+from typing import Any, Dict, Iterable, Optional, List, Set
 from langchain.schema import Document
+from utils.document_processor import chunk_id, iter_process_documents, format_load_report
+from utils.ingest_manifest import IngestManifest, file_hash, source_key
+from utils.sparse_index import SparseIndex, sparse_index_path
+from utils.embedding_cache import CachedEmbeddings, get_embedding_cache
+from utils.batch_embeddings import OllamaBatchEmbeddings, batched, prefetched
+from utils.vector_store_registry import registry
+from utils.quantized_index import QuantizedIndex
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+EMBEDDING_MODEL = "nomic-embed-text"
 
-def create_vector_db(documents: List[Document],
+# On-disk cache of chunk embeddings used at ingestion; EMBEDDING_CACHE=0 disables it
+EMBEDDING_CACHE_PATH = os.environ.get('EMBEDDING_CACHE_PATH', "./db/embedding_cache.sqlite")
+EMBEDDING_CACHE_MAX_MB = int(os.environ.get('EMBEDDING_CACHE_MAX_MB', 512))
+
+# Chunks per Ollama embedding request and requests in flight during ingestion
+EMBED_BATCH_SIZE = int(os.environ.get('EMBED_BATCH_SIZE', 64))
+EMBED_MAX_IN_FLIGHT = int(os.environ.get('EMBED_MAX_IN_FLIGHT', 4))
+
+# Chunks per Chroma write; stays under Chroma's maximum batch size
+UPSERT_BATCH_SIZE = 1000
+
+# Batches of chunks parsed ahead of the one being embedded during streaming ingestion
+INGEST_PREFETCH_BATCHES = int(os.environ.get('INGEST_PREFETCH_BATCHES', 2))
+
+# Optional compressed dense index ("float16" or "int8") served instead of Chroma's
+# float32 HNSW search; pick a mode with: python -m utils.quantized_index
+COMPRESSED_INDEX = os.environ.get('COMPRESSED_INDEX', '')
+
+
+def ingestion_embeddings() -> Any:
+    """
+    Embedding model for ingestion: batched, concurrent Ollama requests behind
+    the on-disk embedding cache so unchanged chunks are not sent again.
+    """
+    embedding_model = OllamaBatchEmbeddings(model=EMBEDDING_MODEL,
+                                            batch_size=EMBED_BATCH_SIZE,
+                                            max_in_flight=EMBED_MAX_IN_FLIGHT)
+    if os.environ.get('EMBEDDING_CACHE', '1') == '0':
+        return embedding_model
+    cache = get_embedding_cache(EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_MAX_MB * 1024 * 1024)
+    cache.reset_stats()
+    return CachedEmbeddings(embedding_model, EMBEDDING_MODEL, cache)
+
+
+def create_vector_db(documents: Iterable[Document],
                      persist_directory: str = "./db/vector_db",
-                     collection_name: str = "docs-financial-rag") -> Chroma:
+                     collection_name: str = "docs-financial-rag",
+                     replace_sources: bool = True,
+                     chunk_ids: Optional[Dict[str, List[str]]] = None) -> Chroma:
     """
     Create or update a vector database from documents using Ollama embeddings.
+    Documents are upserted under deterministic chunk IDs (see upsert_documents),
+    so ingesting the same files again does not add duplicate vectors.
+    documents may be a generator (see iter_process_documents); it is consumed
+    in bounded batches while embedding runs. chunk_ids, if given, receives the
+    chunk IDs produced per source.
     """
     os.makedirs(persist_directory, exist_ok=True)
 
-    embedding_model = OllamaEmbeddings(model="nomic-embed-text")
-    print("Using OllamaEmbeddings: nomic-embed-text")
+    embedding_model = ingestion_embeddings()
+    print(f"Using OllamaEmbeddings: {EMBEDDING_MODEL}")
 
-    vector_db = Chroma.from_documents(
-        documents=documents,
-        embedding=embedding_model,
-        persist_directory=persist_directory,
-        collection_name=collection_name,
-    )
+    vector_db = registry.open(persist_directory, collection_name, embedding_model)
+    report = upsert_documents(vector_db, documents, persist_directory, collection_name, replace_sources,
+                              chunk_ids=chunk_ids)
 
     vector_db.persist()
-    print(f"Vector DB created with {len(documents)} documents at {persist_directory}")
+    print(f"Vector DB updated with {report['added'] + report['unchanged']} documents at {persist_directory}")
+    if isinstance(embedding_model, CachedEmbeddings):
+        print(embedding_model.report())
+        embedding_model = embedding_model.embeddings
+    print(f"Embedding throughput: {embedding_model.stats()}")
+
+    if COMPRESSED_INDEX:
+        build_quantized_index(vector_db, persist_directory, collection_name, COMPRESSED_INDEX)
     return vector_db
 
 
+def ingestion_params(chunk_size: int = 1200,
+                     chunk_overlap: int = 300,
+                     doc_title: str = "Financial-Documents") -> Dict[str, Any]:
+    """
+    Parameters recorded in the manifest; a change in any of them re-ingests a file.
+    """
+    return {"chunk_size": chunk_size, "chunk_overlap": chunk_overlap, "doc_title": doc_title}
+
+
+def plan_ingestion(file_paths: List[str],
+                   persist_directory: str = "./db/vector_db",
+                   collection_name: str = "docs-financial-rag",
+                   params: Optional[Dict[str, Any]] = None,
+                   sources: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """
+    Files that need ingesting, with their content hashes. A file is skipped
+    when its hash and params match the collection's manifest and every chunk
+    recorded for it is still stored. sources maps a file to the source it is
+    stored under when that is not its path (see iter_process_documents).
+    """
+    params = params or ingestion_params()
+    sources = sources or {}
+    manifest = IngestManifest.load(persist_directory, collection_name)
+    changed = manifest.changed_files(file_paths, params, sources)
+
+    try:
+        collection = registry.client(persist_directory).get_collection(collection_name)
+    except Exception:
+        collection = None
+    for file_path in file_paths:
+        if file_path in changed:
+            continue
+        recorded = manifest.entry(sources.get(file_path, file_path))["chunk_ids"]
+        if collection is None or len(collection.get(ids=recorded, include=[])["ids"]) != len(recorded):
+            # Recorded but no longer (fully) stored, e.g. a manifest copied without its data
+            changed[file_path] = file_hash(file_path)
+    return changed
+
+
+def missing_sources(file_paths: List[str],
+                    persist_directory: str = "./db/vector_db",
+                    collection_name: str = "docs-financial-rag",
+                    prefix: str = "",
+                    sources: Optional[Dict[str, str]] = None) -> List[str]:
+    """
+    Sources recorded in the manifest under prefix (e.g. a folder's real path,
+    or an upload namespace) that none of file_paths provides any more.
+    """
+    sources = sources or {}
+    present = {source_key(sources.get(file_path, file_path)) for file_path in file_paths}
+    manifest = IngestManifest.load(persist_directory, collection_name)
+    return sorted(source for source in manifest.entries if source.startswith(prefix) and source not in present)
+
+
+def ingest_files(file_paths: List[str],
+                 persist_directory: str = "./db/vector_db",
+                 collection_name: str = "docs-financial-rag",
+                 chunk_size: int = 1200,
+                 chunk_overlap: int = 300,
+                 doc_title: str = "Financial-Documents",
+                 workers: Optional[int] = None,
+                 changed: Optional[Dict[str, str]] = None,
+                 sources: Optional[Dict[str, str]] = None,
+                 prune_prefix: Optional[str] = None) -> Dict[str, int]:
+    """
+    Ingest files incrementally against the collection's manifest.
+
+    Unchanged files (see plan_ingestion) are skipped without being parsed or
+    embedded. The rest are streamed through create_vector_db, which replaces
+    only their chunks that changed. Each successfully ingested file is then
+    recorded with its hash, parameters and chunk IDs. changed takes a plan
+    computed beforehand; sources gives the source each file is stored and
+    recorded under when that is not its path, so a file saved to a different
+    temp path on every upload still replaces its own earlier chunks. With
+    prune_prefix, file_paths is the complete set under that prefix: recorded
+    sources under it that are not among them (see missing_sources) have their
+    chunks and manifest entries removed. Returns counts of skipped, ingested,
+    failed and removed files.
+    """
+    params = ingestion_params(chunk_size, chunk_overlap, doc_title)
+    sources = sources or {}
+    if changed is None:
+        changed = plan_ingestion(file_paths, persist_directory, collection_name, params, sources)
+
+    missing = [] if prune_prefix is None else missing_sources(file_paths, persist_directory, collection_name,
+                                                              prune_prefix, sources)
+
+    report = {"skipped": len(file_paths) - len(changed), "ingested": 0, "failed": 0, "removed": len(missing)}
+    print(f"Ingestion manifest: {report['skipped']} unchanged files skipped, {len(changed)} to process, "
+          f"{len(missing)} no longer present")
+    if missing:
+        delete_sources(registry.open(persist_directory, collection_name, ingestion_embeddings()),
+                       missing, persist_directory, collection_name)
+        manifest = IngestManifest.load(persist_directory, collection_name)
+        for source in missing:
+            manifest.remove(source)
+        manifest.save()
+    if not changed:
+        return report
+
+    load_report: List[Dict[str, Any]] = []
+    produced: Dict[str, List[str]] = {}
+    changed_paths = [file_path for file_path in file_paths if file_path in changed]
+    documents = iter_process_documents(changed_paths, chunk_size, chunk_overlap, doc_title, workers, load_report,
+                                       sources)
+    vector_db = create_vector_db(documents, persist_directory, collection_name, replace_sources=True,
+                                 chunk_ids=produced)
+    print(format_load_report(load_report))
+
+    manifest = IngestManifest.load(persist_directory, collection_name)
+    produced = {source_key(source): ids for source, ids in produced.items()}
+    for file_path in changed_paths:
+        source = sources.get(file_path, file_path)
+        ids = produced.get(source_key(source))
+        if ids:
+            manifest.record(source, changed[file_path], params, ids)
+            report["ingested"] += 1
+        else:
+            # Failed to parse or produced no text; retried on the next run
+            report["failed"] += 1
+    manifest.save()
+
+    print(f"Ingested {report['ingested']} files ({report['failed']} failed), "
+          f"collection holds {vector_db._collection.count()} chunks")
+    return report
+
+
+def upsert_documents(vector_db: Chroma,
+                     documents: Iterable[Document],
+                     persist_directory: str = "./db/vector_db",
+                     collection_name: str = "docs-financial-rag",
+                     replace_sources: bool = True,
+                     batch_size: int = UPSERT_BATCH_SIZE,
+                     chunk_ids: Optional[Dict[str, List[str]]] = None) -> Dict[str, int]:
+    """
+    Incrementally sync documents into the collection under chunk_id IDs.
+
+    Documents are consumed in batches of batch_size: each batch is checked
+    against the store and only new chunks are embedded and written, while the
+    next batches are produced on a background thread. Only chunk IDs are kept
+    across batches, so memory does not grow with the size of the corpus text.
+    With replace_sources, every source seen is treated as complete: its stored
+    chunks that are no longer produced (changed or removed text) are deleted
+    at the end. The keyword index is kept in step. chunk_ids, if given,
+    receives the chunk IDs produced per source. Returns added/unchanged/removed counts.
+    """
+    collection = vector_db._collection
+    sparse_index = open_sparse_index(vector_db, persist_directory, collection_name)
+    seen: Set[str] = set()
+    produced: Dict[str, Set[str]] = {}
+    report = {"added": 0, "unchanged": 0, "removed": 0}
+
+    for batch in prefetched(batched(documents, batch_size), INGEST_PREFETCH_BATCHES):
+        unique: Dict[str, Document] = {}
+        for doc in batch:
+            doc_id = chunk_id(doc)
+            if doc_id in seen:
+                continue
+            seen.add(doc_id)
+            unique[doc_id] = doc
+            source = doc.metadata.get('source') if doc.metadata else None
+            if (replace_sources or chunk_ids is not None) and source is not None:
+                produced.setdefault(source, set()).add(doc_id)
+        if not unique:
+            continue
+
+        ids = list(unique)
+        existing = set(collection.get(ids=ids, include=[])["ids"])
+        new_ids = [doc_id for doc_id in ids if doc_id not in existing]
+        if new_ids:
+            new_docs = [unique[doc_id] for doc_id in new_ids]
+            vector_db.add_documents(new_docs, ids=new_ids)
+            sparse_index.add(new_docs, new_ids)
+        report["added"] += len(new_ids)
+        report["unchanged"] += len(existing)
+        print(f"Upserted batch of {len(ids)} chunks ({report['added'] + report['unchanged']} so far)")
+
+    stale: List[str] = []
+    for source, ids in produced.items():
+        if chunk_ids is not None:
+            chunk_ids[source] = sorted(ids)
+        if replace_sources:
+            stored = collection.get(where={"source": source}, include=[])["ids"]
+            stale.extend(doc_id for doc_id in stored if doc_id not in ids)
+    if stale:
+        vector_db.delete(ids=stale)
+        sparse_index.remove(stale)
+    report["removed"] = len(stale)
+
+    if report["added"] or stale:
+        print(f"Keyword index updated, {len(sparse_index)} chunks indexed")
+    sparse_index.close()
+
+    print(f"Upserted chunks: {report['added']} added, {report['unchanged']} unchanged, "
+          f"{report['removed']} removed")
+    return report
+
+
+def delete_sources(vector_db: Chroma,
+                   sources: List[str],
+                   persist_directory: str = "./db/vector_db",
+                   collection_name: str = "docs-financial-rag") -> int:
+    """
+    Remove every chunk of sources that no longer exist. Returns the number removed.
+    """
+    stale: List[str] = []
+    for source in sources:
+        stale.extend(vector_db._collection.get(where={"source": source}, include=[])["ids"])
+    if stale:
+        vector_db.delete(ids=stale)
+        update_sparse_index(vector_db, [], persist_directory, collection_name, removed=stale)
+    print(f"Removed {len(stale)} chunks from {len(sources)} sources")
+    return len(stale)
+
+
+def open_sparse_index(vector_db: Chroma,
+                      persist_directory: str = "./db/vector_db",
+                      collection_name: str = "docs-financial-rag") -> SparseIndex:
+    """
+    Open the collection's BM25 keyword index for writing, creating it if needed.
+
+    An index that is missing or out of step with the collection (e.g. one
+    ingested before hybrid retrieval existed) is backfilled from the stored
+    chunks first, so every chunk the vector store holds can be found by keyword.
+    """
+    legacy = os.path.join(persist_directory, f"{collection_name}.bm25.json")
+    if os.path.exists(legacy):
+        os.remove(legacy)
+    sparse_index = SparseIndex(sparse_index_path(persist_directory, collection_name))
+    sparse_index.collection = vector_db._collection
+    if len(sparse_index) != vector_db._collection.count():
+        synced = sparse_index.sync(vector_db._collection)
+        print(f"Keyword index backfilled: {synced['added']} added, {synced['removed']} removed")
+    return sparse_index
+
+
+def update_sparse_index(vector_db: Chroma,
+                        documents: List[Document],
+                        persist_directory: str = "./db/vector_db",
+                        collection_name: str = "docs-financial-rag",
+                        ids: Optional[List[str]] = None,
+                        removed: Optional[List[str]] = None) -> None:
+    """
+    Add documents to (and drop removed IDs from) the collection's BM25 keyword index.
+    """
+    sparse_index = open_sparse_index(vector_db, persist_directory, collection_name)
+    try:
+        sparse_index.remove(removed or [])
+        if documents:
+            sparse_index.add(documents, ids)
+        print(f"Keyword index updated, {len(sparse_index)} chunks indexed")
+    finally:
+        sparse_index.close()
+
+
+def load_sparse_index(persist_directory: str = "./db/vector_db",
+                      collection_name: str = "docs-financial-rag") -> Optional[SparseIndex]:
+    """
+    Open the collection's BM25 keyword index read-only, or None if it has not been built.
+    """
+    path = sparse_index_path(persist_directory, collection_name)
+    if not os.path.exists(path):
+        return None
+    try:
+        return SparseIndex(path, read_only=True)
+    except Exception as e:
+        print(f"Error loading keyword index: {str(e)}")
+        return None
+
+
+def build_quantized_index(vector_db: Chroma,
+                          persist_directory: str = "./db/vector_db",
+                          collection_name: str = "docs-financial-rag",
+                          mode: str = "int8") -> QuantizedIndex:
+    """
+    Rebuild the collection's compressed index from its stored embeddings and save it.
+    """
+    vectors, ids = QuantizedIndex.read_collection(vector_db._collection)
+    index = QuantizedIndex.build(vectors, ids, mode)
+    index.save(persist_directory, collection_name)
+    print(f"Compressed {mode} index built over {len(index)} chunks "
+          f"({index.memory_bytes() / (1024 * 1024):.1f} MB resident)")
+    return index
+
+
+def load_quantized_index(vector_db: Chroma,
+                         persist_directory: str = "./db/vector_db",
+                         collection_name: str = "docs-financial-rag",
+                         mode: str = "int8") -> Optional[QuantizedIndex]:
+    """
+    Load the collection's compressed index, rebuilding it if it is missing or
+    was built from different chunks than the collection holds (compared by a
+    fingerprint of chunk IDs, so a re-ingestion that keeps the chunk count is
+    still caught). Queries are embedded with the store's model.
+    """
+    try:
+        index = QuantizedIndex.load(persist_directory, collection_name, mode)
+        stored = QuantizedIndex.collection_fingerprint(vector_db._collection)
+        if index is None or index.fingerprint() != stored:
+            index = build_quantized_index(vector_db, persist_directory, collection_name, mode)
+        index.collection = vector_db._collection
+        index.embeddings = vector_db.embeddings
+        return index
+    except Exception as e:
+        print(f"Error loading compressed index: {str(e)}")
+        return None
+
+
 def load_vector_db(persist_directory: str = "./db/vector_db",
                    collection_name: str = "docs-financial-rag") -> Optional[Chroma]:
     """
     Load an existing vector database using Ollama embeddings.
+    The handle is shared process-wide through the registry; callers that reload
+    should release_vector_db their previous handle.
     """
     try:
         Path(persist_directory).mkdir(parents=True, exist_ok=True)
         print(f"Loading vector database from {persist_directory} with collection {collection_name}")
+        print(f"Using OllamaEmbeddings: {EMBEDDING_MODEL}")
 
-        # Initialize embedding function with Ollama
-        embedding_model = OllamaEmbeddings(model="nomic-embed-text")
-        print("Using OllamaEmbeddings: nomic-embed-text")
-
-        # Initialize or load Chroma DB with the embedding function
-        vector_db = Chroma(
-            persist_directory=persist_directory,
-            embedding_function=embedding_model,
-            collection_name=collection_name,
-        )
+        # Shared Chroma handle with the shared embedding client
+        vector_db = registry.acquire(persist_directory, collection_name, EMBEDDING_MODEL)
 
         # Get collection stats
         count = vector_db._collection.count()
@@ -63,4 +418,12 @@ def load_vector_db(persist_directory: str = "./db/vector_db",
         print(f"Error loading vector database: {str(e)}")
         import traceback
         traceback.print_exc()
-        return None
\ No newline at end of file
+        return None
+
+
+def release_vector_db(persist_directory: str = "./db/vector_db",
+                      collection_name: str = "docs-financial-rag") -> None:
+    """
+    Release a handle obtained from load_vector_db.
+    """
+    registry.release(persist_directory, collection_name)
@@ -0,0 +1,165 @@
+import os
+import threading
+from typing import Any, Callable, Dict, Tuple
+
+import chromadb
+from langchain_community.vectorstores import Chroma
+from langchain_ollama import OllamaEmbeddings
+from utils.embedding_cache import QueryEmbeddingCache, get_embedding_cache
+
+# Question embeddings kept in memory per process; set QUERY_EMBEDDING_CACHE_PATH
+# to add an on-disk tier shared by all workers on the host
+QUERY_EMBEDDING_CACHE_SIZE = int(os.environ.get('QUERY_EMBEDDING_CACHE_SIZE', 2048))
+QUERY_EMBEDDING_CACHE_PATH = os.environ.get('QUERY_EMBEDDING_CACHE_PATH')
+
+
+def query_embeddings(model: str) -> Any:
+    """
+    Embedding client for the query path, with question embeddings cached.
+    """
+    embeddings = OllamaEmbeddings(model=model)
+    if QUERY_EMBEDDING_CACHE_SIZE <= 0:
+        return embeddings
+    disk = get_embedding_cache(QUERY_EMBEDDING_CACHE_PATH, 64 * 1024 * 1024) if QUERY_EMBEDDING_CACHE_PATH else None
+    return QueryEmbeddingCache(embeddings, model, QUERY_EMBEDDING_CACHE_SIZE, disk)
+
+
+def close_client(client: Any) -> None:
+    """
+    Stop one Chroma client's system, freeing its loaded segments (e.g. the
+    HNSW index), without touching other directories' clients as
+    clear_system_cache() would.
+    """
+    try:
+        systems = getattr(type(client), "_identifier_to_system", None)
+        identifier = getattr(client, "_identifier", None)
+        if systems is not None and identifier is not None:
+            systems.pop(identifier, None)
+        system = getattr(client, "_system", None)
+        if system is not None:
+            system.stop()
+    except Exception as e:
+        print(f"Error closing vector store client: {str(e)}")
+
+
+class VectorStoreRegistry:
+    """
+    Process-wide owner of vector store clients and embedding models.
+
+    There is one Chroma client per persist directory, one embedding client per
+    model and one shared Chroma handle per (persist_directory, collection_name).
+    Entry points acquire a handle instead of building their own, so /refresh,
+    /health and the second API in a process reuse the same clients. Every
+    acquire is matched by a release; a handle is dropped once nobody holds it,
+    and a directory's client is closed with its last handle.
+    """
+
+    def __init__(self, embeddings_factory: Callable[[str], Any] = query_embeddings):
+        self._embeddings_factory = embeddings_factory
+        self._lock = threading.RLock()
+        self._clients: Dict[str, Any] = {}
+        self._embeddings: Dict[str, Any] = {}
+        self._handles: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self._counters = {"handles_created": 0, "handles_reused": 0, "handles_released": 0}
+
+    @staticmethod
+    def _key(persist_directory: str, collection_name: str) -> Tuple[str, str]:
+        return os.path.abspath(persist_directory), collection_name
+
+    def client(self, persist_directory: str) -> Any:
+        """
+        Return the shared Chroma client for a persist directory.
+        """
+        path = os.path.abspath(persist_directory)
+        with self._lock:
+            if path not in self._clients:
+                os.makedirs(path, exist_ok=True)
+                self._clients[path] = chromadb.PersistentClient(path=path)
+            return self._clients[path]
+
+    def embeddings(self, model: str) -> Any:
+        """
+        Return the shared embedding client for a model.
+        """
+        with self._lock:
+            if model not in self._embeddings:
+                self._embeddings[model] = self._embeddings_factory(model)
+            return self._embeddings[model]
+
+    def open(self, persist_directory: str, collection_name: str, embedding_function: Any) -> Chroma:
+        """
+        Build an unshared Chroma handle on the shared client, e.g. for ingestion
+        with a different embedding function.
+        """
+        return Chroma(
+            client=self.client(persist_directory),
+            persist_directory=persist_directory,
+            collection_name=collection_name,
+            embedding_function=embedding_function,
+        )
+
+    def acquire(self, persist_directory: str, collection_name: str, model: str) -> Chroma:
+        """
+        Return the shared handle for a collection, creating it on first use,
+        and take a reference to it.
+        """
+        key = self._key(persist_directory, collection_name)
+        with self._lock:
+            entry = self._handles.get(key)
+            if entry is None:
+                handle = self.open(persist_directory, collection_name, self.embeddings(model))
+                entry = self._handles[key] = {"handle": handle, "refs": 0}
+                self._counters["handles_created"] += 1
+            else:
+                self._counters["handles_reused"] += 1
+            entry["refs"] += 1
+            return entry["handle"]
+
+    def release(self, persist_directory: str, collection_name: str) -> None:
+        """
+        Drop a reference taken by acquire. The handle is dropped with the last
+        one, and the directory's client is closed once it has no handles left.
+        """
+        key = self._key(persist_directory, collection_name)
+        client = None
+        with self._lock:
+            entry = self._handles.get(key)
+            if entry is None:
+                return
+            entry["refs"] -= 1
+            if entry["refs"] <= 0:
+                del self._handles[key]
+                self._counters["handles_released"] += 1
+                if not any(path == key[0] for path, _ in self._handles):
+                    client = self._clients.pop(key[0], None)
+        if client is not None:
+            close_client(client)
+
+    def discard(self, persist_directory: str) -> None:
+        """
+        Forget every handle and the client for a directory that is being deleted.
+        """
+        path = os.path.abspath(persist_directory)
+        with self._lock:
+            for key in [key for key in self._handles if key[0] == path]:
+                del self._handles[key]
+            client = self._clients.pop(path, None)
+        if client is not None:
+            close_client(client)
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return handle counters and the references held per collection.
+        """
+        with self._lock:
+            return dict(self._counters,
+                        clients=len(self._clients),
+                        embedding_models=len(self._embeddings),
+                        query_embeddings={model: embeddings.stats()
+                                          for model, embeddings in self._embeddings.items()
+                                          if hasattr(embeddings, "stats")},
+                        handles={f"{path}:{name}": entry["refs"]
+                                 for (path, name), entry in self._handles.items()})
+
+
+registry = VectorStoreRegistry()